@@ -1,16 +1,39 @@
 import os
+import asyncio
 import logging
+import sqlite3
+import hashlib
+import time
+import math
+import random
+import re
+import html
+import json
+import bisect
+import itertools
+import functools
+import queue
+import atexit
+from collections import OrderedDict, deque, namedtuple
 from datetime import datetime
 from dotenv import load_dotenv
 from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from gigachat import GigaChat
-from gigachat.models import Chat, Messages, MessagesRole
+from telegram.constants import ParseMode
+from telegram.error import BadRequest, RetryAfter
+from telegram.ext import Application, ApplicationHandlerStop, CallbackContext, CommandHandler, MessageHandler, TypeHandler, filters, ContextTypes
+import httpx
 import tempfile
-from docx import Document
-from PyPDF2 import PdfReader
-import openpyxl
-from PIL import Image
+import multiprocessing
+import subprocess
+import shutil
+import zipfile
+import struct
+import socket
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager, contextmanager
+from logging.handlers import QueueHandler, QueueListener
 import io
 
 # Load environment variables from .env file
@@ -24,46 +47,2623 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
-# Initialize GigaChat client
+# GigaChat credentials
 GIGACHAT_CREDENTIALS = os.getenv("GIGACHAT_CREDENTIALS")
 GIGACHAT_SCOPE = os.getenv("GIGACHAT_SCOPE")
+GIGACHAT_MODEL = os.getenv("GIGACHAT_MODEL", "GigaChat")
+
+# How many GigaChat requests may run at the same time and how long each may take
+GIGACHAT_MAX_CONCURRENCY = int(os.getenv("GIGACHAT_MAX_CONCURRENCY", "4"))
+GIGACHAT_TIMEOUT = float(os.getenv("GIGACHAT_TIMEOUT", "120"))
+
+# GigaChat HTTP client: endpoints (e.g. a local stub server), keep-alive pool size and OAuth token refresh
+GIGACHAT_BASE_URL = os.getenv("GIGACHAT_BASE_URL")
+GIGACHAT_AUTH_URL = os.getenv("GIGACHAT_AUTH_URL")
+GIGACHAT_MAX_CONNECTIONS = int(os.getenv("GIGACHAT_MAX_CONNECTIONS", str(GIGACHAT_MAX_CONCURRENCY)))
+GIGACHAT_TOKEN_REFRESH_MARGIN = float(os.getenv("GIGACHAT_TOKEN_REFRESH_MARGIN", "120"))
+
+# Retries of failed GigaChat calls (429, 5xx, network errors) with jittered exponential backoff
+GIGACHAT_MAX_RETRIES = int(os.getenv("GIGACHAT_MAX_RETRIES", "3"))
+GIGACHAT_BACKOFF_BASE = float(os.getenv("GIGACHAT_BACKOFF_BASE", "0.5"))
+GIGACHAT_BACKOFF_MAX = float(os.getenv("GIGACHAT_BACKOFF_MAX", "10"))
+
+# Circuit breaker: after this many failed calls in a row GigaChat is not called for the cooldown
+GIGACHAT_BREAKER_THRESHOLD = int(os.getenv("GIGACHAT_BREAKER_THRESHOLD", "5"))
+GIGACHAT_BREAKER_COOLDOWN = float(os.getenv("GIGACHAT_BREAKER_COOLDOWN", "30"))
+
+# Stream GigaChat answers into the placeholder message while they are generated
+GIGACHAT_STREAMING = os.getenv("GIGACHAT_STREAMING", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))
+
+# Telegram rejects messages longer than this
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Deployment mode: "polling" (single instance) or "webhook" (several instances behind a load balancer)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN")
+
+# Alternative Bot API server, e.g. a local fake one for load tests
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL")
+TELEGRAM_API_BASE_FILE_URL = os.getenv("TELEGRAM_API_BASE_FILE_URL")
+
+# Update deduplication: recent update_ids kept in memory, optionally shared between processes
+UPDATE_DEDUP_SIZE = int(os.getenv("UPDATE_DEDUP_SIZE", "10000"))
+UPDATE_DEDUP_DB = os.getenv("UPDATE_DEDUP_DB")
+
+# Durable queue of upload analyses, resumed after a restart; processes sharing the database
+# hold a lease on their jobs, and only jobs whose lease ran out are resumed
+JOB_QUEUE_DB = os.getenv("JOB_QUEUE_DB", "jobs.db")
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_MAX_AGE = int(os.getenv("JOB_MAX_AGE", "21600"))
+JOB_LEASE = float(os.getenv("JOB_LEASE", "60"))
+
+# Analysis scheduling: global cap on running analyses and per-user token buckets
+SCHEDULER_MAX_ACTIVE = int(os.getenv("SCHEDULER_MAX_ACTIVE", "8"))
+USER_RATE_PER_MINUTE = float(os.getenv("USER_RATE_PER_MINUTE", "6"))
+USER_RATE_BURST = int(os.getenv("USER_RATE_BURST", "5"))
+
+# Batching: album parts and uploads that arrive within the window are analysed together
+MEDIA_GROUP_WINDOW = float(os.getenv("MEDIA_GROUP_WINDOW", "1.5"))
+UPLOAD_BATCH_WINDOW = float(os.getenv("UPLOAD_BATCH_WINDOW", "1.5"))
+BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", "10"))
+
+# How many Telegram updates the application may process concurrently
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64"))
+
+# Metrics: Prometheus-style /metrics endpoint (0 = off) and/or a periodic JSON dump
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_DUMP_PATH = os.getenv("METRICS_DUMP_PATH")
+METRICS_DUMP_INTERVAL = float(os.getenv("METRICS_DUMP_INTERVAL", "60"))
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# Errors are appended to this file by a background thread
+ERROR_LOG_PATH = os.getenv("ERROR_LOG_PATH", "log.txt")
+
+# User interaction storage settings
+USERS_DB_PATH = os.getenv("USERS_DB_PATH", "users.db")
+USERS_LEGACY_PATH = os.getenv("USERS_LEGACY_PATH", "users.txt")
+USERS_FLUSH_INTERVAL = float(os.getenv("USERS_FLUSH_INTERVAL", "5"))
+USERS_FLUSH_BATCH = int(os.getenv("USERS_FLUSH_BATCH", "100"))
+
+
+class UserStore:
+    """Append-only log of user interactions backed by SQLite in WAL mode.
+
+    Request counters live in an in-memory index so that logging an interaction
+    is O(1); rows are written to the database in batches off the event loop.
+    """
+
+    def __init__(self, db_path=None, legacy_path=None):
+        self.db_path = db_path or USERS_DB_PATH
+        self.counts = {}
+        self.pending = []
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+        
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS interactions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                user_name TEXT,
+                username TEXT,
+                timestamp TEXT NOT NULL,
+                file_type TEXT,
+                request_type TEXT NOT NULL,
+                request_count INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                user_name TEXT,
+                username TEXT,
+                first_seen TEXT NOT NULL,
+                last_seen TEXT NOT NULL,
+                request_count INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+            """
+        )
+        self.conn.commit()
+        
+        self.import_legacy_file(legacy_path or USERS_LEGACY_PATH)
+        
+        # Build the per-user counter index once at startup
+        for user_id, request_count in self.conn.execute("SELECT user_id, request_count FROM users"):
+            self.counts[user_id] = request_count
+    
+    def import_legacy_file(self, legacy_path):
+        """Import users.txt into the database once, recomputing request counters."""
+        imported = self.conn.execute(
+            "SELECT value FROM meta WHERE key = 'users_txt_imported'"
+        ).fetchone()
+        if imported or not os.path.exists(legacy_path):
+            return
+        
+        counts = {}
+        rows = []
+        with open(legacy_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                # Format: user_id|user_name|username|timestamp|file_type|request_type|total_requests
+                parts = line.rstrip('\n').split('|')
+                if len(parts) < 5 or not parts[0].isdigit():
+                    continue
+                user_id = int(parts[0])
+                counts[user_id] = counts.get(user_id, 0) + 1
+                request_type = "first" if counts[user_id] == 1 else "repeat"
+                rows.append((user_id, parts[1], parts[2], parts[3], parts[4], request_type, counts[user_id]))
+        
+        self._write_batch(rows)
+        self.conn.execute(
+            "INSERT INTO meta (key, value) VALUES ('users_txt_imported', ?)",
+            (datetime.now().strftime("%Y-%m-%d %H:%M:%S"),)
+        )
+        self.conn.commit()
+        logger.info(f"Imported {len(rows)} interactions from {legacy_path}")
+    
+    def log_interaction(self, user_id, user_name, username=None, file_type=None):
+        """Record a user interaction; the row is written on the next flush."""
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        
+        request_count = self.counts.get(user_id, 0) + 1
+        self.counts[user_id] = request_count
+        request_type = "first" if request_count == 1 else "repeat"
+        
+        self.pending.append(
+            (user_id, user_name, username or 'N/A', timestamp, file_type or 'N/A', request_type, request_count)
+        )
+        
+        # Flush early when a large batch has accumulated
+        if len(self.pending) >= USERS_FLUSH_BATCH and (self._flush_task is None or self._flush_task.done()):
+            try:
+                self._flush_task = asyncio.get_running_loop().create_task(self.flush())
+            except RuntimeError:
+                self._write_batch(self._take_pending())
+        
+        return request_count
+    
+    def _take_pending(self):
+        batch, self.pending = self.pending, []
+        return batch
+    
+    def _write_batch(self, rows):
+        if not rows:
+            return
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO interactions (user_id, user_name, username, timestamp, file_type, request_type, request_count) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            self.conn.executemany(
+                "INSERT INTO users (user_id, user_name, username, first_seen, last_seen, request_count) "
+                "VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET user_name = excluded.user_name, "
+                "username = excluded.username, last_seen = excluded.last_seen, "
+                "request_count = excluded.request_count",
+                [(row[0], row[1], row[2], row[3], row[3], row[6]) for row in rows]
+            )
+    
+    async def flush(self):
+        """Write pending interactions to the database in a worker thread."""
+        async with self._flush_lock:
+            batch = self._take_pending()
+            if batch:
+                await asyncio.to_thread(self._write_batch, batch)
+    
+    async def run_periodic_flush(self):
+        """Flush pending interactions every USERS_FLUSH_INTERVAL seconds."""
+        while True:
+            await asyncio.sleep(USERS_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing user interactions: {e}")
+    
+    async def close(self):
+        """Flush everything that is left and close the database."""
+        await self.flush()
+        self.conn.close()
+
+
+# Files up to this size are kept in memory; larger ones are spooled to disk
+DOWNLOAD_SPILL_THRESHOLD = int(os.getenv("DOWNLOAD_SPILL_THRESHOLD", str(10 * 1024 * 1024)))
+
+
+async def download_to_memory(telegram_file):
+    """Download a Telegram file into a BytesIO, or a named temp file above the threshold.
+    
+    The temp file is deleted when it is closed; the worker processes open it by its path, so it
+    cannot be unlinked earlier, and a killed bot process leaves it behind in the temp directory.
+    """
+    if telegram_file.file_size and telegram_file.file_size > DOWNLOAD_SPILL_THRESHOLD:
+        buffer = tempfile.NamedTemporaryFile(prefix='tgbot_')
+    else:
+        buffer = io.BytesIO()
+    await telegram_file.download_to_memory(buffer)
+    buffer.seek(0)
+    return buffer
+
+
+# Limits for document parsing in the worker process pool
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", "0")) or os.cpu_count() or 1
+EXTRACT_TIMEOUT = float(os.getenv("EXTRACT_TIMEOUT", "60"))
+EXTRACT_MAX_FILE_SIZE = int(os.getenv("EXTRACT_MAX_FILE_SIZE", str(20 * 1024 * 1024)))
+EXTRACT_MAX_PAGES = int(os.getenv("EXTRACT_MAX_PAGES", "50"))
+
+# Extracted text beyond this many characters would not fit into the prompt anyway
+EXTRACT_MAX_CHARS = int(os.getenv("EXTRACT_MAX_CHARS", "60000"))
+
+# Pages per worker job when a PDF is split across the pool (0 disables page parallelism)
+PDF_PARALLEL_PAGES = int(os.getenv("PDF_PARALLEL_PAGES", "0"))
+
+# Spreadsheets: non-empty rows (over all sheets) and columns (per sheet) passed on to the prompt
+SPREADSHEET_MAX_ROWS = int(os.getenv("SPREADSHEET_MAX_ROWS", "2000"))
+SPREADSHEET_MAX_COLS = int(os.getenv("SPREADSHEET_MAX_COLS", "30"))
+
+
+# Errors for log.txt are queued here and written by a listener thread
+error_file_logger = logging.getLogger('error_file')
+error_file_logger.propagate = False
+error_log_listener = None
+
+
+def start_error_log():
+    """Open ERROR_LOG_PATH once and start the thread that writes queued errors to it."""
+    global error_log_listener
+    if error_log_listener is not None:
+        return
+    log_queue = queue.SimpleQueue()
+    file_handler = logging.FileHandler(ERROR_LOG_PATH, encoding='utf-8')
+    file_handler.setFormatter(logging.Formatter('%(message)s'))
+    error_log_listener = QueueListener(log_queue, file_handler)
+    error_file_logger.handlers = [QueueHandler(log_queue)]
+    error_log_listener.start()
+
+
+def stop_error_log():
+    """Write out the queued errors and close log.txt."""
+    global error_log_listener
+    if error_log_listener is None:
+        return
+    error_log_listener.stop()
+    for handler in error_log_listener.handlers:
+        handler.close()
+    error_file_logger.handlers = []
+    error_log_listener = None
+
+
+# Worker processes log errors too and exit without post_shutdown
+atexit.register(stop_error_log)
+
+
+def log_error(message):
+    """Log an error to the logger and queue it for log.txt without blocking on file I/O."""
+    error_msg = f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - {message}"
+    logger.error(error_msg)
+    start_error_log()
+    error_file_logger.error(error_msg)
+
+
+def iter_pdf_pages(reader, start=0, stop=None):
+    """Yield the text of PDF pages start..stop one at a time."""
+    for page in reader.pages[start:stop]:
+        yield page.extract_text() or ""
+
+
+def join_within_budget(chunks, max_chars):
+    """Join text chunks with newlines, consuming no more chunks than max_chars needs."""
+    parts = []
+    total = 0
+    for chunk in chunks:
+        if total + len(chunk) >= max_chars:
+            parts.append(chunk[:max_chars - total])
+            break
+        parts.append(chunk)
+        total += len(chunk) + 1
+    return "\n".join(parts)
+
+
+# Text extractors, looked up by magic bytes, MIME type or file extension.
+# Every backend imports its parser on first use, so startup does not pay for all of them.
+Extractor = namedtuple('Extractor', 'name function extensions mime_types signatures container_entries')
+EXTRACTORS = []
+
+ZIP_SIGNATURE = b'PK\x03\x04'
+OLE_SIGNATURE = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+OLE_DIRECTORY_ENTRY_SIZE = 128
+# Sector ids above this one mark the end of a chain or unused entries
+OLE_MAX_SECTOR = 0xFFFFFFFA
+
+# Legacy .doc files are converted with antiword when it is installed
+DOC_CONVERTER_CMD = os.getenv("DOC_CONVERTER_CMD", "antiword")
+
+
+def register_extractor(name, extensions=(), mime_types=(), signatures=(), container_entries=()):
+    """Decorator adding a function(source, filename) -> text to the extractor registry.
+    
+    container_entries tell formats sharing a ZIP or OLE2 signature apart.
+    """
+    def decorator(function):
+        EXTRACTORS.append(Extractor(
+            name, function, tuple(extensions), tuple(mime_types), tuple(signatures), tuple(container_entries)
+        ))
+        return function
+    return decorator
+
+
+def has_container_entry(source, head, entries):
+    """Whether a ZIP (OOXML) or OLE2 (legacy Office) container holds one of the entries."""
+    source.seek(0)
+    if head.startswith(ZIP_SIGNATURE):
+        try:
+            with zipfile.ZipFile(source) as archive:
+                names = set(archive.namelist())
+        except zipfile.BadZipFile:
+            return False
+        return any(entry in names for entry in entries)
+    try:
+        names = ole_root_entries(source.read())
+    except (struct.error, IndexError):
+        return False
+    return any(entry in names for entry in entries)
+
+
+def ole_root_entries(data):
+    """Names of the streams and storages at the top level of an OLE2 compound file.
+    
+    Only the root storage counts: a Word file with an embedded Excel table keeps
+    its Workbook stream in a nested storage.
+    """
+    sector_size = 1 << struct.unpack_from('<H', data, 30)[0]
+    per_sector = sector_size // 4
+    
+    def sector(number):
+        # Sector 0 starts right after the header, which takes one sector
+        return data[(number + 1) * sector_size:(number + 2) * sector_size]
+    
+    # The FAT sectors are listed in the header, continued in a chain of DIFAT sectors
+    fat_sectors = list(struct.unpack_from('<109I', data, 76))
+    next_difat, difat_count = struct.unpack_from('<II', data, 68)
+    for _ in range(difat_count):
+        if next_difat > OLE_MAX_SECTOR:
+            break
+        ids = struct.unpack_from(f'<{per_sector}I', sector(next_difat))
+        fat_sectors.extend(ids[:-1])
+        next_difat = ids[-1]
+    fat_count, directory_start = struct.unpack_from('<II', data, 44)
+    fat = []
+    for number in fat_sectors[:fat_count]:
+        fat.extend(struct.unpack_from(f'<{per_sector}I', sector(number)))
+    
+    directory = bytearray()
+    number, seen = directory_start, set()
+    while number <= OLE_MAX_SECTOR and number not in seen:
+        seen.add(number)
+        directory += sector(number)
+        number = fat[number]
+    
+    # Entries of a storage form a tree of siblings under its child entry
+    names, visited = set(), set()
+    pending = [struct.unpack_from('<I', directory, 76)[0]]
+    while pending:
+        index = pending.pop()
+        offset = index * OLE_DIRECTORY_ENTRY_SIZE
+        if index > OLE_MAX_SECTOR or index in visited or offset + OLE_DIRECTORY_ENTRY_SIZE > len(directory):
+            continue
+        visited.add(index)
+        name_size, _, left, right = struct.unpack_from('<HBxII', directory, offset + 64)
+        names.add(directory[offset:offset + max(name_size - 2, 0)].decode('utf-16-le', 'replace'))
+        pending += [left, right]
+    return names
+
+
+def find_extractor(source, filename, mime_type=None):
+    """Pick the extractor for a file: magic bytes first, then the MIME type, then the extension."""
+    _, ext = os.path.splitext((filename or '').lower())
+    source.seek(0)
+    head = source.read(8)
+    
+    sniffed = [extractor for extractor in EXTRACTORS if any(head.startswith(sig) for sig in extractor.signatures)]
+    if len(sniffed) == 1:
+        return sniffed[0]
+    if sniffed:
+        for extractor in sniffed:
+            if extractor.container_entries and has_container_entry(source, head, extractor.container_entries):
+                return extractor
+        for extractor in sniffed:
+            if mime_type in extractor.mime_types or ext in extractor.extensions:
+                return extractor
+        return None
+    
+    for extractor in EXTRACTORS:
+        if mime_type and mime_type in extractor.mime_types:
+            return extractor
+    for extractor in EXTRACTORS:
+        if ext in extractor.extensions:
+            return extractor
+    return None
+
+
+@register_extractor('text', extensions=('.txt',), mime_types=('text/plain',))
+def extract_txt(source, filename):
+    data = source.read()
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        # Older lab systems export plain text in the Windows Cyrillic code page
+        return data.decode('cp1251')
+
+
+def iter_docx_blocks(document):
+    """Paragraphs and table rows of a DOCX body in document order; cells are joined by tabs."""
+    for block in document.iter_inner_content():
+        if not hasattr(block, 'rows'):
+            yield block.text
+            continue
+        for row in block.rows:
+            cells = []
+            previous = None
+            for cell in row.cells:
+                # Merged cells are returned once per grid column they span
+                if cell._tc is previous:
+                    continue
+                previous = cell._tc
+                cells.append(cell.text.strip())
+            if any(cells):
+                yield '\t'.join(cells)
+
+
+@register_extractor(
+    'docx',
+    extensions=('.docx',),
+    mime_types=('application/vnd.openxmlformats-officedocument.wordprocessingml.document',),
+    signatures=(ZIP_SIGNATURE,),
+    container_entries=('word/document.xml',),
+)
+def extract_docx(source, filename):
+    from docx import Document
+    return '\n'.join(iter_docx_blocks(Document(source)))
+
+
+@register_extractor('pdf', extensions=('.pdf',), mime_types=('application/pdf',), signatures=(b'%PDF',))
+def extract_pdf(source, filename):
+    from PyPDF2 import PdfReader
+    try:
+        reader = PdfReader(source)
+        return join_within_budget(iter_pdf_pages(reader, 0, EXTRACT_MAX_PAGES), EXTRACT_MAX_CHARS)
+    except Exception as pdf_error:
+        # Log PDF-specific error to both logger and log.txt file
+        log_error(f"Error processing PDF {filename}: {pdf_error}")
+        return None
+
+
+def format_spreadsheet_cell(value):
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value).strip()
+
+
+def iter_sheet_lines(sheets):
+    """Tab-separated lines of spreadsheet sheets with empty rows and columns dropped.
+    
+    sheets yields (title, rows) with lazily read rows of cell values. At most
+    SPREADSHEET_MAX_ROWS rows in total and SPREADSHEET_MAX_COLS columns per sheet
+    are kept, and reading stops once EXTRACT_MAX_CHARS of text is collected.
+    """
+    rows_left = SPREADSHEET_MAX_ROWS
+    chars = 0
+    for title, rows in sheets:
+        if rows_left <= 0 or chars >= EXTRACT_MAX_CHARS:
+            return
+        # Only one sheet's capped rows are buffered, to find its empty columns
+        kept = []
+        used_columns = set()
+        for row in rows:
+            cells = [format_spreadsheet_cell(value) for value in row]
+            filled = [index for index, cell in enumerate(cells) if cell]
+            if not filled:
+                continue
+            kept.append(cells)
+            used_columns.update(filled)
+            chars += sum(len(cells[index]) + 1 for index in filled)
+            if len(kept) >= rows_left or chars >= EXTRACT_MAX_CHARS:
+                break
+        if not kept:
+            continue
+        rows_left -= len(kept)
+        
+        columns = sorted(used_columns)[:SPREADSHEET_MAX_COLS]
+        yield f"=== Лист: {title} ==="
+        for cells in kept:
+            values = [cells[index] if index < len(cells) else '' for index in columns]
+            if any(values):
+                yield '\t'.join(values)
+
+
+@register_extractor(
+    'xlsx',
+    extensions=('.xlsx',),
+    mime_types=('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',),
+    signatures=(ZIP_SIGNATURE,),
+    container_entries=('xl/workbook.xml',),
+)
+def extract_xlsx(source, filename):
+    import openpyxl
+    # Read-only mode streams rows from the XML instead of loading the whole workbook
+    workbook = openpyxl.load_workbook(source, read_only=True, data_only=True)
+    try:
+        def sheets():
+            for sheet in workbook.worksheets:
+                # Exporters often write wrong dimensions, which would cut rows off
+                sheet.reset_dimensions()
+                yield sheet.title, sheet.iter_rows(values_only=True)
+        return join_within_budget(iter_sheet_lines(sheets()), EXTRACT_MAX_CHARS)
+    finally:
+        workbook.close()
+
+
+@register_extractor(
+    'xls',
+    extensions=('.xls',),
+    mime_types=('application/vnd.ms-excel',),
+    signatures=(OLE_SIGNATURE,),
+    container_entries=('Workbook', 'Book'),
+)
+def extract_xls(source, filename):
+    import xlrd
+    workbook = xlrd.open_workbook(file_contents=source.read(), on_demand=True)
+    sheets = (
+        (sheet.name, (sheet.row_values(row) for row in range(sheet.nrows))) for sheet in workbook.sheets()
+    )
+    return join_within_budget(iter_sheet_lines(sheets), EXTRACT_MAX_CHARS)
+
+
+# Runs of at least eight Latin or Cyrillic UTF-16 characters
+UTF16_TEXT_RE = re.compile(rb'(?:[\t\r\x20-\x7e]\x00|[\x01-\x5f]\x04){8,}')
+
+
+@register_extractor(
+    'doc',
+    extensions=('.doc',),
+    mime_types=('application/msword',),
+    signatures=(OLE_SIGNATURE,),
+    container_entries=('WordDocument',),
+)
+def extract_doc(source, filename):
+    """Legacy Word: antiword when installed, otherwise the UTF-16 text runs of the file."""
+    data = source.read()
+    if shutil.which(DOC_CONVERTER_CMD):
+        with tempfile.NamedTemporaryFile(suffix='.doc') as copy:
+            copy.write(data)
+            copy.flush()
+            result = subprocess.run(
+                [DOC_CONVERTER_CMD, '-m', 'UTF-8.txt', copy.name],
+                capture_output=True,
+                timeout=EXTRACT_TIMEOUT,
+            )
+        if result.returncode == 0:
+            return result.stdout.decode('utf-8', 'replace').strip() or None
+        log_error(f"{DOC_CONVERTER_CMD} failed on {filename}: {result.stderr.decode('utf-8', 'replace').strip()}")
+    
+    # Word 97+ keeps non-Latin text in UTF-16, which is enough for Russian lab reports
+    runs = [match.decode('utf-16-le').strip() for match in UTF16_TEXT_RE.findall(data)]
+    return '\n'.join(run for run in runs if run) or None
+
+
+def extract_text_from_document(source, filename, mime_type=None):
+    """Extract text from various document formats.
+    
+    source is a binary stream (BytesIO or temporary file) positioned anywhere.
+    """
+    return extract_document(source, filename, mime_type)[1]
+
+
+def extract_document(source, filename, mime_type=None):
+    """(name of the extractor used or 'unknown', text or None) of a document stream."""
+    file_format = 'unknown'
+    try:
+        extractor = find_extractor(source, filename, mime_type)
+        if extractor is None:
+            return file_format, None
+        file_format = extractor.name
+        source.seek(0)
+        return file_format, extractor.function(source, filename)
+            
+    except Exception as e:
+        # Log general error to both logger and log.txt file
+        log_error(f"Error extracting text from {filename}: {e}")
+        return file_format, None
+
+
+# Local OCR settings (Tesseract is called as a subprocess)
+TESSERACT_CMD = os.getenv("TESSERACT_CMD", "tesseract")
+OCR_LANGUAGES = os.getenv("OCR_LANGUAGES", "rus+eng")
+OCR_TARGET_DPI = int(os.getenv("OCR_TARGET_DPI", "300"))
+OCR_TIMEOUT = float(os.getenv("OCR_TIMEOUT", "30"))
+OCR_MAX_SKEW = float(os.getenv("OCR_MAX_SKEW", "5"))
+# Smallest Telegram photo size downloaded for OCR (long side in pixels)
+OCR_MIN_PHOTO_SIDE = int(os.getenv("OCR_MIN_PHOTO_SIDE", "1280"))
+OCR_BINARIZE = os.getenv("OCR_BINARIZE", "1") == "1"
+# A photo of one user re-sent within this many seconds, even recompressed, is recognised once (0 = off)
+PHOTO_DEDUP_WINDOW = float(os.getenv("PHOTO_DEDUP_WINDOW", "600"))
+PHOTO_DEDUP_DISTANCE = int(os.getenv("PHOTO_DEDUP_DISTANCE", "12"))
+PHOTO_DEDUP_MAX_ENTRIES = 1024
+PHOTO_HASH_SIZE = 16
+# A hash match is only a candidate, because pages of one lab form differ in just a
+# few hash bits: no thumbnail pixel may differ by more than the tolerance either.
+# Recompression stays within it and a changed digit does not. Another shot of the
+# same sheet (shifted, tilted, rescaled) differs from the first one by as much as
+# a changed digit does, so it is recognised again and only its text is deduplicated
+PHOTO_THUMBNAIL_SIZE = 192
+PHOTO_THUMBNAIL_TOLERANCE = 12
+
+# Long side of an A4 page in inches, used to estimate the DPI of phone photos
+A4_LONG_SIDE_INCHES = 11.69
+
+
+def estimate_skew(image):
+    """Estimate the text skew angle in degrees with a projection profile on a thumbnail."""
+    from PIL import Image
+    thumbnail = image.copy()
+    thumbnail.thumbnail((800, 800))
+    # Dark pixels (text) become 1, background 0
+    binary = thumbnail.point(lambda value: 255 if value < 128 else 0)
+    
+    best_angle = 0.0
+    best_score = -1.0
+    steps = int(OCR_MAX_SKEW * 2)
+    for step in range(-steps, steps + 1):
+        angle = step / 2
+        rotated = binary.rotate(angle, resample=Image.NEAREST, fillcolor=0)
+        width, height = rotated.size
+        data = rotated.tobytes()
+        # Text lines aligned with the rows give the most uneven row sums
+        rows = [sum(data[row * width:(row + 1) * width]) for row in range(height)]
+        mean = sum(rows) / height
+        score = sum((row - mean) ** 2 for row in rows)
+        if score > best_score:
+            best_angle, best_score = angle, score
+    return best_angle
+
+
+def select_photo_size(sizes, min_side=None):
+    """Smallest Telegram PhotoSize whose long side reaches min_side, otherwise the largest one."""
+    min_side = OCR_MIN_PHOTO_SIDE if min_side is None else min_side
+    ordered = sorted(sizes, key=lambda size: size.width * size.height)
+    for size in ordered:
+        if max(size.width, size.height) >= min_side:
+            return size
+    return ordered[-1]
+
+
+def open_image(source, max_long_side):
+    """Open an image, letting the JPEG decoder scale it down and decode grayscale directly."""
+    from PIL import Image
+    image = Image.open(source)
+    scale = min(1.0, max_long_side / max(image.size))
+    # Decoding happens on first access; draft picks the smallest 1/2, 1/4 or 1/8 scale that is large enough
+    image.draft('L', (math.ceil(image.width * scale), math.ceil(image.height * scale)))
+    return image
+
+
+def crop_to_content(image, margin=20):
+    """Cut away the empty border around the text of a grayscale page."""
+    ink = image.point(lambda value: 255 if value < 128 else 0)
+    box = ink.getbbox()
+    if not box:
+        return image
+    left, top, right, bottom = box
+    return image.crop((
+        max(0, left - margin), max(0, top - margin),
+        min(image.width, right + margin), min(image.height, bottom + margin),
+    ))
+
+
+def otsu_threshold(image):
+    """Gray level that best separates text from background (Otsu's method)."""
+    histogram = image.histogram()[:256]
+    total = sum(histogram)
+    weighted_total = sum(level * count for level, count in enumerate(histogram))
+    background = background_sum = 0
+    best_level, best_variance = 127, -1.0
+    for level, count in enumerate(histogram):
+        background += count
+        if not background or background == total:
+            continue
+        background_sum += level * count
+        background_mean = background_sum / background
+        foreground_mean = (weighted_total - background_sum) / (total - background)
+        variance = background * (total - background) * (background_mean - foreground_mean) ** 2
+        if variance > best_variance:
+            best_level, best_variance = level, variance
+    return best_level
+
+
+def binarize(image):
+    """Black text on white as a 1-bit image, which is also much cheaper to hand to Tesseract."""
+    threshold = otsu_threshold(image)
+    return image.point(lambda value: 255 if value > threshold else 0, mode='1')
+
+
+def photo_fingerprint(source):
+    """(difference hash, grayscale thumbnail) of an image.
+    
+    Similar photos differ in few hash bits; a re-sent or recompressed copy of the
+    same photo also has a nearly equal thumbnail (see same_photo).
+    """
+    from PIL import Image, ImageOps
+    image = open_image(source, 4 * PHOTO_THUMBNAIL_SIZE)
+    image = ImageOps.autocontrast(ImageOps.exif_transpose(image).convert('L'))
+    small = image.resize((PHOTO_HASH_SIZE + 1, PHOTO_HASH_SIZE), Image.BOX)
+    pixels = small.tobytes()
+    value = 0
+    for row in range(PHOTO_HASH_SIZE):
+        offset = row * (PHOTO_HASH_SIZE + 1)
+        for column in range(PHOTO_HASH_SIZE):
+            value = (value << 1) | (pixels[offset + column] > pixels[offset + column + 1])
+    return value, image.resize((PHOTO_THUMBNAIL_SIZE, PHOTO_THUMBNAIL_SIZE), Image.BOX)
+
+
+def same_photo(thumbnail, other):
+    """Whether two photo thumbnails differ by no more than recompression noise.
+    
+    This matches copies of one photo only, never two shots of the same sheet.
+    """
+    from PIL import ImageChops
+    return ImageChops.difference(thumbnail, other).getextrema()[1] <= PHOTO_THUMBNAIL_TOLERANCE
+
+
+def photo_fingerprint_job(data):
+    """Fingerprint of raw image bytes, or None when they cannot be decoded."""
+    try:
+        return photo_fingerprint(io.BytesIO(data))
+    except Exception as e:
+        logger.warning(f"Cannot fingerprint image: {e}")
+        return None
+
+
+def preprocess_for_ocr(image):
+    """Downscale to OCR_TARGET_DPI, convert to grayscale, straighten the page, crop and threshold it."""
+    from PIL import Image, ImageOps
+    image = ImageOps.exif_transpose(image)
+    
+    # Phone photos rarely carry a real DPI: assume the long side is an A4 page
+    long_side = max(image.size)
+    max_long_side = int(OCR_TARGET_DPI * A4_LONG_SIDE_INCHES)
+    if long_side > max_long_side:
+        scale = max_long_side / long_side
+        image = image.resize((int(image.width * scale), int(image.height * scale)), Image.LANCZOS)
+    
+    image = ImageOps.autocontrast(image.convert('L'))
+    
+    angle = estimate_skew(image)
+    if angle:
+        image = image.rotate(angle, resample=Image.BICUBIC, expand=True, fillcolor=255)
+    
+    image = crop_to_content(image)
+    return binarize(image) if OCR_BINARIZE else image
+
+
+def ocr_image(source):
+    """Recognise text on an image stream with Tesseract; returns None when nothing is found."""
+    image = preprocess_for_ocr(open_image(source, int(OCR_TARGET_DPI * A4_LONG_SIDE_INCHES)))
+    png = io.BytesIO()
+    image.save(png, format='PNG')
+    
+    try:
+        result = subprocess.run(
+            [TESSERACT_CMD, 'stdin', 'stdout', '-l', OCR_LANGUAGES, '--dpi', str(OCR_TARGET_DPI)],
+            input=png.getvalue(),
+            capture_output=True,
+            timeout=OCR_TIMEOUT,
+            # Parallelism comes from the worker pool, not from Tesseract threads
+            env={**os.environ, 'OMP_THREAD_LIMIT': '1'},
+        )
+    except FileNotFoundError:
+        log_error(f"OCR engine not found: {TESSERACT_CMD}")
+        return None
+    except subprocess.TimeoutExpired:
+        log_error(f"OCR did not finish within {OCR_TIMEOUT} seconds")
+        return None
+    
+    if result.returncode != 0:
+        log_error(f"OCR failed: {result.stderr.decode('utf-8', 'replace').strip()}")
+        return None
+    
+    text = result.stdout.decode('utf-8', 'replace').strip()
+    return text or None
+
+
+@register_extractor(
+    'image',
+    extensions=('.jpg', '.jpeg', '.png', '.bmp', '.tiff'),
+    mime_types=('image/jpeg', 'image/png', 'image/bmp', 'image/tiff'),
+    signatures=(b'\xff\xd8\xff', b'\x89PNG\r\n\x1a\n', b'II*\x00', b'MM\x00*'),
+)
+def extract_image(source, filename):
+    return ocr_image(source)
+
+
+def ocr_image_job(data):
+    """Process pool entry point for OCR of raw image bytes."""
+    try:
+        return ocr_image(io.BytesIO(data))
+    except Exception as e:
+        log_error(f"Error recognising image: {e}")
+        return None
+
+
+def extract_text_job(payload, filename, mime_type=None):
+    """Process pool entry point returning (format, text); payload is the file bytes or a path to a spooled file."""
+    if isinstance(payload, str):
+        with open(payload, 'rb') as source:
+            return extract_document(source, filename, mime_type)
+    return extract_document(io.BytesIO(payload), filename, mime_type)
+
+
+def extract_pdf_pages_job(payload, filename, start, stop):
+    """Process pool entry point: text of PDF pages start..stop and the total page count."""
+    from PyPDF2 import PdfReader
+    try:
+        source = open(payload, 'rb') if isinstance(payload, str) else io.BytesIO(payload)
+        with source:
+            reader = PdfReader(source)
+            text = join_within_budget(iter_pdf_pages(reader, start, stop), EXTRACT_MAX_CHARS)
+            return text, len(reader.pages)
+    except Exception as pdf_error:
+        log_error(f"Error processing PDF {filename}: {pdf_error}")
+        return None, 0
+
+
+# Analysis result cache settings
+RESULT_CACHE_PATH = os.getenv("RESULT_CACHE_PATH", "cache.db")
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", str(7 * 24 * 3600)))
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "512"))
+RESULT_CACHE_DISK_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_DISK_MAX_ENTRIES", "10000"))
+
+
+def file_cache_key(source):
+    """Cache key for the raw bytes of a downloaded file (bytes-like or binary stream)."""
+    digest = hashlib.sha256()
+    if isinstance(source, io.BytesIO):
+        digest.update(source.getbuffer())
+    elif hasattr(source, 'read'):
+        source.seek(0)
+        for chunk in iter(lambda: source.read(1024 * 1024), b''):
+            digest.update(chunk)
+        source.seek(0)
+    else:
+        digest.update(source)
+    return "file:" + digest.hexdigest()
+
+
+def batch_cache_key(file_keys):
+    """Cache key for several files analysed together, in upload order."""
+    return "batch:" + hashlib.sha256("\n".join(file_keys).encode('utf-8')).hexdigest()
+
+
+def summary_cache_key(upload_key):
+    """Cache key for the follow-up context of the report behind an upload key."""
+    return "summary:" + upload_key
+
+
+def text_cache_key(text):
+    """Cache key for extracted text, insensitive to case and whitespace."""
+    normalized = " ".join(text.lower().split())
+    return "text:" + hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """Two-tier cache of formatted analyses: in-memory LRU with TTL over SQLite."""
+
+    def __init__(self, db_path=None, ttl=None, max_entries=None, disk_max_entries=None):
+        self.db_path = db_path or RESULT_CACHE_PATH
+        self.ttl = RESULT_CACHE_TTL if ttl is None else ttl
+        self.max_entries = max_entries or RESULT_CACHE_MAX_ENTRIES
+        self.disk_max_entries = disk_max_entries or RESULT_CACHE_DISK_MAX_ENTRIES
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = asyncio.Lock()
+        
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        # Drop entries that expired while the bot was not running
+        self.conn.execute("DELETE FROM results WHERE created < ?", (time.time() - self.ttl,))
+        self.conn.commit()
+    
+    def stats(self):
+        """Hit and miss counters of the cache."""
+        return {"hits": self.hits, "misses": self.misses, "memory_entries": len(self.memory)}
+    
+    def _remember(self, key, value, created):
+        self.memory[key] = (value, created)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+    
+    def _disk_get(self, key):
+        return self.conn.execute("SELECT value, created FROM results WHERE key = ?", (key,)).fetchone()
+    
+    def _disk_put(self, keys, value, created):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO results (key, value, created) VALUES (?, ?, ?)",
+                [(key, value, created) for key in keys]
+            )
+            # Keep only the newest entries on disk
+            self.conn.execute(
+                "DELETE FROM results WHERE key NOT IN "
+                "(SELECT key FROM results ORDER BY created DESC LIMIT ?)",
+                (self.disk_max_entries,)
+            )
+    
+    async def get(self, key):
+        """Return the cached analysis for key, or None."""
+        now = time.time()
+        entry = self.memory.get(key)
+        if entry is None:
+            async with self._lock:
+                entry = await asyncio.to_thread(self._disk_get, key)
+        
+        if entry is not None and now - entry[1] <= self.ttl:
+            self._remember(key, entry[0], entry[1])
+            self.hits += 1
+            return entry[0]
+        
+        self.memory.pop(key, None)
+        self.misses += 1
+        return None
+    
+    async def put(self, keys, value):
+        """Store value under every key in keys."""
+        created = time.time()
+        for key in keys:
+            self._remember(key, value, created)
+        async with self._lock:
+            await asyncio.to_thread(self._disk_put, list(keys), value, created)
+    
+    def close(self):
+        self.conn.close()
+
+
+# Response formatting: GigaChat Markdown is converted to Telegram HTML in one pass over the lines
+HEADING_ICONS = {2: '🔬', 3: '💊', 4: '🧪'}
+HEADING_RE = re.compile(r'(#{2,4})\s+(.*)')
+# Bounded, non-overlapping quantifiers keep matching linear even on long lines
+TEST_NAME_RE = re.compile(r'(\s{0,8}(?:[-•]\s{1,4})?)([A-ZА-ЯЁ][\w ()\-]{0,80}?)(\s{0,4}:\s{0,4}[\w<>≥≤\[(][^\n]*)')
+BOLD_RE = re.compile(r'\*\*([^*\n]{1,500})\*\*')
+DISCLAIMER_RE = re.compile(
+    r'(?:самолечение\s{1,4}недопустимо'
+    r'|(?:пользователь\s{0,4}не\s{0,4}должен|не\s{0,4}следует)\s{0,4}заниматься\s{0,4}(?:самолечением|лечением\s{0,4}без\s{0,4}врача)'
+    r')[^.\n]*\.?',
+    re.IGNORECASE
+)
+
+
+def format_inline(text):
+    """Escape a piece of a line and turn its **bold** markup into tags."""
+    return BOLD_RE.sub(r'<b>\1</b>', html.escape(text, quote=False))
+
+
+def format_response_line(line):
+    """Format one line of a GigaChat answer as Telegram HTML."""
+    heading = HEADING_RE.fullmatch(line)
+    if heading:
+        title = html.escape(heading.group(2).replace('**', '').strip(), quote=False)
+        level = len(heading.group(1))
+        return f"{HEADING_ICONS[level]} <b>{title}</b>" if level == 2 else f"{HEADING_ICONS[level]} {title}"
+    
+    # The self-treatment disclaimer is shown in italics. It is found in the raw line
+    # and formatted as a piece of its own, so no other tag can cross its boundaries
+    disclaimer = DISCLAIMER_RE.search(line)
+    start, end = disclaimer.span() if disclaimer else (len(line), len(line))
+    if line[:start].endswith('**') and line.count('**', start, end) % 2:
+        # "**Самолечение недопустимо**.": the bold markup belongs to the disclaimer
+        start -= 2
+    
+    # Analysis names followed by a value are underlined
+    formatted = ''
+    test_name = TEST_NAME_RE.fullmatch(line)
+    if test_name and test_name.end(2) <= start:
+        indent, name = (html.escape(part, quote=False) for part in test_name.group(1, 2))
+        formatted = f"{indent}<u>{name}</u>"
+        before = line[test_name.end(2):start]
+    else:
+        before = line[:start]
+    
+    formatted += format_inline(before)
+    if disclaimer:
+        formatted += f"<i>{format_inline(line[start:end])}</i>"
+    return formatted + format_inline(line[end:])
+
+
+def format_gigachat_response(text):
+    """Format the GigaChat response with emojis and proper formatting (Telegram HTML)."""
+    return '\n'.join(format_response_line(line) for line in text.split('\n'))
+
+
+# Structured lab value extraction done locally before calling the LLM
+LAB_COMPACT_PROMPT = os.getenv("LAB_COMPACT_PROMPT", "1") == "1"
+LAB_SKIP_LLM_WHEN_NORMAL = os.getenv("LAB_SKIP_LLM_WHEN_NORMAL", "0") == "1"
+
+# kb_reference: the range comes from ANALYTES because the report gives none
+LabValue = namedtuple('LabValue', ['name', 'value', 'unit', 'low', 'high', 'status', 'kb_reference'], defaults=(False,))
+
+NUMBER = r'\d+(?:[.,]\d+)?'
+
+# "Глюкоза: 6.5 ммоль/л (норма: 3.3-5.5)" or "Глюкоза\t6.5\tммоль/л\t3.3-5.5";
+# the value must not be the start of a range, i.e. the line has no value at all
+LAB_LINE_RE = re.compile(
+    rf'^\s*(?P<name>[^\d\s:][^:\t]*?)\s*[:\t]\s*|^\s*(?P<plain_name>.*?(?:[A-Za-zА-Яа-яЁё)]|[A-Za-zА-Яа-яЁё]\d+))\s+(?=[<>≤≥]?\s*\d)'
+)
+# "Лимфоциты, % 52 19 - 37": the unit follows the name after a comma
+LAB_NAME_UNIT_RE = re.compile(
+    r'^\s*(?P<name>[^\d\s,:][^,:\t]*?)\s*,\s*(?P<unit>%|фл|пг|fl|pg|[^\s:\t]*[/^][^\s:\t]*)\s*[:\t]?\s*(?=[<>≤≥]?\s*\d)',
+    re.IGNORECASE
+)
+LAB_VALUE_RE = re.compile(rf'(?P<prefix>[<>≤≥])?\s*(?P<value>{NUMBER})(?!\d|[.,]\d|\s*[-–—]\s*\d)(?P<rest>.*)$')
+RANGE_BETWEEN_RE = re.compile(rf'(?P<low>{NUMBER})\s*[-–—]\s*(?P<high>{NUMBER})')
+RANGE_UPPER_RE = re.compile(rf'(?:<|≤|до|менее)\s*(?P<high>{NUMBER})', re.IGNORECASE)
+RANGE_LOWER_RE = re.compile(rf'(?:>|≥|от|более)\s*(?P<low>{NUMBER})', re.IGNORECASE)
+RANGE_LABEL_RE = re.compile(r'\(|\)|норма|референс\w*|реф\.|:', re.IGNORECASE)
+QUALITATIVE_LINE_RE = re.compile(r'^[^:\t]{2,60}[:\t]\s*[^\d\s][^\n]{0,40}$')
+PATIENT_FIELD_RE = re.compile(
+    r'^\s*(?:пол|возраст|дата|фио|пациент|врач|лаборатория|адрес|телефон|заказ|номер|№|материал|биоматериал|исследование)',
+    re.IGNORECASE
+)
+# Addresses, organisations and contacts in the report header
+REPORT_HEADER_RE = re.compile(
+    r'\b(?:ооо|оао|зао|инн|огрн|лицензия)\b|\b(?:г|ул|д|тел)\.|www\.|https?://', re.IGNORECASE
+)
+DATE_TIME_RE = re.compile(r'\d{1,2}[./]\d{1,2}[./]\d{2,4}|\d{1,2}:\d{2}')
+
+
+def parse_number(text):
+    return float(text.replace(',', '.'))
+
+
+def parse_reference_range(text):
+    """Return (low, high, matched span start) for the reference range in text, or None."""
+    for pattern in (RANGE_BETWEEN_RE, RANGE_UPPER_RE, RANGE_LOWER_RE):
+        match = pattern.search(text)
+        if match:
+            groups = match.groupdict()
+            low = parse_number(groups['low']) if groups.get('low') else None
+            high = parse_number(groups['high']) if groups.get('high') else None
+            return low, high, match.start()
+    return None
+
+
+def parse_lab_line(line):
+    """Parse one line of a lab report into a LabValue, or return None."""
+    head = LAB_NAME_UNIT_RE.match(line) or LAB_LINE_RE.match(line)
+    if not head:
+        return None
+    groups = head.groupdict()
+    name = (groups['name'] or groups.get('plain_name') or '').strip(' .-')
+    if len(name) < 2 or not any(char.isalpha() for char in name):
+        return None
+    
+    value_match = LAB_VALUE_RE.match(line, head.end())
+    if not value_match:
+        return None
+    value = parse_number(value_match.group('value'))
+    rest = value_match.group('rest')
+    
+    low = high = None
+    unit_part = rest
+    reference = parse_reference_range(rest)
+    if reference:
+        low, high, start = reference
+        unit_part = rest[:start]
+    unit = ' '.join(RANGE_LABEL_RE.sub(' ', unit_part).replace('\t', ' ').split())
+    # Words after the value that are not a unit, e.g. "ПОВЫШЕНО"
+    if len(unit) > 20:
+        unit = ''
+    unit = unit or groups.get('unit') or ''
+    
+    # A bare number with neither unit nor range is most likely an address or a date
+    if low is None and high is None and not unit:
+        return None
+    
+    return LabValue(name, value, unit, low, high, value_status(value, low, high))
+
+
+def value_status(value, low, high):
+    """'low', 'high' or 'normal' against the range, None without one."""
+    if low is None and high is None:
+        return None
+    if low is not None and value < low:
+        return 'low'
+    if high is not None and value > high:
+        return 'high'
+    return 'normal'
+
+
+def parse_lab_values(text):
+    """Extract the lab values that can be recognised in a report."""
+    values = []
+    for line in text.splitlines():
+        record = parse_lab_line(line)
+        if record:
+            values.append(record)
+    if LAB_REFERENCE_KB:
+        values = annotate_lab_values(values, text)
+    return values
+
+
+# Reference ranges of common analytes, used when the document gives none
+LAB_REFERENCE_KB = os.getenv("LAB_REFERENCE_KB", "1") == "1"
+LAB_LOCAL_SINGLE_ANALYTE = os.getenv("LAB_LOCAL_SINGLE_ANALYTE", "1") == "1"
+
+Analyte = namedtuple('Analyte', ['name', 'aliases', 'units', 'ranges', 'low_note', 'high_note'])
+
+# sex is 'M', 'F' or None for both; ages in years, max_age exclusive
+ReferenceRange = namedtuple('ReferenceRange', ['low', 'high', 'sex', 'min_age', 'max_age'], defaults=(None, 18, 200))
+
+
+def both_sexes(low, high):
+    return (ReferenceRange(low, high),)
+
+
+def by_sex(male, female):
+    """Sex-specific ranges; (None, None) marks a sex without a fixed range, e.g. cycle-dependent hormones."""
+    return (ReferenceRange(*male, 'M'), ReferenceRange(*female, 'F'))
+
+
+ANALYTES = (
+    Analyte("Глюкоза", ("глюкоза", "глюкоза натощак", "glucose", "glu"), ("ммоль/л",),
+            (ReferenceRange(4.1, 5.9, None, 18, 60), ReferenceRange(4.6, 6.4, None, 60, 200)),
+            "бывает при длительном голодании, избытке инсулина или сахароснижающих препаратов.",
+            "бывает при нарушении углеводного обмена (преддиабет, сахарный диабет), стрессе или если анализ сдан не натощак."),
+    Analyte("Гликированный гемоглобин", ("гликированный гемоглобин", "гемоглобин гликированный", "hba1c", "гликогемоглобин"), ("%",),
+            both_sexes(4.0, 6.0),
+            "встречается при анемиях и кровопотере.",
+            "отражает высокий уровень глюкозы за последние 2–3 месяца (преддиабет, сахарный диабет)."),
+    Analyte("Гемоглобин", ("гемоглобин", "hgb", "hb"), ("г/л",),
+            by_sex((130, 170), (120, 150)),
+            "характерно для анемии: дефицит железа, витамина B12 или фолиевой кислоты, кровопотеря.",
+            "бывает при обезвоживании, курении, пребывании в высокогорье, заболеваниях лёгких и крови."),
+    Analyte("Эритроциты", ("эритроциты", "rbc"), ("10^12/л",),
+            by_sex((4.3, 5.7), (3.8, 5.1)),
+            "встречается при анемиях и кровопотере.",
+            "бывает при обезвоживании, хронической нехватке кислорода, заболеваниях крови."),
+    Analyte("Гематокрит", ("гематокрит", "hct"), ("%",),
+            by_sex((39, 49), (35, 45)),
+            "встречается при анемиях и избытке жидкости.",
+            "бывает при обезвоживании и повышении числа эритроцитов."),
+    Analyte("Лейкоциты", ("лейкоциты", "wbc"), ("10^9/л",),
+            both_sexes(4.0, 9.0),
+            "бывает при вирусных инфекциях, приёме некоторых лекарств, заболеваниях костного мозга.",
+            "бывает при бактериальных инфекциях, воспалении, стрессе, физической нагрузке."),
+    Analyte("Тромбоциты", ("тромбоциты", "plt"), ("10^9/л",),
+            both_sexes(150, 400),
+            "повышает риск кровоточивости; бывает при вирусных инфекциях, заболеваниях печени и крови.",
+            "бывает после воспаления, кровопотери, при дефиците железа, заболеваниях крови."),
+    Analyte("СОЭ", ("соэ", "esr", "скорость оседания эритроцитов"), ("мм/ч",),
+            by_sex((2, 15), (2, 20)),
+            "обычно не имеет клинического значения.",
+            "бывает при воспалении, инфекциях, анемии, беременности."),
+    Analyte("АЛТ", ("алт", "alt", "аланинаминотрансфераза", "алат"), ("ед/л", "u/l", "me/л"),
+            by_sex((None, 41), (None, 33)),
+            "",
+            "бывает при поражении печени (гепатит, жировой гепатоз), приёме лекарств, после нагрузки."),
+    Analyte("АСТ", ("аст", "ast", "аспартатаминотрансфераза", "асат"), ("ед/л", "u/l", "me/л"),
+            by_sex((None, 40), (None, 32)),
+            "",
+            "бывает при поражении печени, сердечной и скелетных мышц."),
+    Analyte("ГГТ", ("ггт", "ggt", "гамма гт", "гамма глутамилтрансфераза", "гамма глутамилтранспептидаза"), ("ед/л", "u/l", "me/л"),
+            by_sex((None, 55), (None, 38)),
+            "",
+            "бывает при застое желчи, поражении печени, употреблении алкоголя."),
+    Analyte("Щелочная фосфатаза", ("щелочная фосфатаза", "щф", "alp"), ("ед/л", "u/l", "me/л"),
+            by_sex((40, 129), (35, 104)),
+            "встречается при дефиците цинка и магния, гипотиреозе.",
+            "бывает при застое желчи, заболеваниях костей."),
+    Analyte("Билирубин общий", ("билирубин общий", "общий билирубин", "tbil"), ("мкмоль/л",),
+            both_sexes(3.4, 20.5),
+            "обычно не имеет клинического значения.",
+            "бывает при заболеваниях печени, застое желчи, усиленном разрушении эритроцитов, синдроме Жильбера."),
+    Analyte("Общий белок", ("общий белок", "белок общий", "tp"), ("г/л",),
+            both_sexes(64, 83),
+            "бывает при недостаточном питании, заболеваниях печени и почек.",
+            "бывает при обезвоживании и хронических воспалительных заболеваниях."),
+    Analyte("Креатинин", ("креатинин", "crea", "creatinine"), ("мкмоль/л",),
+            by_sex((62, 106), (44, 80)),
+            "бывает при низкой мышечной массе и вегетарианском питании.",
+            "бывает при снижении функции почек, обезвоживании, большой мышечной массе."),
+    Analyte("Мочевина", ("мочевина", "urea"), ("ммоль/л",),
+            both_sexes(2.8, 7.2),
+            "бывает при низкобелковой диете и заболеваниях печени.",
+            "бывает при снижении функции почек, обезвоживании, избытке белка в питании."),
+    Analyte("Мочевая кислота", ("мочевая кислота", "uric acid", "ua"), ("мкмоль/л",),
+            by_sex((202, 416), (142, 339)),
+            "обычно не имеет клинического значения.",
+            "бывает при подагре, снижении функции почек, избытке пуринов в питании."),
+    Analyte("Холестерин общий", ("холестерин общий", "общий холестерин", "холестерин", "chol"), ("ммоль/л",),
+            both_sexes(None, 5.2),
+            "",
+            "связано с риском атеросклероза, питанием, наследственностью, гипотиреозом."),
+    Analyte("Холестерин ЛПНП", ("холестерин лпнп", "лпнп", "ldl", "ldl c"), ("ммоль/л",),
+            both_sexes(None, 3.0),
+            "",
+            "связано с риском атеросклероза и сердечно-сосудистых заболеваний."),
+    Analyte("Холестерин ЛПВП", ("холестерин лпвп", "лпвп", "hdl", "hdl c"), ("ммоль/л",),
+            by_sex((1.0, None), (1.2, None)),
+            "связано с риском атеросклероза; бывает при малоподвижном образе жизни и курении.",
+            ""),
+    Analyte("Триглицериды", ("триглицериды", "tg", "trig"), ("ммоль/л",),
+            both_sexes(None, 1.7),
+            "",
+            "бывает при избытке углеводов и жиров в питании, ожирении, сахарном диабете."),
+    Analyte("Калий", ("калий", "k"), ("ммоль/л",),
+            both_sexes(3.5, 5.1),
+            "бывает при рвоте, диарее, приёме мочегонных.",
+            "бывает при снижении функции почек, гемолизе пробы."),
+    Analyte("Натрий", ("натрий", "na"), ("ммоль/л",),
+            both_sexes(136, 145),
+            "бывает при избытке жидкости, приёме мочегонных.",
+            "бывает при обезвоживании."),
+    Analyte("Кальций общий", ("кальций общий", "общий кальций", "ca"), ("ммоль/л",),
+            both_sexes(2.15, 2.55),
+            "бывает при дефиците витамина D и нарушении функции паращитовидных желёз.",
+            "бывает при гиперпаратиреозе, избытке витамина D."),
+    Analyte("Железо", ("железо", "железо сывороточное", "сывороточное железо", "fe"), ("мкмоль/л",),
+            by_sex((11.6, 31.3), (9.0, 30.4)),
+            "бывает при дефиците железа, кровопотере, хроническом воспалении.",
+            "бывает при избыточном приёме препаратов железа, гемохроматозе."),
+    Analyte("Ферритин", ("ферритин", "ferritin"), ("мкг/л", "нг/мл"),
+            by_sex((30, 400), (13, 150)),
+            "отражает истощение запасов железа.",
+            "бывает при воспалении, заболеваниях печени, избытке железа."),
+    Analyte("Витамин B12", ("витамин b12", "цианокобаламин", "b12"), ("пг/мл",),
+            both_sexes(187, 883),
+            "бывает при недостатке в питании (вегетарианство), нарушении всасывания, приёме метформина.",
+            "обычно связано с приёмом добавок."),
+    Analyte("Фолиевая кислота", ("фолиевая кислота", "фолаты", "folate"), ("нг/мл",),
+            both_sexes(3.1, 20.5),
+            "бывает при недостатке в питании, нарушении всасывания, беременности.",
+            "обычно связано с приёмом добавок."),
+    Analyte("Витамин D", ("витамин d", "25 oh витамин d", "витамин d 25 oh", "25 он витамин d", "25 oh d"), ("нг/мл",),
+            both_sexes(30, 100),
+            "говорит о недостатке витамина D; бывает при малом пребывании на солнце.",
+            "обычно связано с избыточным приёмом добавок."),
+    Analyte("ТТГ", ("ттг", "tsh", "тиреотропный гормон"), ("мкме/мл", "мме/л", "мед/л"),
+            both_sexes(0.4, 4.0),
+            "бывает при повышенной функции щитовидной железы (гипертиреоз).",
+            "бывает при сниженной функции щитовидной железы (гипотиреоз)."),
+    Analyte("Т4 свободный", ("т4 свободный", "свободный т4", "ft4", "тироксин свободный"), ("пмоль/л",),
+            both_sexes(9.0, 19.0),
+            "бывает при гипотиреозе.",
+            "бывает при гипертиреозе."),
+    Analyte("Т3 свободный", ("т3 свободный", "свободный т3", "ft3", "трийодтиронин свободный"), ("пмоль/л",),
+            both_sexes(2.6, 5.7),
+            "бывает при гипотиреозе и тяжёлых общих заболеваниях.",
+            "бывает при гипертиреозе."),
+    Analyte("С-реактивный белок", ("с реактивный белок", "срб", "crp"), ("мг/л",),
+            both_sexes(None, 5.0),
+            "",
+            "бывает при воспалении и инфекциях."),
+    Analyte("ЛГ", ("лг", "lh", "лютеинизирующий гормон"), ("мме/мл", "мед/мл"),
+            by_sex((1.7, 8.6), (None, None)),
+            "бывает при нарушении функции гипофиза.",
+            "бывает при снижении функции яичек."),
+    Analyte("ФСГ", ("фсг", "fsh", "фолликулостимулирующий гормон"), ("мме/мл", "мед/мл"),
+            by_sex((1.5, 12.4), (None, None)),
+            "бывает при нарушении функции гипофиза.",
+            "бывает при снижении функции яичек."),
+    Analyte("Тестостерон общий", ("тестостерон общий", "общий тестостерон", "тестостерон", "testosterone"), ("нмоль/л",),
+            by_sex((8.64, 29.0), (0.29, 1.67)),
+            "бывает при гипогонадизме, ожирении, хроническом стрессе.",
+            "бывает при приёме препаратов, у женщин — при синдроме поликистозных яичников."),
+    Analyte("Пролактин", ("пролактин", "prl", "prolactin"), ("мме/л", "мкме/мл", "мед/л"),
+            by_sex((86, 324), (102, 496)),
+            "обычно не имеет клинического значения.",
+            "бывает при стрессе, приёме лекарств, гипотиреозе, опухолях гипофиза."),
+    Analyte("Кортизол", ("кортизол", "cortisol"), ("нмоль/л",),
+            both_sexes(138, 635),
+            "бывает при недостаточности надпочечников.",
+            "бывает при стрессе, приёме гормональных препаратов, синдроме Кушинга."),
+)
+
+# Latin and Cyrillic letters that look alike, e.g. "НGВ" typed or recognised with Cyrillic letters
+HOMOGLYPHS = str.maketrans('аеорсухкмтнвё', 'aeopcyxkmthbe')
+
+# Words that do not change which analyte is meant
+ANALYTE_FILLER_WORDS = {
+    word.translate(HOMOGLYPHS)
+    for word in ('в', 'крови', 'сыворотке', 'сыворотки', 'плазме', 'плазмы', 'венозной', 'капиллярной', 'натощак')
+}
+ANALYTE_NAME_RE = re.compile(r'[^\w%]+')
+PARENTHESES_RE = re.compile(r'\(([^)]*)\)')
+
+
+def normalize_analyte_name(name):
+    """Lower-case name with lookalike letters, punctuation and filler words folded away."""
+    words = ANALYTE_NAME_RE.sub(' ', name.lower().translate(HOMOGLYPHS).replace('_', ' ')).split()
+    return ' '.join(word for word in words if word not in ANALYTE_FILLER_WORDS)
+
+
+def normalize_unit(unit):
+    """Unit folded for comparison, so that "х10*9/л" and "10^9/л" are the same."""
+    return re.sub(r'[\s*×^.]', '', unit.lower()).translate(HOMOGLYPHS).lstrip('x')
+
+
+# Precomputed index: normalised alias -> analyte, and aliases grouped by length for fuzzy lookups
+ANALYTE_INDEX = {
+    normalize_analyte_name(alias): analyte for analyte in ANALYTES for alias in (analyte.name,) + analyte.aliases
+}
+ANALYTE_KEYS_BY_LENGTH = {}
+for key in ANALYTE_INDEX:
+    ANALYTE_KEYS_BY_LENGTH.setdefault(len(key), []).append(key)
+ANALYTE_UNITS = {analyte.name: {normalize_unit(unit) for unit in analyte.units} for analyte in ANALYTES}
+# Short aliases such as "k" or "лг" are only matched exactly
+FUZZY_MIN_LENGTH = 5
+
+
+def edit_distance(first, second, limit):
+    """Levenshtein distance of two strings, or limit + 1 once it is known to exceed limit."""
+    previous = list(range(len(second) + 1))
+    for row, first_char in enumerate(first, start=1):
+        current = [row]
+        for column, second_char in enumerate(second, start=1):
+            current.append(min(
+                previous[column] + 1,
+                current[column - 1] + 1,
+                previous[column - 1] + (first_char != second_char),
+            ))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+def fuzzy_analyte_key(key):
+    """Closest alias within one edit (two for long names) with the same digits, if it is unambiguous."""
+    if len(key) < FUZZY_MIN_LENGTH:
+        return None
+    limit = 1 if len(key) < 10 else 2
+    digits = re.sub(r'\D', '', key)
+    best, best_distance, ambiguous = None, limit + 1, False
+    for length in range(len(key) - limit, len(key) + limit + 1):
+        for candidate in ANALYTE_KEYS_BY_LENGTH.get(length, ()):
+            # "Т3 свободный" must never turn into "Т4 свободный"
+            if re.sub(r'\D', '', candidate) != digits:
+                continue
+            distance = edit_distance(key, candidate, limit)
+            if distance < best_distance:
+                best, best_distance, ambiguous = candidate, distance, False
+            elif best is not None and distance == best_distance and ANALYTE_INDEX[candidate] is not ANALYTE_INDEX[best]:
+                ambiguous = True
+    return None if ambiguous else best
+
+
+@functools.lru_cache(maxsize=4096)
+def find_analyte(name):
+    """Look up the analyte a report line names, tolerating OCR and typing errors."""
+    plain = PARENTHESES_RE.sub(' ', name)
+    candidates = [normalize_analyte_name(name), normalize_analyte_name(plain)]
+    candidates += [normalize_analyte_name(inner) for inner in PARENTHESES_RE.findall(name)]
+    candidates = [key for key in candidates if key]
+    for key in candidates:
+        if key in ANALYTE_INDEX:
+            return ANALYTE_INDEX[key]
+    for key in candidates:
+        match = fuzzy_analyte_key(key)
+        if match:
+            return ANALYTE_INDEX[match]
+    return None
+
+
+PATIENT_SEX_RE = re.compile(r'\bпол\s*[:\t]?\s*(муж|жен|м\b|ж\b)', re.IGNORECASE)
+PATIENT_AGE_RE = re.compile(r'\bвозраст\s*[:\t]?\s*(\d{1,3})', re.IGNORECASE)
+PATIENT_BIRTH_RE = re.compile(r'дата\s+рождения\s*[:\t]?\s*\d{1,2}[./]\d{1,2}[./](\d{4})', re.IGNORECASE)
+
+
+def parse_patient(text):
+    """Return (sex 'M'/'F' or None, age in years or None) stated in a report."""
+    sex = age = None
+    match = PATIENT_SEX_RE.search(text)
+    if match:
+        sex = 'M' if match.group(1).lower().startswith('м') else 'F'
+    match = PATIENT_AGE_RE.search(text)
+    if match:
+        age = int(match.group(1))
+    else:
+        match = PATIENT_BIRTH_RE.search(text)
+        if match:
+            age = datetime.now().year - int(match.group(1))
+    return sex, age
+
+
+def reference_for(analyte, sex=None, age=None):
+    """(low, high) for the patient; with unknown sex, the range covering both sexes; None if unknown."""
+    age = 30 if age is None else age
+    ranges = [
+        reference for reference in analyte.ranges
+        if reference.min_age <= age < reference.max_age and (sex is None or reference.sex in (None, sex))
+    ]
+    if not ranges:
+        return None
+    low = None if any(reference.low is None for reference in ranges) else min(reference.low for reference in ranges)
+    high = None if any(reference.high is None for reference in ranges) else max(reference.high for reference in ranges)
+    if low is None and high is None:
+        return None
+    return low, high
+
+
+def annotate_lab_values(values, text):
+    """Fill in reference ranges from ANALYTES for values the report gives without one."""
+    if not any(value.status is None for value in values):
+        return values
+    sex, age = parse_patient(text)
+    annotated = []
+    for value in values:
+        analyte = find_analyte(value.name) if value.status is None else None
+        reference = None
+        if analyte and normalize_unit(value.unit) in ANALYTE_UNITS[analyte.name]:
+            reference = reference_for(analyte, sex, age)
+        if reference:
+            low, high = reference
+            value = value._replace(low=low, high=high, status=value_status(value.value, low, high), kb_reference=True)
+        annotated.append(value)
+    return annotated
+
+
+def find_single_analyte(values, text):
+    """(value, analyte) of a report whose only result is one graded, known analyte, or None."""
+    # Any other value, graded or not, and results such as "ВИЧ: отрицательный" need the full analysis
+    if len(values) != 1 or not values[0].status or unchecked_result_lines(text):
+        return None
+    analyte = find_analyte(values[0].name)
+    if analyte is None:
+        return None
+    return values[0], analyte
+
+
+def format_single_analyte_report(value, analyte):
+    """Local answer for a report with a single known analyte."""
+    line = f"{value.name}: {format_number(value.value)} {value.unit}".rstrip() + f" (норма: {format_reference(value)})"
+    if value.status == 'normal':
+        lines = ["🔬 <b>Показатель в пределах референсных значений:</b>", "", "✅ " + html.escape(line, quote=False)]
+    else:
+        change, note = ("Снижение", analyte.low_note) if value.status == 'low' else ("Повышение", analyte.high_note)
+        lines = [f"🔬 <b>Показатель {STATUS_LABELS[value.status]}:</b>", "", "⚠️ " + html.escape(line, quote=False)]
+        if note:
+            lines += ["", html.escape(f"{change} {note}", quote=False)]
+        lines += ["", "Для выяснения причины обратитесь к врачу, при необходимости он назначит дополнительные исследования."]
+    if value.kb_reference:
+        lines += ["", "Референсный интервал справочный: нормы разных лабораторий немного отличаются."]
+    lines += ["", f"<i>{DISCLAIMER}</i>"]
+    return "\n".join(lines)
+
+
+def format_number(number):
+    return f"{number:g}".replace('.', ',')
+
+
+def format_reference(value):
+    if value.low is not None and value.high is not None:
+        reference = f"{format_number(value.low)}–{format_number(value.high)}"
+    elif value.high is not None:
+        reference = f"< {format_number(value.high)}"
+    elif value.low is not None:
+        reference = f"> {format_number(value.low)}"
+    else:
+        return "—"
+    return reference + (" справочно" if value.kb_reference else "")
+
+
+STATUS_LABELS = {'low': '↓ ниже нормы', 'high': '↑ выше нормы', 'normal': 'норма', None: 'нет референса'}
+
+
+def format_lab_table(values):
+    """Compact text table of lab values for the prompt."""
+    rows = ["Показатель | Результат | Ед. | Референс | Оценка"]
+    for value in values:
+        rows.append(
+            f"{value.name} | {format_number(value.value)} | {value.unit or '—'} | "
+            f"{format_reference(value)} | {STATUS_LABELS[value.status]}"
+        )
+    return "\n".join(rows)
+
+
+def other_result_lines(text):
+    """Lines the numeric parser does not cover.
+    
+    These are qualitative results such as "ВИЧ: отрицательный", patient details and
+    numeric results in a layout the parser does not know; addresses and dates are left out.
+    """
+    lines = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or parse_lab_line(line):
+            continue
+        if QUALITATIVE_LINE_RE.match(line):
+            lines.append(line)
+        elif (
+            not PATIENT_FIELD_RE.match(line) and not REPORT_HEADER_RE.search(line)
+            and any(char.isdigit() for char in DATE_TIME_RE.sub('', line))
+        ):
+            lines.append(line)
+    return lines
+
+
+def unchecked_result_lines(text):
+    """Result lines that were not compared with a reference range (patient details excluded)."""
+    return [line for line in other_result_lines(text) if not PATIENT_FIELD_RE.match(line)]
+
+
+DISCLAIMER = (
+    "Самолечение недопустимо: рекомендации сформированы искусственным интеллектом, "
+    "носят информационный, а не рекомендательный характер. "
+    "Обязательно проконсультируйтесь со специалистом."
+)
+
+
+ANSWER_RULES = (
+    "Но в конце обязательно добавь, что пользователь не должен заниматься самолечением, "
+    "рекомендации сформированы искусственным интеллектом и носят информационный, "
+    "а не рекомендательный характер, и ему следует консультироваться со специалистами."
+)
+
+
+def build_analysis_prompt(text_content, values):
+    """Build the GigaChat prompt, as a compact table when lab values were recognised."""
+    if values and LAB_COMPACT_PROMPT:
+        table = format_lab_table(values)
+        other = other_result_lines(text_content)
+        other_block = "\nПрочие результаты:\n" + "\n".join(other) + "\n" if other else ""
+        
+        # Lines the parser could not check may hold deviations
+        if all(value.status == 'normal' for value in values) and not unchecked_result_lines(text_content):
+            return (
+                f"Ты врач. Все показатели анализов пользователя находятся в пределах референсных значений. "
+                f"Кратко, в нескольких предложениях, подтверди это и дай общие рекомендации.\n\n"
+                f"{table}\n{other_block}\n{ANSWER_RULES}"
+            )
+        return (
+            f"Ты врач, который должен изучить результаты анализов пользователя. Ниже таблица показателей, "
+            f"отклонения от референсных значений уже отмечены (↑ выше нормы, ↓ ниже нормы). "
+            f"По каждому отклонению напиши: анализ, результат, референсные значения, с чем может быть связано "
+            f"отклонение и на что обратить внимание; если требуется дополнительное исследование, дай рекомендации. "
+            f"Показатели в норме перечисли кратко одним списком. В конце дай экспертное заключение.\n\n"
+            f"{table}\n{other_block}\n{ANSWER_RULES}"
+        )
+    
+    # Ranges the document lacks are taken from the local reference table
+    known = [value for value in values if value.kb_reference]
+    reference_block = (
+        "Справочные референсные значения показателей, для которых в документе их нет:\n"
+        + "\n".join(f"{value.name}: {format_reference(value)} {value.unit}".rstrip() for value in known) + "\n\n"
+    ) if known else ""
+    
+    return (
+        f"Ты врач, который должен изучить результаты анализов пользователя и сообщить ему "
+        f"где и какие результаты отличаются от референсных, с чем это может быть связано "
+        f"и на что обратить внимание. Если требуется дополнительное исследование, "
+        f"то дать рекомендации к этим исследованиям. Структура ответа должна быть такая:"
+        F"Анализ, например Лютеинизирующий гормон (ЛГ), потом результат из исследования, потом Референсные значения"
+        f"потом комментарии насчет этого анализа от ИИ в роли врача эксперта, в норме анализы или нет, если нет, то с чем это может быть связано. И так по каждому анализу."
+        f"В конце, после всех анализов дай экспертное заключение"
+        f"Вот данные анализов:\n\n{text_content}\n\n"
+        f"{reference_block}{ANSWER_RULES}"
+    )
+
+
+# Prompt size in estimated tokens: longer reports are analysed in chunks (map) and merged (reduce)
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "6000"))
+MAP_CHUNK_TOKENS = int(os.getenv("MAP_CHUNK_TOKENS", "3000"))
+MAP_MAX_CHUNKS = int(os.getenv("MAP_MAX_CHUNKS", "8"))
+
+CYRILLIC_RE = re.compile(r'[а-яё]', re.IGNORECASE)
+DIGIT_RE = re.compile(r'\d')
+
+
+def estimate_tokens(text):
+    """Rough GigaChat token count: ~3 Cyrillic characters, ~2 digits or ~4 other characters per token."""
+    cyrillic = len(CYRILLIC_RE.findall(text))
+    digits = len(DIGIT_RE.findall(text))
+    return math.ceil(cyrillic / 3 + digits / 2 + (len(text) - cyrillic - digits) / 4)
+
+
+def truncate_to_tokens(text, max_tokens):
+    """Cut text so that its estimated size fits max_tokens."""
+    tokens = estimate_tokens(text)
+    while tokens > max_tokens:
+        text = text[:max(1, int(len(text) * max_tokens / tokens) - 1)]
+        tokens = estimate_tokens(text)
+    return text
+
+
+def split_for_budget(text, max_tokens):
+    """Split text at line boundaries into chunks of at most max_tokens estimated tokens."""
+    chunks = []
+    lines = []
+    size = 0
+    for line in text.splitlines():
+        # A single overlong line is cut into pieces
+        pieces = []
+        while estimate_tokens(line) > max_tokens:
+            head = truncate_to_tokens(line, max_tokens)
+            pieces.append(head)
+            line = line[len(head):]
+        pieces.append(line)
+        
+        for piece in pieces:
+            tokens = estimate_tokens(piece) + 1
+            if lines and size + tokens > max_tokens:
+                chunks.append("\n".join(lines))
+                lines, size = [], 0
+            lines.append(piece)
+            size += tokens
+    if any(line.strip() for line in lines):
+        chunks.append("\n".join(lines))
+    return chunks
+
+
+def build_map_prompts(text_content, values):
+    """Prompts analysing a long report part by part, and the number of parts before MAP_MAX_CHUNKS.
+    
+    Every part stays within MAP_CHUNK_TOKENS.
+    """
+    if values and LAB_COMPACT_PROMPT:
+        header, *rows = format_lab_table(values).split("\n")
+        source = "\n".join(rows + other_result_lines(text_content))
+        header += "\n"
+    else:
+        header, source = "", text_content
+    
+    chunks = split_for_budget(source, MAP_CHUNK_TOKENS)
+    total = len(chunks)
+    if total > MAP_MAX_CHUNKS:
+        logger.warning(f"Report split into {total} parts, only the first {MAP_MAX_CHUNKS} are analysed")
+        chunks = chunks[:MAP_MAX_CHUNKS]
+    prompts = [
+        f"Ты врач. Ниже часть {number} из {len(chunks)} результатов анализов пользователя. "
+        f"По каждому показателю вне референсных значений напиши: анализ, результат, референсные значения "
+        f"и с чем может быть связано отклонение. Показатели в норме перечисли одной строкой. "
+        f"Общее заключение не пиши: части будут объединены.\n\n{header}{chunk}"
+        for number, chunk in enumerate(chunks, start=1)
+    ]
+    return prompts, total
+
+
+def add_note_before_disclaimer(answer, note):
+    """Insert a line into a formatted answer above its self-treatment disclaimer, or append it."""
+    lines = answer.split('\n')
+    for index in range(len(lines) - 1, -1, -1):
+        if DISCLAIMER_RE.search(html.unescape(HTML_TAG_RE.sub('', lines[index]))):
+            return '\n'.join(lines[:index] + [note, ''] + lines[index:])
+    return f"{answer}\n\n{note}"
+
+
+def build_reduce_prompt(partial_answers):
+    """Prompt merging the answers for the parts of a long report into one expert conclusion."""
+    per_part = max(200, (PROMPT_TOKEN_BUDGET - 500) // max(1, len(partial_answers)))
+    parts = "\n\n".join(
+        f"Часть {number}:\n{truncate_to_tokens(answer, per_part)}"
+        for number, answer in enumerate(partial_answers, start=1)
+    )
+    return (
+        f"Ты врач. Результаты анализов пользователя были разобраны по частям. Объедини разборы в один ответ: "
+        f"убери повторы, сгруппируй отклонения по системам организма, показатели в норме перечисли кратко "
+        f"одним списком, а в конце дай экспертное заключение и рекомендации по дополнительным исследованиям.\n\n"
+        f"{parts}\n\n{ANSWER_RULES}"
+    )
+
+
+def format_normal_report(values):
+    """Local answer for a report in which every recognised value is within range."""
+    lines = ["🔬 <b>Все распознанные показатели в пределах референсных значений:</b>", ""]
+    for value in values:
+        line = f"{value.name}: {format_number(value.value)} {value.unit}".rstrip() + f" (норма: {format_reference(value)})"
+        lines.append("✅ " + html.escape(line, quote=False))
+    lines += ["", f"<i>{DISCLAIMER}</i>"]
+    return "\n".join(lines)
+
+
+# Follow-up questions: per-user report context kept in memory
+SESSION_TTL = float(os.getenv("SESSION_TTL", "3600"))
+SESSION_MAX_USERS = int(os.getenv("SESSION_MAX_USERS", "1000"))
+SESSION_SUMMARY_CHARS = int(os.getenv("SESSION_SUMMARY_CHARS", "4000"))
+SESSION_ANSWER_CHARS = int(os.getenv("SESSION_ANSWER_CHARS", "2000"))
+SESSION_MAX_TURNS = int(os.getenv("SESSION_MAX_TURNS", "3"))
+SESSION_QUESTION_CHARS = int(os.getenv("SESSION_QUESTION_CHARS", "1000"))
+
+HTML_TAG_RE = re.compile(r'<[^>]+>')
+
+
+def html_to_text(text, max_chars):
+    """Plain text of a formatted answer, cut to max_chars."""
+    plain = html.unescape(HTML_TAG_RE.sub('', text)).strip()
+    return plain if len(plain) <= max_chars else plain[:max_chars - 1] + '…'
+
+
+def build_report_summary(text_content):
+    """Compact report context for follow-ups: the lab table, or the start of the raw text."""
+    values = parse_lab_values(text_content)
+    if values:
+        other = other_result_lines(text_content)
+        summary = format_lab_table(values) + ("\n" + "\n".join(other) if other else "")
+    else:
+        summary = text_content.strip()
+    return summary[:SESSION_SUMMARY_CHARS]
+
+
+def build_follow_up_prompt(session, question):
+    """Prompt answering a question about an already analysed report without resending it."""
+    history = "".join(
+        f"Вопрос пользователя: {previous_question}\nТвой ответ: {previous_answer}\n\n"
+        for previous_question, previous_answer in session['turns']
+    )
+    return (
+        f"Ты врач. Ранее ты разобрал анализы пользователя. Краткая сводка анализов:\n\n"
+        f"{session['summary']}\n\n"
+        f"Твой разбор (сокращённо):\n{session['answer']}\n\n"
+        f"{history}"
+        f"Ответь на новый вопрос пользователя по этим анализам кратко и по существу. "
+        f"Если в сводке нет нужного показателя, так и скажи и предложи, какой анализ сдать.\n\n"
+        f"Вопрос: {question}\n\n"
+        f"В конце напомни, что ответ сформирован искусственным интеллектом, носит информационный характер "
+        f"и не заменяет консультацию специалиста."
+    )
+
+
+def split_message(text, limit=TELEGRAM_MESSAGE_LIMIT):
+    """Split text into Telegram-sized parts, preferring section and line boundaries."""
+    parts = []
+    while len(text) > limit:
+        # Prefer a blank line (section boundary), then a line break, then a space
+        cut = text.rfind('\n\n', 0, limit)
+        if cut < limit // 2:
+            cut = text.rfind('\n', 0, limit)
+        if cut < limit // 2:
+            cut = text.rfind(' ', 0, limit)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut].rstrip())
+        text = text[cut:].lstrip('\n ')
+    if text.strip() or not parts:
+        parts.append(text)
+    return parts
+
+
+class SessionStore:
+    """The last analysed report of each user, kept for follow-up questions.
+    
+    Sessions expire SESSION_TTL seconds after their last use. At most SESSION_MAX_USERS
+    are kept, least recently used first out, and each holds only a capped summary,
+    the shortened answer and the last SESSION_MAX_TURNS questions.
+    """
+    
+    def __init__(self, ttl=None, max_users=None):
+        self.ttl = SESSION_TTL if ttl is None else ttl
+        self.max_users = SESSION_MAX_USERS if max_users is None else max_users
+        self.sessions = OrderedDict()
+    
+    def start(self, user_id, text_content, answer, summary=None):
+        """Remember a freshly analysed report, replacing the user's previous one.
+        
+        summary, when given, is a ready build_report_summary of the report.
+        """
+        self.sessions.pop(user_id, None)
+        self.sessions[user_id] = {
+            'summary': build_report_summary(text_content) if summary is None else summary,
+            'answer': html_to_text(answer, SESSION_ANSWER_CHARS),
+            'turns': deque(maxlen=SESSION_MAX_TURNS),
+            'expires': time.monotonic() + self.ttl,
+        }
+        self._evict()
+    
+    def get(self, user_id):
+        """The user's live session or None; using it renews its TTL."""
+        session = self.sessions.get(user_id)
+        if session is None:
+            return None
+        if session['expires'] <= time.monotonic():
+            del self.sessions[user_id]
+            return None
+        session['expires'] = time.monotonic() + self.ttl
+        self.sessions.move_to_end(user_id)
+        return session
+    
+    def add_turn(self, user_id, question, answer):
+        session = self.get(user_id)
+        if session is not None:
+            session['turns'].append((question, html_to_text(answer, SESSION_ANSWER_CHARS // 2)))
+    
+    def _evict(self):
+        # Entries are ordered by last use, so expired ones sit at the front
+        now = time.monotonic()
+        while self.sessions:
+            user_id, session = next(iter(self.sessions.items()))
+            if len(self.sessions) <= self.max_users and session['expires'] > now:
+                break
+            del self.sessions[user_id]
+
+
+class ProgressiveReply:
+    """Shows a streamed answer in the placeholder message, then sends the final text.
+    
+    Edits are throttled to STREAM_EDIT_INTERVAL seconds and back off when Telegram
+    asks to retry later.
+    """
+
+    def __init__(self, message, placeholder):
+        self.message = message
+        self.placeholder = placeholder
+        self.next_edit = 0.0
+        self.finished = False
+    
+    async def update(self, text):
+        """Show partial text if enough time has passed since the last edit."""
+        now = time.monotonic()
+        if now < self.next_edit or not text.strip():
+            return
+        self.next_edit = now + STREAM_EDIT_INTERVAL
+        
+        # While streaming only the tail fits into one message
+        preview = text if len(text) < TELEGRAM_MESSAGE_LIMIT - 2 else '…' + text[-(TELEGRAM_MESSAGE_LIMIT - 4):]
+        try:
+            await self.placeholder.edit_text(preview + ' ▌')
+        except RetryAfter as e:
+            self.next_edit = time.monotonic() + float(e.retry_after)
+        except BadRequest:
+            pass
+    
+    async def finish(self, text):
+        """Replace the placeholder with the first part of text and send the rest (Telegram HTML)."""
+        parts = split_message(text)
+        try:
+            await self.edit_html(parts[0])
+        except BadRequest:
+            # The placeholder is gone or cannot be edited: send a fresh message
+            await self.send_html(parts[0])
+        self.finished = True
+        
+        for part in parts[1:]:
+            await self.send_html(part)
+    
+    async def edit_html(self, text):
+        """Edit the placeholder to text as HTML, or as plain text if Telegram rejects the markup."""
+        try:
+            await self.placeholder.edit_text(text, parse_mode=ParseMode.HTML)
+        except RetryAfter as e:
+            await asyncio.sleep(float(e.retry_after))
+            await self.edit_html(text)
+        except BadRequest as e:
+            error = str(e).lower()
+            if 'not modified' in error:
+                return
+            if 'parse entities' not in error:
+                raise
+            # Editing in place keeps the streamed preview from being left behind
+            await self.placeholder.edit_text(html_to_text(text, TELEGRAM_MESSAGE_LIMIT))
+    
+    async def send_html(self, text):
+        """Send text as HTML, falling back to plain text if Telegram rejects the markup."""
+        try:
+            await self.message.reply_text(text, parse_mode=ParseMode.HTML)
+        except BadRequest:
+            await self.message.reply_text(html_to_text(text, TELEGRAM_MESSAGE_LIMIT))
+
+
+class UpdateDeduplicator:
+    """Remembers recent update_ids so that redelivered webhook updates are processed once.
+    
+    With db_path the ids are also claimed in a SQLite table, so several bot
+    processes on the same host never handle the same update twice.
+    """
+
+    def __init__(self, size=None, db_path=None):
+        self.size = size or UPDATE_DEDUP_SIZE
+        self.seen = OrderedDict()
+        self.duplicates = 0
+        self.conn = None
+        
+        if db_path:
+            self.conn = sqlite3.connect(db_path, check_same_thread=False, timeout=5)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS updates (update_id INTEGER PRIMARY KEY, received REAL NOT NULL)"
+            )
+            self.conn.commit()
+            self._lock = asyncio.Lock()
+    
+    def _claim(self, update_id):
+        with self.conn:
+            cursor = self.conn.execute(
+                "INSERT OR IGNORE INTO updates (update_id, received) VALUES (?, ?)", (update_id, time.time())
+            )
+            if cursor.rowcount and update_id % 1000 == 0:
+                # Forget ids older than a day now and then
+                self.conn.execute("DELETE FROM updates WHERE received < ?", (time.time() - 24 * 3600,))
+            return cursor.rowcount == 1
+    
+    async def is_duplicate(self, update_id):
+        """Return True if update_id was already seen, otherwise remember it."""
+        if update_id in self.seen:
+            self.duplicates += 1
+            return True
+        self.seen[update_id] = None
+        while len(self.seen) > self.size:
+            self.seen.popitem(last=False)
+        
+        if self.conn is not None:
+            async with self._lock:
+                claimed = await asyncio.to_thread(self._claim, update_id)
+            if not claimed:
+                self.duplicates += 1
+                return True
+        return False
+    
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+
+
+Job = namedtuple('Job', 'id user_id chat_id updates stage status_message_id attempts created')
+
+
+class JobStore:
+    """Durable queue of upload analyses in SQLite.
+    
+    A job keeps the serialised updates of its uploads (file_id, chat and message),
+    the pipeline stage it reached and the id of its "Обрабатываю..." message.
+    Finished jobs are deleted. Each store leases its jobs for `lease` seconds and
+    renews the lease while it runs; jobs whose lease ran out were left by a stopped
+    process and are claimed by the next one that looks.
+    """
+
+    def __init__(self, db_path=None, lease=None):
+        self.db_path = db_path or JOB_QUEUE_DB
+        self.lease = JOB_LEASE if lease is None else lease
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._lock = asyncio.Lock()
+        
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=5)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, chat_id INTEGER NOT NULL, "
+            "file_ids TEXT NOT NULL, updates TEXT NOT NULL, stage TEXT NOT NULL, status_message_id INTEGER, "
+            "attempts INTEGER NOT NULL DEFAULT 0, created REAL NOT NULL, updated REAL NOT NULL, "
+            "owner TEXT, lease_until REAL NOT NULL DEFAULT 0)"
+        )
+        # Queues written before leases existed
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(jobs)")}
+        if 'owner' not in columns:
+            self.conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+            self.conn.execute("ALTER TABLE jobs ADD COLUMN lease_until REAL NOT NULL DEFAULT 0")
+        self.conn.commit()
+    
+    def _execute(self, sql, params):
+        with self.conn:
+            return self.conn.execute(sql, params).lastrowid
+    
+    async def _write(self, sql, params):
+        async with self._lock:
+            return await asyncio.to_thread(self._execute, sql, params)
+    
+    async def add(self, items):
+        """Store a batch of (update, context) uploads as a queued job; returns the job id."""
+        update = items[0][0]
+        file_ids = [
+            select_photo_size(update.message.photo).file_id if update.message.photo else update.message.document.file_id
+            for update, _ in items
+        ]
+        now = time.time()
+        return await self._write(
+            "INSERT INTO jobs (user_id, chat_id, file_ids, updates, stage, created, updated, owner, lease_until) "
+            "VALUES (?, ?, ?, ?, 'queued', ?, ?, ?, ?)",
+            (
+                update.effective_user.id, update.effective_chat.id, ",".join(file_ids),
+                json.dumps([update.to_dict() for update, _ in items], ensure_ascii=False), now, now,
+                self.owner, now + self.lease,
+            )
+        )
+    
+    async def set_stage(self, job_id, stage, status_message_id=None):
+        """Record the stage a job reached and, once sent, its status message."""
+        if job_id is None:
+            return
+        await self._write(
+            "UPDATE jobs SET stage = ?, status_message_id = COALESCE(?, status_message_id), updated = ? WHERE id = ?",
+            (stage, status_message_id, time.time(), job_id)
+        )
+    
+    async def retry(self, job_id):
+        """Count another attempt of a resumed job and queue it again."""
+        await self._write(
+            "UPDATE jobs SET stage = 'queued', status_message_id = NULL, attempts = attempts + 1, updated = ? "
+            "WHERE id = ?",
+            (time.time(), job_id)
+        )
+    
+    async def finish(self, job_id):
+        """Drop a job that was answered, refused or given up."""
+        await self._write("DELETE FROM jobs WHERE id = ?", (job_id,))
+    
+    def _pending(self, owner=None):
+        rows = self.conn.execute(
+            "SELECT id, user_id, chat_id, updates, stage, status_message_id, attempts, created "
+            "FROM jobs WHERE ? IS NULL OR owner = ? ORDER BY id",
+            (owner, owner)
+        ).fetchall()
+        return [Job(row[0], row[1], row[2], json.loads(row[3]), *row[4:]) for row in rows]
+    
+    async def pending(self):
+        """Jobs left unfinished by any process, oldest first."""
+        async with self._lock:
+            return await asyncio.to_thread(self._pending)
+    
+    def _claim(self):
+        now = time.time()
+        expired = [row[0] for row in self.conn.execute("SELECT id FROM jobs WHERE lease_until <= ?", (now,))]
+        claimed = set()
+        with self.conn:
+            for job_id in expired:
+                # Another process may have claimed the job since it was read
+                if self.conn.execute(
+                    "UPDATE jobs SET owner = ?, lease_until = ? WHERE id = ? AND lease_until <= ?",
+                    (self.owner, now + self.lease, job_id, now)
+                ).rowcount:
+                    claimed.add(job_id)
+        return [job for job in self._pending(self.owner) if job.id in claimed] if claimed else []
+    
+    async def claim(self):
+        """Take over the jobs whose lease ran out, oldest first."""
+        async with self._lock:
+            return await asyncio.to_thread(self._claim)
+    
+    async def renew(self):
+        """Extend the lease of this store's jobs."""
+        await self._write("UPDATE jobs SET lease_until = ? WHERE owner = ?", (time.time() + self.lease, self.owner))
+    
+    def close(self):
+        """Release this store's jobs, so that the next process resumes them at once."""
+        with self.conn:
+            self.conn.execute("UPDATE jobs SET lease_until = 0 WHERE owner = ?", (self.owner,))
+        self.conn.close()
+
+
+class FairScheduler:
+    """Runs analysis jobs with a global concurrency cap, round-robin between users.
+    
+    Each user also has a token bucket (USER_RATE_BURST jobs, refilled at
+    USER_RATE_PER_MINUTE) so one user cannot flood the queue.
+    """
+
+    def __init__(self, max_active=None, rate_per_minute=None, burst=None):
+        self.max_active = max_active or SCHEDULER_MAX_ACTIVE
+        self.rate = (rate_per_minute or USER_RATE_PER_MINUTE) / 60
+        self.burst = burst or USER_RATE_BURST
+        self.queues = OrderedDict()
+        self.buckets = {}
+        self.active = 0
+        self.wait_times = deque(maxlen=1000)
+        self.run_times = deque(maxlen=1000)
+        # The event loop only keeps weak references to tasks
+        self.tasks = set()
+    
+    def take_token(self, user_id):
+        """Consume one token of the user's bucket; returns (allowed, seconds until next token)."""
+        now = time.monotonic()
+        tokens, updated = self.buckets.get(user_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self.buckets[user_id] = (tokens, now)
+            return False, (1 - tokens) / self.rate
+        self.buckets[user_id] = (tokens - 1, now)
+        return True, 0.0
+    
+    def queued(self):
+        """Number of jobs waiting to start."""
+        return sum(len(queue) for queue in self.queues.values())
+    
+    def position(self, user_id):
+        """Position of the user's latest queued job in the round-robin order (0 if none)."""
+        queue = self.queues.get(user_id)
+        if not queue:
+            return 0
+        rounds = len(queue)
+        # Every other user gets up to the same number of turns before it
+        return rounds + sum(min(len(other), rounds) for other_id, other in self.queues.items() if other_id != user_id)
+    
+    def submit(self, user_id, job):
+        """Queue job (a coroutine function); returns (future of its result, queue position)."""
+        future = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(user_id, deque()).append((job, future, time.monotonic()))
+        self._dispatch()
+        # Position 0 means the job has already been started
+        return future, (self.position(user_id) if self._is_queued(user_id, future) else 0)
+    
+    def _is_queued(self, user_id, future):
+        return any(queued_future is future for _, queued_future, _ in self.queues.get(user_id, ()))
+    
+    def _dispatch(self):
+        while self.active < self.max_active and self.queues:
+            # Take the next job from the user at the head of the rotation
+            user_id, queue = self.queues.popitem(last=False)
+            job, future, enqueued = queue.popleft()
+            if queue:
+                self.queues[user_id] = queue
+            if future.cancelled():
+                continue
+            self.active += 1
+            task = asyncio.create_task(self._run(user_id, job, future, enqueued))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+    
+    async def _run(self, user_id, job, future, enqueued):
+        started = time.monotonic()
+        self.wait_times.append(started - enqueued)
+        try:
+            result = await job()
+            if not future.done():
+                future.set_result(result)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        finally:
+            finished = time.monotonic()
+            self.run_times.append(finished - started)
+            logger.info(
+                f"Job for user {user_id}: waited {started - enqueued:.2f} s, ran {finished - started:.2f} s, "
+                f"{self.queued()} still queued"
+            )
+            self.active -= 1
+            self._dispatch()
+
+
+class UploadBatcher:
+    """Collects uploads that belong together and hands them over as one batch.
+    
+    Parts of an album share a media_group_id; other uploads of the same user in
+    the same chat are grouped when they arrive within UPLOAD_BATCH_WINDOW seconds
+    of each other. Every new part restarts the window.
+    """
+
+    def __init__(self, on_batch, media_group_window=None, upload_window=None, max_files=None):
+        self.on_batch = on_batch
+        self.media_group_window = MEDIA_GROUP_WINDOW if media_group_window is None else media_group_window
+        self.upload_window = UPLOAD_BATCH_WINDOW if upload_window is None else upload_window
+        self.max_files = max_files or BATCH_MAX_FILES
+        self.batches = {}
+        self.tasks = set()
+    
+    def batch_key(self, update):
+        """Return (key, window) for the batch the update belongs to, or (None, 0)."""
+        message = update.message
+        if message.media_group_id:
+            return ('album', message.media_group_id), self.media_group_window
+        if self.upload_window > 0:
+            return ('uploads', update.effective_chat.id, update.effective_user.id), self.upload_window
+        return None, 0
+    
+    async def add(self, update, context):
+        """Add an upload; the batch is flushed once no new part arrives within the window."""
+        key, window = self.batch_key(update)
+        if key is None:
+            self._start(self.on_batch([(update, context)]))
+            return
+        
+        items, timer = self.batches.get(key, ([], None))
+        if timer:
+            timer.cancel()
+        items.append((update, context))
+        
+        if len(items) >= self.max_files:
+            self.batches.pop(key, None)
+            self._start(self.on_batch(self._ordered(items)))
+            return
+        self.batches[key] = (items, self._start(self._flush_later(key, window)))
+    
+    def _start(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+    
+    def _ordered(self, items):
+        # Pages of a report are analysed in the order they were sent
+        return sorted(items, key=lambda item: item[0].message.message_id)
+    
+    async def _flush_later(self, key, window):
+        await asyncio.sleep(window)
+        items, _ = self.batches.pop(key)
+        if len(items) > 1:
+            logger.info(f"Analysing {len(items)} uploads together")
+        await self.on_batch(self._ordered(items))
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling GigaChat while the circuit breaker is open."""
+
+
+def is_retryable_error(error):
+    """Whether a failed GigaChat call is worth retrying: 429, 5xx or a network error."""
+    from gigachat.exceptions import RateLimitError, ResponseError, ServerError
+    if isinstance(error, (RateLimitError, ServerError, httpx.TransportError)):
+        return True
+    return isinstance(error, ResponseError) and (error.status_code == 429 or error.status_code >= 500)
+
+
+class GigaChatClient:
+    """Managed access to GigaChat through one long-lived, pooled HTTP client.
+    
+    The OAuth token is refreshed before it expires, calls failing with 429, 5xx or
+    network errors are retried with full-jitter exponential backoff, and after
+    breaker_threshold failed calls in a row every call fails fast with
+    CircuitOpenError until breaker_cooldown has passed and a probe call succeeds.
+    The GigaChat library itself is imported and configured on the first call.
+    """
+    
+    def __init__(self, client=None, max_retries=None, backoff_base=None, backoff_max=None,
+                 refresh_margin=None, breaker_threshold=None, breaker_cooldown=None):
+        self.client = client
+        self.max_retries = GIGACHAT_MAX_RETRIES if max_retries is None else max_retries
+        self.backoff_base = GIGACHAT_BACKOFF_BASE if backoff_base is None else backoff_base
+        self.backoff_max = GIGACHAT_BACKOFF_MAX if backoff_max is None else backoff_max
+        self.refresh_margin = GIGACHAT_TOKEN_REFRESH_MARGIN if refresh_margin is None else refresh_margin
+        self.breaker_threshold = GIGACHAT_BREAKER_THRESHOLD if breaker_threshold is None else breaker_threshold
+        self.breaker_cooldown = GIGACHAT_BREAKER_COOLDOWN if breaker_cooldown is None else breaker_cooldown
+        self.token_expires_at = 0.0
+        self.token_lock = asyncio.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.retries = 0
+        self.token_refreshes = 0
+    
+    def get_client(self):
+        """The underlying GigaChat client, built from the GIGACHAT_* settings on first use.
+        
+        The library's own retries are disabled: they are done here.
+        """
+        if self.client is not None:
+            return self.client
+        from gigachat import GigaChat
+        options = {
+            'credentials': GIGACHAT_CREDENTIALS,
+            'scope': GIGACHAT_SCOPE,
+            'model': GIGACHAT_MODEL,
+            'verify_ssl_certs': False,
+            'max_connections': GIGACHAT_MAX_CONNECTIONS,
+            'max_retries': 0,
+        }
+        if GIGACHAT_BASE_URL:
+            options['base_url'] = GIGACHAT_BASE_URL
+        if GIGACHAT_AUTH_URL:
+            options['auth_url'] = GIGACHAT_AUTH_URL
+        # The library renews its token once it expires within this buffer; the setting
+        # is only read from the environment
+        os.environ['GIGACHAT_TOKEN_EXPIRY_BUFFER_MS'] = str(int(self.refresh_margin * 1000))
+        self.client = GigaChat(**options)
+        return self.client
+    
+    @property
+    def state(self):
+        """Circuit breaker state: closed, open or half-open."""
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at < self.breaker_cooldown:
+            return 'open'
+        return 'half-open'
+    
+    def backoff(self, attempt, error):
+        """Full-jitter delay before the next attempt, never shorter than a 429 Retry-After."""
+        from gigachat.exceptions import RateLimitError
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        if isinstance(error, RateLimitError):
+            delay = max(delay, min(error.retry_after, self.backoff_max))
+        return delay
+    
+    def _before_call(self):
+        state = self.state
+        if state == 'open' or (state == 'half-open' and self.probing):
+            raise CircuitOpenError("GigaChat circuit breaker is open")
+        if state == 'half-open':
+            self.probing = True
+    
+    def _record_success(self):
+        if self.opened_at is not None:
+            logger.info("GigaChat circuit breaker closed")
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+    
+    def _record_failure(self, error):
+        self.failures += 1
+        self.probing = False
+        if self.opened_at is not None or self.failures >= self.breaker_threshold:
+            if self.state != 'open':
+                logger.warning(f"GigaChat circuit breaker opened after {self.failures} failures: {error}")
+            self.opened_at = time.monotonic()
+    
+    async def ensure_token(self):
+        """Fetch a new OAuth token when there is none or it expires within refresh_margin.
+        
+        aget_token replaces a token inside the expiry buffer set in get_client, so
+        requests running meanwhile keep using the old one until then.
+        """
+        if self.token_expires_at - time.time() > self.refresh_margin:
+            return
+        async with self.token_lock:
+            if self.token_expires_at - time.time() > self.refresh_margin:
+                return
+            token = await self.get_client().aget_token()
+            if token is not None and token.expires_at / 1000 != self.token_expires_at:
+                self.token_expires_at = token.expires_at / 1000
+                self.token_refreshes += 1
+                logger.info(f"GigaChat token refreshed, valid for {self.token_expires_at - time.time():.0f} s")
+    
+    async def run_token_refresh(self):
+        """Keep the OAuth token fresh in the background so no request waits for it."""
+        while True:
+            try:
+                await self.ensure_token()
+                delay = self.token_expires_at - time.time() - self.refresh_margin
+            except Exception as e:
+                logger.warning(f"GigaChat token refresh failed: {e}")
+                delay = 0
+            await asyncio.sleep(max(delay, self.backoff_max))
+    
+    async def achat(self, chat):
+        """Send a chat request, retrying transient failures."""
+        self._before_call()
+        attempt = 0
+        while True:
+            try:
+                await self.ensure_token()
+                response = await self.get_client().achat(chat)
+            except asyncio.CancelledError:
+                self.probing = False
+                raise
+            except Exception as e:
+                if not is_retryable_error(e):
+                    self.probing = False
+                    raise
+                if attempt >= self.max_retries or self.opened_at is not None:
+                    self._record_failure(e)
+                    raise
+                delay = self.backoff(attempt, e)
+                logger.warning(f"GigaChat call failed ({e}), retry {attempt + 1} in {delay:.2f} s")
+                self.retries += 1
+                attempt += 1
+                await asyncio.sleep(delay)
+            else:
+                self._record_success()
+                return response
+    
+    async def astream(self, chat):
+        """Stream a chat response; failures are retried only until the first chunk arrived."""
+        self._before_call()
+        attempt = 0
+        while True:
+            received = False
+            try:
+                await self.ensure_token()
+                async for chunk in self.get_client().astream(chat):
+                    received = True
+                    yield chunk
+            except asyncio.CancelledError:
+                self.probing = False
+                raise
+            except Exception as e:
+                if not is_retryable_error(e):
+                    self.probing = False
+                    raise
+                if received or attempt >= self.max_retries or self.opened_at is not None:
+                    self._record_failure(e)
+                    raise
+                delay = self.backoff(attempt, e)
+                logger.warning(f"GigaChat stream failed ({e}), retry {attempt + 1} in {delay:.2f} s")
+                self.retries += 1
+                attempt += 1
+                await asyncio.sleep(delay)
+            else:
+                self._record_success()
+                return
+    
+    async def aclose(self):
+        """Close the pooled HTTP connections."""
+        if self.client is not None:
+            await self.client.aclose()
+
 
 if GIGACHAT_CREDENTIALS and GIGACHAT_SCOPE:
-    giga = GigaChat(
-        credentials=GIGACHAT_CREDENTIALS,
-        scope=GIGACHAT_SCOPE,
-        verify_ssl_certs=False,
-    )
+    giga = GigaChatClient()
 else:
     logger.warning("GigaChat credentials not found. Please set GIGACHAT_CREDENTIALS and GIGACHAT_SCOPE environment variables.")
 
-def log_user_interaction(user_id, user_name, username=None, file_type=None):
-    """Log user interaction to users.txt file"""
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    
-    # Check if this is the user's first request
-    is_first_request = True
-    request_count = 1
-    
-    # Read existing data to check if user already exists
-    if os.path.exists('users.txt'):
-        with open('users.txt', 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-            for line in lines:
-                parts = line.strip().split('|')
-                if len(parts) >= 3 and parts[0] == str(user_id):
-                    is_first_request = False
-                    # Get the current count and increment
-                    request_count = int(parts[6]) + 1 if len(parts) >= 7 else 2
-                    break
+
+class Metrics:
+    """In-process counters, gauges, latency histograms and summaries.
+    
+    Rendered in the Prometheus text format for /metrics or as a JSON snapshot.
+    Gauges and summaries read existing state (a callable or a deque of samples)
+    when they are rendered, so the code they describe does not need to change.
+    """
+    
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.summaries = {}
+    
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+    
+    def inc(self, name, amount=1, **labels):
+        key = self._key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + amount
+    
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            histogram['buckets'][index] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+    
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe the duration of the block, also when it raises."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+    
+    def gauge(self, name, read, kind='gauge'):
+        """Register a value read on every render; kind 'counter' marks a monotonic one."""
+        self.gauges[name] = (read, kind)
+    
+    def summary(self, name, samples):
+        """Register a deque of recent samples reported as quantiles."""
+        self.summaries[name] = samples
+    
+    @staticmethod
+    def quantiles(samples):
+        ordered = sorted(samples)
+        if not ordered:
+            return {}
+        return {q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] for q in (0.5, 0.95, 0.99)}
     
-    request_type = "first" if is_first_request else "repeat"
+    def snapshot(self):
+        """All metrics as a JSON-serialisable dict."""
+        def labelled(items):
+            result = {}
+            for (name, labels), value in sorted(items):
+                result.setdefault(name, []).append({'labels': dict(labels), 'value': value})
+            return result
+        
+        histograms = {}
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            histograms.setdefault(name, []).append({
+                'labels': dict(labels),
+                'buckets': dict(zip(map(str, self.buckets), itertools.accumulate(histogram['buckets']))),
+                'sum': histogram['sum'],
+                'count': histogram['count'],
+            })
+        return {
+            'counters': labelled(self.counters.items()),
+            'gauges': {name: read() for name, (read, _) in sorted(self.gauges.items())},
+            'histograms': histograms,
+            'summaries': {
+                name: {str(q): value for q, value in self.quantiles(samples).items()}
+                for name, samples in sorted(self.summaries.items())
+            },
+        }
+    
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        def format_labels(labels, extra=()):
+            pairs = [f'{key}="{value}"' for key, value in (*labels, *extra)]
+            return '{' + ','.join(pairs) + '}' if pairs else ''
+        
+        lines = []
+        typed = set()
+        
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+        
+        for (name, labels), value in sorted(self.counters.items()):
+            declare(name, 'counter')
+            lines.append(f"{name}{format_labels(labels)} {value}")
+        for name, (read, kind) in sorted(self.gauges.items()):
+            declare(name, kind)
+            lines.append(f"{name} {read()}")
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            declare(name, 'histogram')
+            cumulative = itertools.accumulate(histogram['buckets'])
+            for bound, count in zip(self.buckets, cumulative):
+                lines.append(f"{name}_bucket{format_labels(labels, [('le', bound)])} {count}")
+            lines.append(f"{name}_bucket{format_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+            lines.append(f"{name}_sum{format_labels(labels)} {histogram['sum']:.6f}")
+            lines.append(f"{name}_count{format_labels(labels)} {histogram['count']}")
+        for name, samples in sorted(self.summaries.items()):
+            declare(name, 'summary')
+            for q, value in self.quantiles(samples).items():
+                lines.append(f"{name}{format_labels((), [('quantile', q)])} {value:.6f}")
+            lines.append(f"{name}_sum {sum(samples):.6f}")
+            lines.append(f"{name}_count {len(samples)}")
+        return '\n'.join(lines) + '\n'
+    
+    async def handle_http(self, reader, writer):
+        """Answer GET /metrics on a plain asyncio stream; everything else is 404."""
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            # Skip the request headers
+            while (await asyncio.wait_for(reader.readline(), timeout=5)).strip():
+                pass
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, body = '200 OK', self.render().encode('utf-8')
+            else:
+                status, body = '404 Not Found', b'not found\n'
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode('latin-1') + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+    
+    async def start_server(self, host=None, port=None):
+        """Serve /metrics for Prometheus scrapes."""
+        host = METRICS_LISTEN if host is None else host
+        port = METRICS_PORT if port is None else port
+        server = await asyncio.start_server(self.handle_http, host, port)
+        logger.info(f"Metrics are served on http://{host}:{port}/metrics")
+        return server
     
-    # Format: user_id|user_name|username|timestamp|file_type|request_type|total_requests
-    log_entry = f"{user_id}|{user_name}|{username or 'N/A'}|{timestamp}|{file_type or 'N/A'}|{request_type}|{request_count}\n"
+    def dump(self, path):
+        """Write the JSON snapshot atomically."""
+        temporary = f"{path}.tmp"
+        with open(temporary, 'w', encoding='utf-8') as dump_file:
+            json.dump(self.snapshot(), dump_file, ensure_ascii=False, indent=1)
+        os.replace(temporary, path)
     
-    with open('users.txt', 'a', encoding='utf-8') as f:
-        f.write(log_entry)
+    async def run_periodic_dump(self, path, interval=None):
+        """Dump the JSON snapshot every METRICS_DUMP_INTERVAL seconds."""
+        interval = METRICS_DUMP_INTERVAL if interval is None else interval
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.dump(path)
+            except OSError as e:
+                logger.warning(f"Could not write metrics to {path}: {e}")
+
 
 class MedicalAnalysisBot:
     def __init__(self):
@@ -71,12 +2671,107 @@ class MedicalAnalysisBot:
         if not self.bot_token:
             raise ValueError("TELEGRAM_BOT_TOKEN environment variable is not set")
         
+        # Bounded pool for GigaChat calls and the number of requests waiting for a slot
+        self.llm_semaphore = asyncio.Semaphore(GIGACHAT_MAX_CONCURRENCY)
+        self.llm_queue_depth = 0
+        self.llm_ttft = deque(maxlen=1000)
+        
+        # Indexed, append-only store of user interactions
+        self.user_store = UserStore()
+        
+        # Cache of finished analyses keyed by file bytes and by extracted text
+        self.result_cache = ResultCache()
+        
+        # Worker processes for CPU-bound document parsing, started on first use
+        self.extract_pool = None
+        
+        if not shutil.which(TESSERACT_CMD):
+            logger.warning(f"OCR engine '{TESSERACT_CMD}' not found: photos cannot be recognised. Install tesseract-ocr.")
+        self.background_tasks = []
+        
+        # Fair round-robin scheduling of analyses between users
+        self.scheduler = FairScheduler()
+        
+        # Groups albums and quick successive uploads into one analysis
+        self.batcher = UploadBatcher(self.schedule_batch)
+        
+        # Uploads waiting for or in analysis, kept on disk to survive restarts
+        self.jobs = JobStore()
+        
+        # Drops updates that Telegram delivers more than once
+        self.deduplicator = UpdateDeduplicator(db_path=UPDATE_DEDUP_DB)
+        
+        # Recent reports for follow-up questions
+        self.sessions = SessionStore()
+        
+        # Perceptual hashes of recent photos per user and futures of their recognised text
+        self.recent_photos = OrderedDict()
+        
+        # Stage latencies and counters, plus the state the components above already track
+        self.metrics = Metrics()
+        self.metrics_server = None
+        self.metrics.gauge('llm_queue_depth', lambda: self.llm_queue_depth)
+        self.metrics.gauge('scheduler_active', lambda: self.scheduler.active)
+        self.metrics.gauge('scheduler_queued', self.scheduler.queued)
+        self.metrics.gauge('follow_up_sessions', lambda: len(self.sessions.sessions))
+        self.metrics.gauge('result_cache_hits_total', lambda: self.result_cache.hits, kind='counter')
+        self.metrics.gauge('result_cache_misses_total', lambda: self.result_cache.misses, kind='counter')
+        self.metrics.gauge('duplicate_updates_total', lambda: self.deduplicator.duplicates, kind='counter')
+        self.metrics.summary('llm_ttft_seconds', self.llm_ttft)
+        self.metrics.summary('scheduler_wait_seconds', self.scheduler.wait_times)
+        self.metrics.summary('scheduler_run_seconds', self.scheduler.run_times)
+        if GIGACHAT_CREDENTIALS and GIGACHAT_SCOPE:
+            self.metrics.gauge('llm_retries_total', lambda: giga.retries, kind='counter')
+            self.metrics.gauge('llm_circuit_open', lambda: int(giga.state != 'closed'))
+        
+    async def drop_duplicate_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Stop handling an update whose update_id has already been processed."""
+        if await self.deduplicator.is_duplicate(update.update_id):
+            logger.info(f"Skipping duplicate update {update.update_id}")
+            raise ApplicationHandlerStop
+    
+    async def schedule(self, update, job, rate_limited=True):
+        """Run an analysis job through the fair scheduler, telling the user about the queue."""
+        message = update.message
+        user_id = update.effective_user.id
+        
+        allowed, retry_after = self.scheduler.take_token(user_id) if rate_limited else (True, 0.0)
+        if not allowed:
+            self.metrics.inc('rate_limited_total')
+            await message.reply_text(
+                f"Слишком много запросов подряд. Попробуйте снова через {math.ceil(retry_after)} сек."
+            )
+            return
+        
+        state = {'started': False, 'queue_msg': None}
+        
+        async def run():
+            state['started'] = True
+            if state['queue_msg']:
+                try:
+                    await state['queue_msg'].delete()
+                except:
+                    pass
+            await job()
+        
+        future, position = self.scheduler.submit(user_id, run)
+        if position:
+            queue_msg = await message.reply_text(f"⏳ Запрос в очереди, позиция {position}. Я начну обработку, как только освободится место.")
+            if state['started']:
+                try:
+                    await queue_msg.delete()
+                except:
+                    pass
+            else:
+                state['queue_msg'] = queue_msg
+        await future
+    
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Send a welcome message when the command /start is issued."""
         user = update.effective_user
         
         # Log user interaction
-        log_user_interaction(
+        self.user_store.log_interaction(
             user_id=user.id, 
             user_name=f"{user.first_name} {user.last_name or ''}".strip(), 
             username=user.username,
@@ -89,7 +2784,8 @@ class MedicalAnalysisBot:
             "Я помогу вам понять, где и какие результаты отличаются от нормы, "
             "с чем это может быть связано и на что обратить внимание.\n\n"
             "Пожалуйста, загрузите документ с результатами анализов (поддерживаются форматы: "
-            "DOC, DOCX, XLS, PDF, JPEG). После загрузки я проанализирую данные и дам разъяснения."
+            "DOC, DOCX, XLS, PDF, JPEG). После загрузки я проанализирую данные и дам разъяснения.\n\n"
+            "Потом можно задать уточняющий вопрос текстом, например: «А что с ферритином?»"
         )
         await update.message.reply_text(welcome_message)
     
@@ -99,272 +2795,701 @@ class MedicalAnalysisBot:
         message = update.message
         
         # Log user interaction
-        file_extension = os.path.splitext(message.document.file_name)[1]
-        log_user_interaction(
+        file_extension = os.path.splitext(message.document.file_name or '')[1]
+        self.user_store.log_interaction(
             user_id=user.id, 
             user_name=f"{user.first_name} {user.last_name or ''}".strip(), 
             username=user.username,
             file_type=file_extension
         )
         
-        # Inform user that processing has started
-        processing_msg = await message.reply_text("Обрабатываю документ... Подождите немного.")
+        # Refuse files that are too large to parse in reasonable time
+        if message.document.file_size and message.document.file_size > EXTRACT_MAX_FILE_SIZE:
+            await message.reply_text(
+                f"Файл слишком большой. Максимальный размер — {EXTRACT_MAX_FILE_SIZE // (1024 * 1024)} МБ."
+            )
+            return
         
-        try:
-            # Get file from message
-            file = await context.bot.get_file(message.document.file_id)
-            
-            # Create temporary file
-            with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-                await file.download_to_memory(temp_file)
-                temp_file_path = temp_file.name
-            
-            # Extract text from the document based on its type
-            text_content = self.extract_text_from_document(temp_file_path, message.document.file_name)
-            
-            if not text_content:
-                await message.reply_text("Не удалось извлечь текст из документа. Попробуйте другой файл.")
-                os.unlink(temp_file_path)
-                return
-            
-            # Analyze with GigaChat
-            analysis_result = self.analyze_with_gigachat(text_content)
-            
-            # Send the analysis result back to user
-            await message.reply_text(analysis_result)
-            
-        except Exception as e:
-            # Log document processing error to both logger and log.txt file
-            error_msg = f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - Error processing document {message.document.file_name}: {e}"
-            logger.error(error_msg)
-            
-            # Write to log.txt file
-            with open('log.txt', 'a', encoding='utf-8') as log_file:
-                log_file.write(error_msg + "\n")
-                
-            await message.reply_text("Произошла ошибка при обработке документа. Попробуйте снова.")
-        finally:
-            # Clean up temporary file
-            if 'temp_file_path' in locals():
-                os.unlink(temp_file_path)
-            
-            # Delete the processing message
-            try:
-                await processing_msg.delete()
-            except:
-                pass
+        # Albums and quick successive uploads are analysed together
+        await self.batcher.add(update, context)
     
     async def handle_photo(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle photo uploads and send to GigaChat for analysis."""
         user = update.effective_user
-        message = update.message
         
         # Log user interaction
-        log_user_interaction(
+        self.user_store.log_interaction(
             user_id=user.id, 
             user_name=f"{user.first_name} {user.last_name or ''}".strip(), 
             username=user.username,
             file_type='image'
         )
         
+        # Albums and quick successive uploads are analysed together
+        await self.batcher.add(update, context)
+    
+    async def handle_text(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Answer a text message as a follow-up question about the user's last report."""
+        user = update.effective_user
+        message = update.message
+        
+        if self.sessions.get(user.id) is None:
+            await message.reply_text(
+                "Чтобы задать вопрос, сначала отправьте документ или фото с результатами анализов."
+            )
+            return
+        
+        # Log user interaction
+        self.user_store.log_interaction(
+            user_id=user.id,
+            user_name=f"{user.first_name} {user.last_name or ''}".strip(),
+            username=user.username,
+            file_type='question'
+        )
+        
+        try:
+            await self.schedule(update, lambda: self.answer_follow_up(update))
+        except Exception as e:
+            log_error(f"Error scheduling follow-up of user {user.id}: {e}")
+    
+    async def answer_follow_up(self, update):
+        """Answer a question from the stored report summary instead of the whole document."""
+        message = update.message
+        user_id = update.effective_user.id
+        session = self.sessions.get(user_id)
+        if session is None:
+            await message.reply_text("Сессия истекла. Отправьте результаты анализов ещё раз.")
+            return
+        
+        question = message.text.strip()[:SESSION_QUESTION_CHARS]
+        processing_msg = await message.reply_text("Думаю над ответом...")
+        reply = ProgressiveReply(message, processing_msg)
+        self.metrics.inc('follow_ups_total')
+        
+        try:
+            answer, succeeded = await self.ask_gigachat(build_follow_up_prompt(session, question), reply.update)
+            if succeeded:
+                self.sessions.add_turn(user_id, question, answer)
+            with self.metrics.timer('stage_seconds', stage='send'):
+                await reply.finish(answer)
+        except Exception as e:
+            log_error(f"Error answering follow-up of user {user_id}: {e}")
+            self.metrics.inc('errors_total', stage='follow_up')
+            await message.reply_text("Произошла ошибка при ответе на вопрос. Попробуйте снова.")
+        finally:
+            if not reply.finished:
+                try:
+                    await processing_msg.delete()
+                except:
+                    pass
+    
+    async def schedule_batch(self, items):
+        """Store one analysis for a batch of (update, context) uploads and queue it."""
+        update = items[0][0]
+        try:
+            job_id = await self.jobs.add(items)
+        except Exception as e:
+            # Still analyse the uploads, they just would not survive a restart
+            log_error(f"Error storing job of user {update.effective_user.id}: {e}")
+            job_id = None
+        await self.run_job(job_id, items)
+    
+    async def run_job(self, job_id, items, rate_limited=True):
+        """Run a stored job through the fair scheduler and drop it once it is handled."""
+        update = items[0][0]
+        try:
+            # Queue the analysis fairly between users
+            await self.schedule(update, lambda: self.process_uploads(items, job_id), rate_limited)
+        except Exception as e:
+            log_error(f"Error scheduling uploads of user {update.effective_user.id}: {e}")
+        
+        # Answered, refused or failed: only a cancelled job stays queued for the next start
+        if job_id is not None:
+            await self.jobs.finish(job_id)
+    
+    async def resume_jobs(self, application):
+        """Resume the jobs a stopped run of the bot left unfinished."""
+        jobs = await self.jobs.claim()
+        if not jobs:
+            return
+        logger.info(f"Resuming {len(jobs)} unfinished jobs")
+        context = CallbackContext(application)
+        await asyncio.gather(*(self.resume_job(job, context) for job in jobs))
+    
+    async def run_job_leases(self, application):
+        """Renew the leases of this process's jobs and resume jobs whose process has stopped."""
+        while True:
+            try:
+                await self.jobs.renew()
+                # Resumed jobs run in the background, so leases keep being renewed meanwhile
+                task = asyncio.create_task(self.resume_jobs(application))
+                self.background_tasks.append(task)
+                task.add_done_callback(self.background_tasks.remove)
+            except Exception as e:
+                logger.error(f"Error renewing job leases: {e}")
+            await asyncio.sleep(self.jobs.lease / 3)
+    
+    async def resume_job(self, job, context):
+        """Restart one unfinished job; finished stages are answered from the result cache."""
+        items = [(Update.de_json(data, context.bot), context) for data in job.updates]
+        message = items[0][0].message
+        
+        # The status message of the interrupted run would stay forever
+        if job.status_message_id:
+            try:
+                await context.bot.delete_message(job.chat_id, job.status_message_id)
+            except:
+                pass
+        
+        if job.attempts + 1 >= JOB_MAX_ATTEMPTS or time.time() - job.created > JOB_MAX_AGE:
+            logger.warning(f"Giving up job {job.id} of user {job.user_id} in stage {job.stage}")
+            self.metrics.inc('jobs_abandoned_total')
+            try:
+                await message.reply_text("Не удалось обработать файл. Пожалуйста, отправьте его ещё раз.")
+            except Exception as e:
+                log_error(f"Error notifying user {job.user_id} about job {job.id}: {e}")
+            await self.jobs.finish(job.id)
+            return
+        
+        logger.info(f"Resuming job {job.id} of user {job.user_id} from stage {job.stage}")
+        self.metrics.inc('jobs_resumed_total')
+        await self.jobs.retry(job.id)
+        await self.run_job(job.id, items, rate_limited=False)
+    
+    async def download_upload(self, update, context):
+        """Download the document or photo of an update; returns (file name, buffer, is_photo, MIME type)."""
+        message = update.message
+        if message.photo:
+            # The smallest size that is still legible is enough for OCR
+            photo = select_photo_size(message.photo)
+            with self.metrics.timer('stage_seconds', stage='download'):
+                file = await context.bot.get_file(photo.file_id)
+                return "photo.jpg", await download_to_memory(file), True, "image/jpeg"
+        
+        document = message.document
+        with self.metrics.timer('stage_seconds', stage='download'):
+            file = await context.bot.get_file(document.file_id)
+            # Download into memory (large files go to a named temp file the workers read by path)
+            return document.file_name or "document", await download_to_memory(file), False, document.mime_type
+    
+    async def extract_upload(self, name, buffer, is_photo, mime_type, file_key, user_id=None):
+        """Extract the text of one downloaded upload."""
+        # The format is only known once a worker has looked into the file
+        started = time.perf_counter()
+        if is_photo:
+            # Recognise the text on the photo
+            file_format = 'photo'
+            text = await self.ocr_photo(buffer, file_key, user_id)
+        else:
+            # Extract text from the document based on its type
+            file_format, text = await self.extract_text_async(buffer, name, mime_type)
+        self.metrics.observe('stage_seconds', time.perf_counter() - started, stage='extract', format=file_format)
+        self.metrics.inc('documents_total', format=file_format)
+        if not text:
+            self.metrics.inc('errors_total', stage='extract', format=file_format)
+        return text
+    
+    async def process_uploads(self, items, job_id=None):
+        """Download, extract and analyze one upload or a whole batch in a single GigaChat request.
+        
+        With job_id the stage reached is recorded in the job queue.
+        """
+        message = items[0][0].message
+        user_id = items[0][0].effective_user.id
+        photos_only = all(update.message.photo for update, _ in items)
+        if len(items) > 1:
+            what = f"файлы ({len(items)})"
+        elif photos_only:
+            what = "изображение"
+        else:
+            what = "документ"
+        
         # Inform user that processing has started
-        processing_msg = await message.reply_text("Обрабатываю изображение... Подождите немного.")
+        processing_msg = await message.reply_text(f"Обрабатываю {what}... Подождите немного.")
+        reply = ProgressiveReply(message, processing_msg)
+        uploads = []
         
         try:
-            # Get the largest photo from the message
-            photo = message.photo[-1]  # Last item is the highest resolution
-            file = await context.bot.get_file(photo.file_id)
+            await self.jobs.set_stage(job_id, 'download', processing_msg.message_id)
             
-            # Create temporary file
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as temp_file:
-                await file.download_to_memory(temp_file)
-                temp_file_path = temp_file.name
+            # Download all files at once
+            uploads = await asyncio.gather(*(self.download_upload(update, context) for update, context in items))
             
-            # For images, we'll just read as text (OCR would be needed for actual text extraction)
-            # Here we'll convert image to base64 string to pass to GigaChat if it supports image processing
-            with open(temp_file_path, 'rb') as img_file:
-                img_data = img_file.read()
-                
-            # For now, we'll just pass a message to GigaChat indicating an image was uploaded
-            text_content = f"Пользователь загрузил изображение медицинского документа с результатами анализов. Пожалуйста, предоставьте интерпретацию этих результатов."
+            # The same file (or the same set of files) was analysed before: answer from the cache
+            file_keys = [file_cache_key(buffer) for _, buffer, _, _ in uploads]
+            upload_key = file_keys[0] if len(file_keys) == 1 else batch_cache_key(file_keys)
+            cached_result = await self.result_cache.get(upload_key)
+            # Without the stored report context the files are extracted again to reopen the session
+            summary = await self.result_cache.get(summary_cache_key(upload_key)) if cached_result else None
+            if cached_result and summary:
+                self.sessions.start(user_id, None, cached_result, summary=summary)
+                with self.metrics.timer('stage_seconds', stage='send'):
+                    await reply.finish(cached_result)
+                return
+            
+            # Extract the text of every file concurrently
+            await self.jobs.set_stage(job_id, 'extract')
+            texts = await asyncio.gather(*(
+                self.extract_upload(*upload, file_key, user_id)
+                for upload, file_key in zip(uploads, file_keys)
+            ))
+            parts = []
+            for (name, _, _, _), text in zip(uploads, texts):
+                # Repeated shots of the same sheet are analysed once
+                if text and text not in (part_text for _, part_text in parts):
+                    parts.append((name, text))
+            
+            if not parts:
+                if len(items) > 1:
+                    await message.reply_text("Не удалось извлечь текст ни из одного файла. Попробуйте другие файлы.")
+                elif photos_only:
+                    await message.reply_text(
+                        "Не удалось распознать текст на изображении. "
+                        "Попробуйте сделать более четкое фото или отправьте документ в формате PDF."
+                    )
+                else:
+                    await message.reply_text("Не удалось извлечь текст из документа. Попробуйте другой файл.")
+                return
+            
+            if len(parts) == 1:
+                text_content = parts[0][1]
+            else:
+                text_content = "\n\n".join(
+                    f"=== Файл {number}: {name} ===\n{text}" for number, (name, text) in enumerate(parts, start=1)
+                )
+            
+            # Different files with the same contents were analysed before, or these very
+            # files were, but their report context was not cached
+            text_key = text_cache_key(text_content)
+            cached_result = await self.result_cache.get(text_key) or cached_result
+            summary = build_report_summary(text_content)
+            if cached_result:
+                await self.result_cache.put([upload_key], cached_result)
+                await self.result_cache.put([summary_cache_key(upload_key)], summary)
+                self.sessions.start(user_id, text_content, cached_result, summary=summary)
+                with self.metrics.timer('stage_seconds', stage='send'):
+                    await reply.finish(cached_result)
+                return
             
             # Analyze with GigaChat
-            analysis_result = self.analyze_with_gigachat(text_content)
+            await self.jobs.set_stage(job_id, 'analyze')
+            analysis_result, succeeded = await self.analyze_with_gigachat(
+                text_content, cache_keys=[upload_key, text_key], on_progress=reply.update
+            )
+            
+            # Keep the report for follow-up questions, unless the analysis failed; the
+            # context is cached too, so that a re-sent file reopens the session
+            if succeeded:
+                await self.result_cache.put([summary_cache_key(upload_key)], summary)
+                self.sessions.start(user_id, text_content, analysis_result, summary=summary)
             
-            # Send the analysis result back to user
-            await message.reply_text(analysis_result)
+            # Send the analysis result back to user, split into several messages if needed
+            await self.jobs.set_stage(job_id, 'send')
+            with self.metrics.timer('stage_seconds', stage='send'):
+                await reply.finish(analysis_result)
             
         except Exception as e:
-            # Log photo processing error to both logger and log.txt file
-            error_msg = f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - Error processing photo: {e}"
-            logger.error(error_msg)
+            # Log processing error to both logger and log.txt file
+            names = ", ".join(
+                str(update.message.document.file_name) if update.message.document else "photo" for update, _ in items
+            )
+            log_error(f"Error processing {names}: {e}")
+            self.metrics.inc('errors_total', stage='processing')
             
-            # Write to log.txt file
-            with open('log.txt', 'a', encoding='utf-8') as log_file:
-                log_file.write(error_msg + "\n")
-                
-            await message.reply_text("Произошла ошибка при обработке изображения. Попробуйте снова.")
+            if photos_only and len(items) == 1:
+                await message.reply_text("Произошла ошибка при обработке изображения. Попробуйте снова.")
+            else:
+                await message.reply_text("Произошла ошибка при обработке документа. Попробуйте снова.")
         finally:
-            # Clean up temporary file
-            if 'temp_file_path' in locals():
-                os.unlink(temp_file_path)
+            # Release the downloaded files
+            for _, buffer, _, _ in uploads:
+                buffer.close()
             
-            # Delete the processing message
+            # Delete the processing message unless it now holds the answer
+            if not reply.finished:
+                try:
+                    await processing_msg.delete()
+                except:
+                    pass
+    
+    def get_extract_pool(self):
+        """Worker processes for CPU-bound document parsing, started on first use."""
+        if self.extract_pool is None:
+            # spawn keeps worker processes independent of the event loop's threads
+            self.extract_pool = ProcessPoolExecutor(
+                max_workers=EXTRACT_WORKERS,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return self.extract_pool
+    
+    def recycle_extract_pool(self, pool, reason):
+        """Replace a worker pool, killing its processes so that jobs stuck in it really stop."""
+        if pool is None or self.extract_pool is not pool:
+            # Already replaced after another job noticed the same failure
+            return
+        self.extract_pool = None
+        self.metrics.inc('extract_pool_restarts_total', reason=reason)
+        logger.warning(f"Restarting the extraction worker pool ({reason})")
+        # A running job cannot be cancelled, only its process killed; jobs of other
+        # uploads killed with it are resubmitted by run_extract_job
+        for process in list((getattr(pool, '_processes', None) or {}).values()):
+            process.kill()
+        pool.shutdown(wait=False, cancel_futures=True)
+    
+    async def run_extract_job(self, job, *args, timeout=None):
+        """Run a parsing job in the worker pool, dropping it if it has not started when cancelled.
+        
+        A job still running after timeout seconds is stopped by restarting the pool.
+        A job whose pool broke (a worker crashed or was killed) is tried once more.
+        """
+        for attempt in range(2):
+            pool = self.get_extract_pool()
+            future = None
             try:
-                await processing_msg.delete()
-            except:
-                pass
+                future = pool.submit(job, *args)
+                return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+            except asyncio.TimeoutError:
+                # A job that never left the queue is just dropped
+                if future.running():
+                    self.recycle_extract_pool(pool, 'timeout')
+                raise
+            except BrokenProcessPool:
+                self.recycle_extract_pool(pool, 'broken')
+                if attempt:
+                    raise
+            finally:
+                if future is not None:
+                    future.cancel()
     
-    def extract_text_from_document(self, file_path, filename):
-        """Extract text from various document formats."""
-        _, ext = os.path.splitext(filename.lower())
+    async def extract_pdf_parallel(self, payload, filename):
+        """Extract a PDF in page chunks spread over the worker pool, stopping at the text budget."""
+        deadline = time.monotonic() + EXTRACT_TIMEOUT
+        text, page_count = await self.run_extract_job(
+            extract_pdf_pages_job, payload, filename, 0, PDF_PARALLEL_PAGES, timeout=EXTRACT_TIMEOUT
+        )
+        if text is None or len(text) >= EXTRACT_MAX_CHARS or page_count <= PDF_PARALLEL_PAGES:
+            return text
         
+        # The first chunk told us the page count: fan out the remaining pages at once
+        last_page = min(page_count, EXTRACT_MAX_PAGES)
+        jobs = [
+            asyncio.ensure_future(self.run_extract_job(
+                extract_pdf_pages_job, payload, filename, start, min(start + PDF_PARALLEL_PAGES, last_page),
+                timeout=max(deadline - time.monotonic(), 0)
+            ))
+            for start in range(PDF_PARALLEL_PAGES, last_page, PDF_PARALLEL_PAGES)
+        ]
+        parts = [text]
         try:
-            if ext == '.txt':
-                with open(file_path, 'r', encoding='utf-8') as file:
-                    return file.read()
-                    
-            elif ext in ['.docx']:
-                doc = Document(file_path)
-                full_text = []
-                for para in doc.paragraphs:
-                    full_text.append(para.text)
-                return '\n'.join(full_text)
-                
-            elif ext in ['.pdf']:
-                try:
-                    reader = PdfReader(file_path)
-                    text = ""
-                    for page in reader.pages:
-                        text += page.extract_text() + "\n"
-                    return text
-                except Exception as pdf_error:
-                    # Log PDF-specific error to both logger and log.txt file
-                    error_msg = f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - Error processing PDF {filename}: {pdf_error}"
-                    logger.error(error_msg)
-                    
-                    # Write to log.txt file
-                    with open('log.txt', 'a', encoding='utf-8') as log_file:
-                        log_file.write(error_msg + "\n")
-                    
+            for job in jobs:
+                chunk_text, _ = await job
+                if chunk_text is None:
                     return None
-                
-            elif ext in ['.xls', '.xlsx']:
-                workbook = openpyxl.load_workbook(file_path, data_only=True)
-                sheet = workbook.active
-                text = ""
-                for row in sheet.iter_rows(values_only=True):
-                    row_text = [str(cell) if cell is not None else "" for cell in row]
-                    text += "\t".join(row_text) + "\n"
-                return text
-                
-            elif ext in ['.jpg', '.jpeg', '.png', '.bmp', '.tiff']:
-                # For images, we might want to implement OCR in the future
-                # For now, just return a placeholder
-                return f"Пользователь загрузил изображение файла: {filename}. Требуется OCR для извлечения текста."
-                
-            else:
-                return None
-                
-        except Exception as e:
-            # Log general error to both logger and log.txt file
-            error_msg = f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - Error extracting text from {filename}: {e}"
-            logger.error(error_msg)
-            
-            # Write to log.txt file
-            with open('log.txt', 'a', encoding='utf-8') as log_file:
-                log_file.write(error_msg + "\n")
-                
-            return None
+                parts.append(chunk_text)
+                if sum(len(part) for part in parts) >= EXTRACT_MAX_CHARS:
+                    break
+        finally:
+            for job in jobs:
+                job.cancel()
+        return join_within_budget(parts, EXTRACT_MAX_CHARS)
+    
+    async def extract_text_async(self, buffer, filename, mime_type=None):
+        """Parse a downloaded document in the worker process pool with a timeout; returns (format, text)."""
+        # In-memory uploads are sent as bytes, spooled ones by the temp file path
+        payload = buffer.getvalue() if isinstance(buffer, io.BytesIO) else buffer.name
+        
+        try:
+            # Every pool job is given what is left of EXTRACT_TIMEOUT, so a stuck one is stopped
+            if PDF_PARALLEL_PAGES > 0 and filename.lower().endswith('.pdf'):
+                return 'pdf', await self.extract_pdf_parallel(payload, filename)
+            return await self.run_extract_job(extract_text_job, payload, filename, mime_type, timeout=EXTRACT_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.error(f"Text extraction from {filename} did not finish within {EXTRACT_TIMEOUT} seconds")
+        except BrokenProcessPool:
+            log_error(f"Worker process crashed while extracting text from {filename}")
+        return 'unknown', None
+    
+    async def ocr_photo(self, buffer, file_key, user_id=None):
+        """Recognise a photo in the worker pool, reusing earlier results for the same image.
+        
+        The same photo sent again by the user within PHOTO_DEDUP_WINDOW seconds, even
+        recompressed, reuses the text of the first one.
+        """
+        ocr_key = "ocr:" + file_key
+        cached_text = await self.result_cache.get(ocr_key)
+        if cached_text:
+            return cached_text
+        
+        data = buffer.getvalue()
+        recognised = None
+        if PHOTO_DEDUP_WINDOW > 0:
+            fingerprint = await asyncio.to_thread(photo_fingerprint_job, data)
+            if fingerprint is not None:
+                image_hash, thumbnail = fingerprint
+                earlier = self.find_similar_photo(user_id, image_hash, thumbnail)
+                if earlier is not None:
+                    self.metrics.inc('duplicate_photos_total')
+                    logger.info(f"Photo of user {user_id} repeats an earlier one, reusing its text")
+                    return await asyncio.shield(earlier)
+                recognised = asyncio.get_running_loop().create_future()
+                self.recent_photos[(user_id, image_hash)] = (recognised, time.monotonic(), thumbnail)
+                while len(self.recent_photos) > PHOTO_DEDUP_MAX_ENTRIES:
+                    self.recent_photos.popitem(last=False)
+        
+        text = None
+        try:
+            # Leave a little headroom over the Tesseract timeout for preprocessing
+            text = await self.run_extract_job(ocr_image_job, data, timeout=OCR_TIMEOUT + 10)
+        except asyncio.TimeoutError:
+            logger.error(f"OCR did not finish within {OCR_TIMEOUT + 10} seconds")
+        except BrokenProcessPool:
+            log_error("Worker process crashed while recognising a photo")
+        finally:
+            if recognised is not None:
+                recognised.set_result(text)
+                # A failed recognition may succeed on the next shot
+                if not text:
+                    self.recent_photos.pop((user_id, image_hash), None)
+        
+        if text:
+            await self.result_cache.put([ocr_key], text)
+        return text
+    
+    def find_similar_photo(self, user_id, image_hash, thumbnail):
+        """Future with the text of a recent copy of the same photo of the user, or None."""
+        now = time.monotonic()
+        for key, (recognised, added, earlier_thumbnail) in list(self.recent_photos.items()):
+            if now - added > PHOTO_DEDUP_WINDOW:
+                del self.recent_photos[key]
+            elif (
+                key[0] == user_id and (key[1] ^ image_hash).bit_count() <= PHOTO_DEDUP_DISTANCE
+                and same_photo(earlier_thumbnail, thumbnail)
+            ):
+                return recognised
+        return None
     
-    def analyze_with_gigachat(self, text_content):
-        """Analyze the extracted text with GigaChat."""
+    async def analyze_with_gigachat(self, text_content, cache_keys=(), on_progress=None):
+        """Analyze the extracted text with GigaChat; returns (answer or error text, succeeded).
+        
+        A successful answer is stored in the result cache under every key in cache_keys.
+        With on_progress and GIGACHAT_STREAMING the answer is streamed and on_progress
+        is awaited with the text received so far.
+        """
+        # Recognise lab values locally to shrink the prompt
+        lab_values = parse_lab_values(text_content)
+        abnormal = [value for value in lab_values if value.status in ('low', 'high')]
+        logger.info(f"Parsed {len(lab_values)} lab values, {len(abnormal)} out of range")
+        
+        # Fully normal report: answer without the LLM when allowed
+        local_result = None
+        if (
+            LAB_SKIP_LLM_WHEN_NORMAL and lab_values and all(value.status == 'normal' for value in lab_values)
+            and not unchecked_result_lines(text_content)
+        ):
+            local_result = format_normal_report(lab_values)
+        
+        # A single common analyte is judged against the local reference ranges
+        single = find_single_analyte(lab_values, text_content) if LAB_LOCAL_SINGLE_ANALYTE else None
+        if single and local_result is None:
+            local_result = format_single_analyte_report(*single)
+        
+        if local_result is not None:
+            self.metrics.inc('analyses_total', mode='local')
+            if cache_keys:
+                await self.result_cache.put(cache_keys, local_result)
+            return local_result, True
+        
+        # Prepare the prompt for GigaChat; an oversized report is analysed in parts and merged
+        prompt = build_analysis_prompt(text_content, lab_values)
+        prompt_tokens = estimate_tokens(prompt)
+        if prompt_tokens <= PROMPT_TOKEN_BUDGET:
+            self.metrics.inc('analyses_total', mode='single')
+            result, succeeded = await self.ask_gigachat(prompt, on_progress)
+        else:
+            map_prompts, total_parts = build_map_prompts(text_content, lab_values)
+            logger.info(f"Prompt of ~{prompt_tokens} tokens exceeds the budget, analysing {len(map_prompts)} parts")
+            self.metrics.inc('analyses_total', mode='map_reduce')
+            result, succeeded = await self.ask_gigachat(build_reduce_prompt, on_progress, map_prompts)
+            if succeeded and total_parts > len(map_prompts):
+                # The conclusion must not look complete when part of the results was not read
+                result = add_note_before_disclaimer(result, (
+                    f"⚠️ <b>Разобраны только первые {len(map_prompts)} из {total_parts} частей отчёта</b>: "
+                    f"остальные результаты в разбор не вошли. Отправьте их отдельным файлом."
+                ))
+        
+        if succeeded and cache_keys:
+            await self.result_cache.put(cache_keys, result)
+            logger.info(f"Result cache stats: {self.result_cache.stats()}")
+        return result, succeeded
+    
+    async def ask_gigachat(self, prompt, on_progress=None, map_prompts=()):
+        """Send a prompt to GigaChat; returns (formatted answer or error text for the user, succeeded).
+        
+        With map_prompts, those are answered concurrently first and prompt is a callable
+        building the final (reduce) prompt from their answers.
+        """
         if not GIGACHAT_CREDENTIALS or not GIGACHAT_SCOPE:
             return (
                 "Ошибка: Не установлены учетные данные для GigaChat. "
                 "Пожалуйста, настройте переменные окружения GIGACHAT_CREDENTIALS и GIGACHAT_SCOPE."
-            )
+            ), False
         
         try:
-            # Prepare the prompt for GigaChat
-            prompt = (
-                f"Ты врач, который должен изучить результаты анализов пользователя и сообщить ему "
-                f"где и какие результаты отличаются от референсных, с чем это может быть связано "
-                f"и на что обратить внимание. Если требуется дополнительное исследование, "
-                f"то дать рекомендации к этим исследованиям. Структура ответа должна быть такая:"
-                F"Анализ, например Лютеинизирующий гормон (ЛГ), потом результат из исследования, потом Референсные значения"
-                f"потом комментарии насчет этого анализа от ИИ в роли врача эксперта, в норме анализы или нет, если нет, то с чем это может быть связано. И так по каждому анализу."
-                f"В конце, после всех анализов дай экспертное заключение"
-                f"Вот данные анализов:\n\n{text_content}\n\n"
-                f"Но в конце обязательно добавь, что пользователь не должен заниматься самолечением, "
-                f"рекомендации сформированы искусственным интеллектом и носят информационный, "
-                f"а не рекомендательный характер, и ему следует консультироваться со специалистами."
-            )
-            
-            # Create the chat message
-            chat = Chat(
-                messages=[
-                    Messages(role=MessagesRole.USER, content=prompt)
-                ]
-            )
+            if map_prompts:
+                with self.metrics.timer('stage_seconds', stage='llm_map'):
+                    partials = await asyncio.gather(*(self.complete(part) for part in map_prompts))
+                prompt = prompt(partials)
             
-            # Get response from GigaChat
-            response = giga.chat(chat)
+            # Get response from GigaChat without blocking the event loop
+            with self.metrics.timer('stage_seconds', stage='llm'):
+                content = await self.complete(prompt, on_progress)
             
             # Format the response with emojis and formatting
-            formatted_response = self.format_gigachat_response(response.choices[0].message.content)
-
-            return formatted_response
+            with self.metrics.timer('stage_seconds', stage='format'):
+                return format_gigachat_response(content), True
             
+        except CircuitOpenError:
+            self.metrics.inc('errors_total', stage='llm', reason='circuit_open')
+            logger.warning("GigaChat call skipped: circuit breaker is open")
+            return (
+                "GigaChat временно недоступен. "
+                "Пожалуйста, попробуйте снова через несколько минут."
+            ), False
+        except asyncio.TimeoutError:
+            self.metrics.inc('errors_total', stage='llm', reason='timeout')
+            logger.error(f"GigaChat did not answer within {GIGACHAT_TIMEOUT} seconds")
+            return (
+                "GigaChat не ответил вовремя. "
+                "Пожалуйста, попробуйте снова позже."
+            ), False
         except Exception as e:
+            self.metrics.inc('errors_total', stage='llm', reason='error')
             logger.error(f"Error calling GigaChat: {e}")
             return (
                 "Произошла ошибка при обращении к GigaChat. "
                 "Пожалуйста, попробуйте снова позже."
-            )
+            ), False
     
-    def format_gigachat_response(self, text):
-        """Format the GigaChat response with emojis and proper formatting."""
-        import re
-        
-        # Replace markdown headers with emojis
-        text = re.sub(r'^##\s+(.*)', r'🔬 **\1**', text, flags=re.MULTILINE)
-        text = re.sub(r'^###\s+(.*)', r'💊 \1', text, flags=re.MULTILINE)
-        text = re.sub(r'^####\s+(.*)', r'🧪 \1', text, flags=re.MULTILINE)
-        
-        # Find analysis names (typically followed by numbers/values) and underline them
-        # This pattern looks for capitalized words or letter combinations that are likely test names
-        text = re.sub(r'([A-Z][A-Za-zА-Яа-яЁё\s\-\(\)]+?)\s*(:\s*[0-9.,\-\s\w\(\)<>≥≤\[\]]+[^\n\r]*(?:\n|$))', r'___\1___\2', text)
-        
-        # Find the disclaimer text about self-treatment and make it italic
-        text = re.sub(
-            r'(Самолечение недопустимо[^\n\r.]*[.\n\r]*)',
-            r'*\1*',
-            text,
-            flags=re.IGNORECASE | re.MULTILINE
-        )
+    async def complete(self, prompt, on_progress=None):
+        """Return GigaChat's raw answer to one prompt, streamed when on_progress is given."""
+        from gigachat.models import Chat, Messages, MessagesRole
         
-        # Look for other variations of the disclaimer
-        text = re.sub(
-            r'((?:пользователь\s*не\s*должен|не\s*следует\s*заниматься)\s*(?:самолечением|лечением\s*без\s*врача)[^\n\r.]*[.\n\r]*)',
-            r'*\1*',
-            text,
-            flags=re.IGNORECASE | re.MULTILINE
+        chat = Chat(
+            messages=[
+                Messages(role=MessagesRole.USER, content=prompt)
+            ]
         )
-        
-        return text
-
+        if on_progress and GIGACHAT_STREAMING:
+            return await self.stream_gigachat(chat, on_progress)
+        response = await self.request_gigachat(chat)
+        return response.choices[0].message.content
+    
+    @asynccontextmanager
+    async def llm_slot(self):
+        """Wait for a free slot in the bounded GigaChat pool, tracking the queue depth."""
+        self.llm_queue_depth += 1
+        logger.info(f"GigaChat queue depth: {self.llm_queue_depth}")
+        waiting = True
+        try:
+            async with self.llm_semaphore:
+                self.llm_queue_depth -= 1
+                waiting = False
+                yield
+        finally:
+            if waiting:
+                self.llm_queue_depth -= 1
+    
+    async def request_gigachat(self, chat):
+        """Send a chat request through the bounded GigaChat pool with a timeout."""
+        async with self.llm_slot():
+            return await asyncio.wait_for(giga.achat(chat), timeout=GIGACHAT_TIMEOUT)
+    
+    async def stream_gigachat(self, chat, on_progress):
+        """Stream a chat response through the bounded GigaChat pool, reporting partial text."""
+        async with self.llm_slot():
+            return await asyncio.wait_for(self._consume_stream(chat, on_progress), timeout=GIGACHAT_TIMEOUT)
+    
+    async def _consume_stream(self, chat, on_progress):
+        started = time.monotonic()
+        parts = []
+        async for chunk in giga.astream(chat):
+            delta = chunk.choices[0].delta.content
+            if not delta:
+                continue
+            if not parts:
+                ttft = time.monotonic() - started
+                self.llm_ttft.append(ttft)
+                logger.info(f"GigaChat time to first token: {ttft:.2f} s")
+            parts.append(delta)
+            await on_progress(''.join(parts))
+        return ''.join(parts)
+    
+    async def post_init(self, application):
+        """Start background maintenance tasks once the event loop is running."""
+        self.background_tasks.append(asyncio.create_task(self.user_store.run_periodic_flush()))
+        self.background_tasks.append(asyncio.create_task(self.run_job_leases(application)))
+        if GIGACHAT_CREDENTIALS and GIGACHAT_SCOPE:
+            self.background_tasks.append(asyncio.create_task(giga.run_token_refresh()))
+        if METRICS_PORT:
+            self.metrics_server = await self.metrics.start_server()
+        if METRICS_DUMP_PATH:
+            self.background_tasks.append(asyncio.create_task(self.metrics.run_periodic_dump(METRICS_DUMP_PATH)))
+    
+    async def post_shutdown(self, application):
+        """Stop background tasks and persist buffered state."""
+        for task in self.background_tasks:
+            task.cancel()
+        await asyncio.gather(*self.background_tasks, return_exceptions=True)
+        await self.user_store.close()
+        if GIGACHAT_CREDENTIALS and GIGACHAT_SCOPE:
+            await giga.aclose()
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+            await self.metrics_server.wait_closed()
+        if METRICS_DUMP_PATH:
+            self.metrics.dump(METRICS_DUMP_PATH)
+        stop_error_log()
+        self.result_cache.close()
+        self.deduplicator.close()
+        self.jobs.close()
+        if self.extract_pool is not None:
+            self.extract_pool.shutdown(wait=False, cancel_futures=True)
+    
     def run_bot(self):
         """Start the bot."""
-        application = Application.builder().token(self.bot_token).build()
+        builder = (
+            Application.builder()
+            .token(self.bot_token)
+            .concurrent_updates(CONCURRENT_UPDATES)
+            .post_init(self.post_init)
+            .post_shutdown(self.post_shutdown)
+        )
+        if TELEGRAM_API_BASE_URL:
+            builder = builder.base_url(TELEGRAM_API_BASE_URL)
+        if TELEGRAM_API_BASE_FILE_URL:
+            builder = builder.base_file_url(TELEGRAM_API_BASE_FILE_URL)
+        application = builder.build()
 
         # Register handlers
+        application.add_handler(TypeHandler(Update, self.drop_duplicate_update), group=-1)
         application.add_handler(CommandHandler("start", self.start_command))
         application.add_handler(MessageHandler(filters.Document.ALL, self.handle_document))
         application.add_handler(MessageHandler(filters.PHOTO, self.handle_photo))
+        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_text))
 
         # Start the bot
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        if BOT_MODE == 'webhook':
+            logger.info(f"Starting webhook server on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
+            application.run_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=WEBHOOK_URL,
+                secret_token=WEBHOOK_SECRET_TOKEN,
+                allowed_updates=Update.ALL_TYPES
+            )
+        else:
+            application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == '__main__':
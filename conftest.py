@@ -0,0 +1,18 @@
+"""
+Shared pytest fixtures: keep the bot's on-disk state inside a temporary directory.
+"""
+
+import pytest
+
+import bot
+
+
+@pytest.fixture(autouse=True)
+def isolated_state(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("TELEGRAM_BOT_TOKEN", "test-token")
+    monkeypatch.setattr(bot, "USERS_DB_PATH", str(tmp_path / "users.db"))
+    monkeypatch.setattr(bot, "USERS_LEGACY_PATH", str(tmp_path / "users.txt"))
+    monkeypatch.setattr(bot, "RESULT_CACHE_PATH", str(tmp_path / "cache.db"))
+    monkeypatch.setattr(bot, "JOB_QUEUE_DB", str(tmp_path / "jobs.db"))
+    return tmp_path
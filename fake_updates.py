@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Offline load test for the webhook mode.
+
+Starts a fake Telegram Bot API server (so the bot's replies never leave the
+machine) and posts synthetic updates to the bot's webhook, reporting how fast
+they are accepted and answered.
+
+1. Start the load test; it starts the fake API and waits for the webhook:
+   python fake_updates.py --url http://127.0.0.1:8443/telegram --secret secret --updates 500
+2. Start the bot against the fake API:
+   BOT_MODE=webhook WEBHOOK_SECRET_TOKEN=secret WEBHOOK_URL=http://127.0.0.1:8443/telegram \\
+   TELEGRAM_API_BASE_URL=http://127.0.0.1:8081/bot \\
+   TELEGRAM_API_BASE_FILE_URL=http://127.0.0.1:8081/file/bot python bot.py
+
+Several bot processes can share the load behind a load balancer; set
+UPDATE_DEDUP_DB to the same file for all of them.
+"""
+
+import argparse
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+
+SAMPLE_REPORT = (
+    "Результаты анализа крови:\n"
+    "Гемоглобин: 120 г/л (норма: 120-140)\n"
+    "Глюкоза: 6.5 ммоль/л (норма: 3.3-5.5)\n"
+).encode("utf-8")
+
+
+class FakeBotAPI(BaseHTTPRequestHandler):
+    """Answers the Bot API methods the bot uses and counts the replies it sends."""
+
+    replies = 0
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, result):
+        body = json.dumps({"ok": True, "result": result}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        # File downloads: /file/bot<token>/<file_path>
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(SAMPLE_REPORT)))
+        self.end_headers()
+        self.wfile.write(SAMPLE_REPORT)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        method = self.path.rsplit("/", 1)[-1]
+        message = {
+            "message_id": 1,
+            "date": int(time.time()),
+            "chat": {"id": 1, "type": "private"},
+            "text": "ok",
+        }
+
+        if method == "getMe":
+            self.send_json({"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"})
+        elif method == "getFile":
+            self.send_json({"file_id": "doc", "file_unique_id": "doc", "file_size": len(SAMPLE_REPORT), "file_path": "documents/report.txt"})
+        elif method in ("sendMessage", "editMessageText"):
+            with FakeBotAPI.lock:
+                FakeBotAPI.replies += 1
+            self.send_json(message)
+        else:
+            # setWebhook, deleteWebhook, deleteMessage, ...
+            self.send_json(True)
+
+
+def start_fake_api(port):
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeBotAPI)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def make_update(update_id, user_id, kind):
+    """Synthetic update: a /start command or a document upload."""
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+    }
+    if kind == "start":
+        message["text"] = "/start"
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": 6}]
+    else:
+        message["document"] = {
+            "file_id": f"doc{update_id}",
+            "file_unique_id": f"doc{update_id}",
+            "file_name": "report.txt",
+            "file_size": len(SAMPLE_REPORT),
+        }
+    return {"update_id": update_id, "message": message}
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def wait_for_webhook(client, url, timeout):
+    """Wait until something answers HTTP on the webhook URL."""
+    deadline = time.perf_counter() + timeout
+    print(f"Waiting for the bot's webhook at {url}...")
+    while True:
+        try:
+            await client.get(url)
+            return
+        except httpx.TransportError:
+            if time.perf_counter() > deadline:
+                raise
+            await asyncio.sleep(0.5)
+
+
+async def post_updates(args):
+    headers = {"X-Telegram-Bot-Api-Secret-Token": args.secret} if args.secret else {}
+    latencies = []
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def post(client, update):
+        async with semaphore:
+            started = time.perf_counter()
+            response = await client.post(args.url, json=update, headers=headers)
+            latencies.append(time.perf_counter() - started)
+            response.raise_for_status()
+
+    updates = [
+        make_update(args.first_id + number, 1000 + number % args.users, "start" if number % 2 else "document")
+        for number in range(args.updates)
+    ]
+    # Redeliver some updates, as Telegram does when a webhook answers too slowly
+    duplicates = updates[:int(len(updates) * args.duplicates)]
+
+    async with httpx.AsyncClient(timeout=30) as client:
+        await wait_for_webhook(client, args.url, args.wait)
+
+    replies_before = FakeBotAPI.replies
+    started = time.perf_counter()
+    async with httpx.AsyncClient(timeout=30) as client:
+        await asyncio.gather(*(post(client, update) for update in updates + duplicates))
+    posted = time.perf_counter() - started
+
+    print(f"Posted {len(updates)} updates (+{len(duplicates)} duplicates) in {posted:.2f} s: "
+          f"{(len(updates) + len(duplicates)) / posted:.1f} updates/s")
+    print(f"Webhook latency p50={percentile(latencies, 0.5) * 1000:.1f} ms "
+          f"p95={percentile(latencies, 0.95) * 1000:.1f} ms p99={percentile(latencies, 0.99) * 1000:.1f} ms")
+
+    if not args.no_fake_api:
+        # Wait for the bot to finish answering
+        deadline = time.perf_counter() + args.wait
+        last = -1
+        while time.perf_counter() < deadline and FakeBotAPI.replies != last:
+            last = FakeBotAPI.replies
+            await asyncio.sleep(1)
+        replies = FakeBotAPI.replies - replies_before
+        total = time.perf_counter() - started
+        print(f"Bot sent or edited {replies} messages; end-to-end {len(updates) / total:.1f} updates/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8443/telegram", help="webhook URL of the bot")
+    parser.add_argument("--secret", default=None, help="webhook secret token")
+    parser.add_argument("--updates", type=int, default=200, help="number of distinct updates to post")
+    parser.add_argument("--users", type=int, default=20, help="number of distinct users")
+    parser.add_argument("--concurrency", type=int, default=20, help="parallel HTTP requests")
+    parser.add_argument("--duplicates", type=float, default=0.1, help="share of updates posted twice")
+    parser.add_argument("--first-id", type=int, default=int(time.time()), help="first update_id")
+    parser.add_argument("--fake-api-port", type=int, default=8081, help="port of the fake Bot API")
+    parser.add_argument("--no-fake-api", action="store_true", help="do not start the fake Bot API")
+    parser.add_argument("--wait", type=float, default=60, help="seconds to wait for the bot to start and to reply")
+    args = parser.parse_args()
+
+    if not args.no_fake_api:
+        start_fake_api(args.fake_api_port)
+        print(f"Fake Bot API listening on http://127.0.0.1:{args.fake_api_port}")
+    asyncio.run(post_updates(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+"""
+Offline end-to-end benchmark of the upload pipeline.
+
+Drives MedicalAnalysisBot.handle_document with synthetic Telegram updates for a
+corpus of generated PDF, DOCX and XLSX reports of several sizes. A fake GigaChat
+answers after a configurable latency, and nothing leaves the machine. Each
+simulated user uploads a report, waits for the answer and uploads the next one.
+
+Reports the latency percentiles per format, the throughput at the given number
+of concurrent users, the mean time per pipeline stage and the peak RSS:
+
+   python load_test.py --users 20 --uploads 5 --llm-latency 0.5
+   python load_test.py --formats pdf --sizes large --users 4 --json report.json
+
+The result cache is bypassed so every upload runs the whole pipeline.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+import openpyxl
+from docx import Document
+
+import bot
+
+LAB_TESTS = [
+    ("Hemoglobin", "g/L", 120, 160),
+    ("Glucose", "mmol/L", 3.3, 5.5),
+    ("Ferritin", "ng/mL", 20, 250),
+    ("Cholesterol", "mmol/L", 3.0, 5.2),
+    ("Leukocytes", "10^9/L", 4.0, 9.0),
+    ("ALT", "U/L", 0, 41),
+    ("TSH", "mIU/L", 0.4, 4.0),
+]
+
+# Size of the generated reports: PDF pages, DOCX table rows, XLSX rows
+CORPUS_SIZES = {
+    "small": {"pdf": 1, "docx": 20, "xlsx": 20},
+    "medium": {"pdf": 10, "docx": 200, "xlsx": 500},
+    "large": {"pdf": 50, "docx": 2000, "xlsx": 5000},
+}
+
+MIME_TYPES = {
+    "pdf": "application/pdf",
+    "docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
+
+
+def lab_rows(count, seed):
+    """count rows of (name, value, unit, reference range) with some values out of range."""
+    rng = random.Random(seed)
+    rows = []
+    for number in range(count):
+        name, unit, low, high = LAB_TESTS[number % len(LAB_TESTS)]
+        value = round(rng.uniform(low * 0.8, high * 1.2), 1)
+        rows.append((f"{name} {number // len(LAB_TESTS) + 1}", value, unit, f"{low}-{high}"))
+    return rows
+
+
+def make_pdf(pages, seed=0, lines_per_page=30):
+    """A PDF with lines_per_page lab result lines of Helvetica text per page."""
+    rows = iter(lab_rows(pages * lines_per_page, seed))
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for _ in range(pages):
+        lines = [" ".join(map(str, next(rows))) for _ in range(lines_per_page)]
+        stream = ("BT /F1 10 Tf 50 780 Td 14 TL " + " ".join(f"({line}) '" for line in lines) + " ET").encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % len(objects)
+        )
+        kids.append(b"%d 0 R" % len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(kids), len(kids))
+
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(out.tell())
+        out.write(b"%d 0 obj\n%s\nendobj\n" % (number, body))
+    xref = out.tell()
+    out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    for offset in offsets:
+        out.write(b"%010d 00000 n \n" % offset)
+    out.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref))
+    return out.getvalue()
+
+
+def make_docx(rows, seed=0):
+    """A DOCX with a heading paragraph and a table of rows lab results."""
+    document = Document()
+    document.add_paragraph("Laboratory report")
+    table = document.add_table(rows=0, cols=4)
+    for values in lab_rows(rows, seed):
+        cells = table.add_row().cells
+        for cell, value in zip(cells, values):
+            cell.text = str(value)
+    out = io.BytesIO()
+    document.save(out)
+    return out.getvalue()
+
+
+def make_xlsx(rows, seed=0):
+    """An XLSX lab-system export with rows results on one sheet."""
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet("Results")
+    sheet.append(["Test", "Result", "Unit", "Reference"])
+    for values in lab_rows(rows, seed):
+        sheet.append(list(values))
+    out = io.BytesIO()
+    workbook.save(out)
+    return out.getvalue()
+
+
+GENERATORS = {"pdf": make_pdf, "docx": make_docx, "xlsx": make_xlsx}
+
+
+def build_corpus(formats, sizes):
+    """List of (label, file name, bytes, MIME type) for every format and size."""
+    corpus = []
+    for size in sizes:
+        for file_format in formats:
+            data = GENERATORS[file_format](CORPUS_SIZES[size][file_format], seed=len(corpus))
+            corpus.append((f"{file_format}/{size}", f"report_{size}.{file_format}", data, MIME_TYPES[file_format]))
+    return corpus
+
+
+def percentile(samples, q):
+    """Nearest-rank percentile of samples (q in 0..100)."""
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered))) - 1))]
+
+
+class FakeGigaChat:
+    """Answers every prompt after latency seconds, streamed in chunks."""
+
+    retries = 0
+    state = "closed"
+    answer = "## Analysis\n\n- **Glucose:** above the reference range.\n\nSelf-treatment is not recommended."
+
+    def __init__(self, latency, chunks=10):
+        self.latency = latency
+        self.chunks = chunks
+        self.calls = 0
+
+    async def achat(self, chat):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=self.answer))])
+
+    async def astream(self, chat):
+        self.calls += 1
+        step = len(self.answer) // self.chunks + 1
+        for start in range(0, len(self.answer), step):
+            await asyncio.sleep(self.latency / self.chunks)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=self.answer[start:start + step]))])
+
+
+class FakeTelegramFile:
+    def __init__(self, data):
+        self.data = data
+        self.file_size = len(data)
+
+    async def download_to_memory(self, out):
+        out.write(self.data)
+
+
+class FakeMessage:
+    """Accepts the Telegram calls the bot makes on a message."""
+
+    def __init__(self, message_id=0, document=None):
+        self.message_id = message_id
+        self.document = document
+        self.photo = None
+        self.media_group_id = None
+        self.text = None
+
+    async def reply_text(self, text, **kwargs):
+        return FakeMessage()
+
+    async def edit_text(self, text, **kwargs):
+        pass
+
+    async def delete(self):
+        pass
+
+
+@contextlib.contextmanager
+def patched(target, **values):
+    """Temporarily replace attributes of target."""
+    missing = object()
+    saved = {name: getattr(target, name, missing) for name in values}
+    for name, value in values.items():
+        setattr(target, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is missing:
+                delattr(target, name)
+            else:
+                setattr(target, name, value)
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process and of its finished worker processes, in MB."""
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    return own / 1e6, children / 1e6
+
+
+async def drive(medical_bot, corpus, users, uploads_per_user):
+    """Run the closed-loop users; returns {label: [latency, ...]}."""
+    files = {str(number): data for number, (_, _, data, _) in enumerate(corpus)}
+    done = {}
+    original = medical_bot.process_uploads
+
+    async def process_and_signal(items, job_id=None):
+        try:
+            await original(items, job_id)
+        finally:
+            for update, _ in items:
+                done[update.update_id].set()
+
+    medical_bot.process_uploads = process_and_signal
+
+    async def get_file(file_id):
+        return FakeTelegramFile(files[file_id])
+
+    context = SimpleNamespace(bot=SimpleNamespace(get_file=get_file))
+    latencies = {}
+    counter = iter(range(1, 10 ** 9))
+
+    async def user(user_id):
+        for upload in range(uploads_per_user):
+            number = (user_id + upload) % len(corpus)
+            label, file_name, data, mime_type = corpus[number]
+            update_id = next(counter)
+            document = SimpleNamespace(file_id=str(number), file_name=file_name, file_size=len(data), mime_type=mime_type)
+            update = SimpleNamespace(
+                update_id=update_id,
+                message=FakeMessage(update_id, document),
+                effective_chat=SimpleNamespace(id=user_id),
+                effective_user=SimpleNamespace(id=user_id, first_name="Load", last_name="Test", username=None),
+                to_dict=lambda update_id=update_id: {"update_id": update_id},
+            )
+            done[update_id] = asyncio.Event()
+            started = time.perf_counter()
+            await medical_bot.handle_document(update, context)
+            await done[update_id].wait()
+            latencies.setdefault(label, []).append(time.perf_counter() - started)
+
+    await asyncio.gather(*(user(user_id) for user_id in range(users)))
+    return latencies
+
+
+def run_load(corpus, users=10, uploads_per_user=5, llm_latency=0.5, streaming=True, workers=None, max_active=None):
+    """Run the benchmark in a temporary directory and return the report as a dict."""
+    fake = FakeGigaChat(llm_latency)
+    workdir = tempfile.TemporaryDirectory(prefix="tgbot_load_")
+    settings = dict(
+        giga=fake,
+        GIGACHAT_CREDENTIALS="load-test",
+        GIGACHAT_SCOPE="load-test",
+        GIGACHAT_STREAMING=streaming,
+        STREAM_EDIT_INTERVAL=0.2,
+        UPLOAD_BATCH_WINDOW=0,
+        USER_RATE_PER_MINUTE=10 ** 6,
+        USER_RATE_BURST=10 ** 6,
+        LAB_SKIP_LLM_WHEN_NORMAL=False,
+        USERS_DB_PATH=os.path.join(workdir.name, "users.db"),
+        USERS_LEGACY_PATH=os.path.join(workdir.name, "users.txt"),
+        RESULT_CACHE_PATH=os.path.join(workdir.name, "cache.db"),
+        JOB_QUEUE_DB=os.path.join(workdir.name, "jobs.db"),
+    )
+    if workers:
+        settings["EXTRACT_WORKERS"] = workers
+    if max_active:
+        settings["SCHEDULER_MAX_ACTIVE"] = max_active
+
+    with workdir, patched(bot, **settings):
+        os.environ.setdefault("TELEGRAM_BOT_TOKEN", "load-test")
+        medical_bot = bot.MedicalAnalysisBot()
+
+        async def no_cache(key):
+            return None
+
+        medical_bot.result_cache.get = no_cache
+
+        async def run():
+            # Start the worker pool outside the measured time
+            await medical_bot.run_extract_job(bot.extract_text_job, b"warm up", "warmup.txt")
+            started = time.perf_counter()
+            latencies = await drive(medical_bot, corpus, users, uploads_per_user)
+            elapsed = time.perf_counter() - started
+            await medical_bot.user_store.close()
+            return latencies, elapsed
+
+        try:
+            latencies, elapsed = asyncio.run(run())
+        finally:
+            medical_bot.result_cache.close()
+            medical_bot.deduplicator.close()
+            medical_bot.jobs.close()
+            if medical_bot.extract_pool is not None:
+                medical_bot.extract_pool.shutdown(wait=True)
+        snapshot = medical_bot.metrics.snapshot()
+
+    everything = [latency for samples in latencies.values() for latency in samples]
+    stages = {}
+    for entry in snapshot["histograms"].get("stage_seconds", []):
+        stage = entry["labels"]["stage"]
+        if "format" in entry["labels"]:
+            stage += "/" + entry["labels"]["format"]
+        stages[stage] = {"count": entry["count"], "mean": entry["sum"] / entry["count"]}
+    own_rss, children_rss = peak_rss_mb()
+
+    def summary(samples):
+        return {
+            "count": len(samples),
+            "p50": percentile(samples, 50),
+            "p95": percentile(samples, 95),
+            "p99": percentile(samples, 99),
+        }
+
+    return {
+        "users": users,
+        "uploads": len(everything),
+        "llm_latency": llm_latency,
+        "elapsed": elapsed,
+        "throughput": len(everything) / elapsed if elapsed else 0.0,
+        "latency": summary(everything),
+        "latency_by_file": {label: summary(samples) for label, samples in sorted(latencies.items())},
+        "stages": dict(sorted(stages.items())),
+        "errors": snapshot["counters"].get("errors_total", []),
+        "llm_calls": fake.calls,
+        "peak_rss_mb": own_rss,
+        "peak_worker_rss_mb": children_rss,
+    }
+
+
+def format_report(report):
+    lines = [
+        f"{report['uploads']} uploads by {report['users']} concurrent users in {report['elapsed']:.2f} s "
+        f"(fake GigaChat latency {report['llm_latency']} s)",
+        f"Throughput: {report['throughput']:.2f} uploads/s",
+        "",
+        f"{'file':<16}{'count':>7}{'p50 s':>10}{'p95 s':>10}{'p99 s':>10}",
+    ]
+    rows = list(report["latency_by_file"].items()) + [("all", report["latency"])]
+    for label, stats in rows:
+        lines.append(f"{label:<16}{stats['count']:>7}{stats['p50']:>10.3f}{stats['p95']:>10.3f}{stats['p99']:>10.3f}")
+    lines += ["", f"{'stage':<22}{'count':>7}{'mean s':>10}"]
+    for stage, stats in report["stages"].items():
+        lines.append(f"{stage:<22}{stats['count']:>7}{stats['mean']:>10.3f}")
+    lines += [
+        "",
+        f"Errors: {sum(entry['value'] for entry in report['errors'])}",
+        f"Peak RSS: {report['peak_rss_mb']:.0f} MB (bot), {report['peak_worker_rss_mb']:.0f} MB (largest worker)",
+    ]
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10, help="concurrent simulated users")
+    parser.add_argument("--uploads", type=int, default=5, help="uploads per user")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="seconds the fake GigaChat takes per answer")
+    parser.add_argument("--no-stream", action="store_true", help="request whole answers instead of streaming")
+    parser.add_argument("--formats", default="pdf,docx,xlsx", help="comma-separated formats of the corpus")
+    parser.add_argument("--sizes", default="small,medium,large", help="comma-separated sizes of the corpus")
+    parser.add_argument("--workers", type=int, default=None, help="extraction worker processes")
+    parser.add_argument("--max-active", type=int, default=None, help="analyses running at the same time")
+    parser.add_argument("--json", default=None, help="also write the report to this JSON file")
+    args = parser.parse_args()
+
+    corpus = build_corpus(args.formats.split(","), args.sizes.split(","))
+    report = run_load(
+        corpus,
+        users=args.users,
+        uploads_per_user=args.uploads,
+        llm_latency=args.llm_latency,
+        streaming=not args.no_stream,
+        workers=args.workers,
+        max_active=args.max_active,
+    )
+    print(format_report(report))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as report_file:
+            json.dump(report, report_file, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,18 @@ if ! command -v python3 &> /dev/null; then
     apt-get update && apt-get install -y python3 python3-pip
 fi
 
+# Проверяем наличие Tesseract OCR для распознавания фотографий
+if ! command -v tesseract &> /dev/null; then
+    echo "Tesseract не найден. Устанавливаем..."
+    apt-get update && apt-get install -y tesseract-ocr tesseract-ocr-rus
+fi
+
+# Проверяем наличие antiword для старых документов Word (.doc)
+if ! command -v antiword &> /dev/null; then
+    echo "antiword не найден. Устанавливаем..."
+    apt-get update && apt-get install -y antiword
+fi
+
 # Устанавливаем зависимости
 echo "Устанавливаем зависимости..."
 pip3 install -r requirements.txt
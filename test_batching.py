@@ -0,0 +1,62 @@
+"""
+Tests for grouping albums and successive uploads into one analysis.
+"""
+
+import asyncio
+from types import SimpleNamespace
+
+import bot
+
+
+def make_update(message_id, user_id=1, media_group_id=None):
+    return SimpleNamespace(
+        message=SimpleNamespace(message_id=message_id, media_group_id=media_group_id),
+        effective_chat=SimpleNamespace(id=user_id),
+        effective_user=SimpleNamespace(id=user_id),
+    )
+
+
+def collect_batches(updates, **windows):
+    batches = []
+
+    async def on_batch(items):
+        batches.append([update.message.message_id for update, _ in items])
+
+    async def run():
+        batcher = bot.UploadBatcher(on_batch, **windows)
+        for delay, update in updates:
+            await asyncio.sleep(delay)
+            await batcher.add(update, None)
+        await asyncio.sleep(0.2)
+        await asyncio.gather(*batcher.tasks)
+
+    asyncio.run(run())
+    return batches
+
+
+def test_album_parts_are_analysed_together_in_order():
+    batches = collect_batches(
+        [(0, make_update(3, media_group_id="album")), (0, make_update(1, media_group_id="album")),
+         (0.02, make_update(2, media_group_id="album")), (0, make_update(10, user_id=2))],
+        media_group_window=0.05, upload_window=0,
+    )
+
+    assert sorted(batches) == [[1, 2, 3], [10]]
+
+
+def test_successive_uploads_of_one_user_are_grouped():
+    batches = collect_batches(
+        [(0, make_update(1)), (0.01, make_update(2)), (0, make_update(5, user_id=2)), (0.2, make_update(3))],
+        media_group_window=0.05, upload_window=0.05,
+    )
+
+    assert sorted(batches) == [[1, 2], [3], [5]]
+
+
+def test_batch_is_flushed_at_max_files():
+    batches = collect_batches(
+        [(0, make_update(number, media_group_id="album")) for number in range(5)],
+        media_group_window=10, upload_window=0, max_files=5,
+    )
+
+    assert batches == [[0, 1, 2, 3, 4]]
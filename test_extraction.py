@@ -0,0 +1,315 @@
+"""
+Tests for the in-memory download and text extraction pipeline.
+"""
+
+import asyncio
+import io
+import os
+import struct
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+import openpyxl
+from docx import Document
+
+import bot
+
+
+class FakeTelegramFile:
+    """Minimal stand-in for telegram.File that writes fixed bytes."""
+
+    def __init__(self, data):
+        self.data = data
+        self.file_size = len(data)
+
+    async def download_to_memory(self, out):
+        out.write(self.data)
+
+
+def test_small_files_stay_in_memory(monkeypatch):
+    monkeypatch.setattr(bot, "DOWNLOAD_SPILL_THRESHOLD", 1024)
+
+    small = asyncio.run(bot.download_to_memory(FakeTelegramFile(b"x" * 10)))
+    large = asyncio.run(bot.download_to_memory(FakeTelegramFile(b"x" * 4096)))
+
+    assert isinstance(small, io.BytesIO)
+    assert not isinstance(large, io.BytesIO)
+    assert large.read() == b"x" * 4096
+    assert bot.file_cache_key(small) == bot.file_cache_key(b"x" * 10)
+    small.close()
+    large.close()
+
+
+def test_extract_docx_from_memory():
+    document = Document()
+    document.add_paragraph("Гемоглобин: 120 г/л (норма: 120-140)")
+    buffer = io.BytesIO()
+    document.save(buffer)
+
+    text = bot.extract_text_from_document(buffer, "analysis.docx")
+
+    assert "Гемоглобин: 120 г/л" in text
+
+
+def test_docx_tables_are_extracted_in_document_order():
+    document = Document()
+    document.add_paragraph("Общий анализ крови")
+    table = document.add_table(rows=2, cols=3)
+    for row, values in zip(table.rows, [("Показатель", "Результат", "Норма"), ("Гемоглобин", "120", "120-140")]):
+        for cell, value in zip(row.cells, values):
+            cell.text = value
+    document.add_paragraph("Врач: Иванова")
+    buffer = io.BytesIO()
+    document.save(buffer)
+
+    text = bot.extract_text_from_document(buffer, "analysis.docx")
+
+    assert text.split("\n") == [
+        "Общий анализ крови", "Показатель\tРезультат\tНорма", "Гемоглобин\t120\t120-140", "Врач: Иванова",
+    ]
+
+
+def test_format_is_detected_by_magic_bytes():
+    workbook = openpyxl.Workbook()
+    workbook.active.append(["Глюкоза", "6.5"])
+    xlsx = io.BytesIO()
+    workbook.save(xlsx)
+    pdf = io.BytesIO(make_text_pdf(["glucose 5.5"]))
+
+    # Telegram may send documents without a file name or with a wrong extension
+    assert bot.find_extractor(xlsx, None).name == "xlsx"
+    assert bot.find_extractor(xlsx, "analysis.docx").name == "xlsx"
+    assert bot.find_extractor(pdf, "scan.jpg").name == "pdf"
+    assert bot.find_extractor(io.BytesIO(b"plain"), None, "text/plain").name == "text"
+    assert bot.find_extractor(io.BytesIO(b"plain"), "notes.odt") is None
+
+
+def test_legacy_doc_text_without_converter(monkeypatch):
+    monkeypatch.setattr(bot, "DOC_CONVERTER_CMD", "missing-antiword")
+    data = bot.OLE_SIGNATURE + b"\0" * 24 + "WordDocument".encode("utf-16-le") + b"\0" * 16
+    data += "Гемоглобин 120 г/л".encode("utf-16-le") + b"\xff\xff"
+
+    text = bot.extract_text_from_document(io.BytesIO(data), "old.doc")
+
+    assert "Гемоглобин 120 г/л" in text
+
+
+NO_ENTRY = 0xFFFFFFFF
+
+
+def make_ole(entries, body=b""):
+    """Minimal OLE2 file: one FAT sector and one directory sector of (name, type, child, right) entries."""
+    header = bytearray(512)
+    header[:8] = bot.OLE_SIGNATURE
+    struct.pack_into("<HHHHH", header, 24, 0x3E, 3, 0xFFFE, 9, 6)
+    struct.pack_into("<IIII", header, 44, 1, 1, 0, 4096)
+    struct.pack_into("<II", header, 60, 0xFFFFFFFE, 0)
+    struct.pack_into("<II", header, 68, 0xFFFFFFFE, 0)
+    struct.pack_into("<109I", header, 76, 0, *[NO_ENTRY] * 108)
+    fat = struct.pack("<128I", 0xFFFFFFFD, 0xFFFFFFFE, *[NO_ENTRY] * 126)
+    directory = bytearray(512)
+    for index, (name, kind, child, right) in enumerate(entries):
+        encoded = (name + "\0").encode("utf-16-le")
+        directory[index * 128:index * 128 + len(encoded)] = encoded
+        struct.pack_into("<HBBIII", directory, index * 128 + 64, len(encoded), kind, 1, NO_ENTRY, right, child)
+    return bytes(header) + fat + bytes(directory) + body
+
+
+def test_ole_files_are_told_apart_by_root_entries():
+    # A Word file with an embedded Excel table and the word "Book" in its text
+    doc = make_ole(
+        [("Root Entry", 5, 1, NO_ENTRY), ("WordDocument", 2, NO_ENTRY, 2), ("ObjectPool", 1, 3, NO_ENTRY), ("Workbook", 2, NO_ENTRY, NO_ENTRY)],
+        "Book".encode("utf-16-le"),
+    )
+    xls = make_ole([("Root Entry", 5, 1, NO_ENTRY), ("Workbook", 2, NO_ENTRY, NO_ENTRY)])
+
+    assert bot.ole_root_entries(doc) == {"WordDocument", "ObjectPool"}
+    assert bot.find_extractor(io.BytesIO(doc), "report.doc").name == "doc"
+    assert bot.find_extractor(io.BytesIO(doc), None).name == "doc"
+    assert bot.find_extractor(io.BytesIO(xls), None).name == "xls"
+    # A damaged directory falls back to the declared type
+    assert bot.find_extractor(io.BytesIO(bot.OLE_SIGNATURE + b"\0" * 40), "old.doc").name == "doc"
+
+
+def test_extract_xlsx_from_memory():
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.append(["Глюкоза", "6.5", "3.3-5.5"])
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+
+    text = bot.extract_text_from_document(buffer, "analysis.xlsx")
+
+    assert "Глюкоза\t6.5\t3.3-5.5" in text
+
+
+def test_xlsx_reads_all_sheets_without_empty_rows_and_columns():
+    workbook = openpyxl.Workbook()
+    blood = workbook.active
+    blood.title = "Кровь"
+    blood.append([None, "Гемоглобин", None, 120])
+    blood.append([])
+    blood.append([None, "СОЭ", None, 12])
+    urine = workbook.create_sheet("Моча")
+    urine.append(["Белок", "отр."])
+    workbook.create_sheet("Пусто")
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+
+    text = bot.extract_text_from_document(buffer, "analysis.xlsx")
+
+    assert text.split("\n") == [
+        "=== Лист: Кровь ===", "Гемоглобин\t120", "СОЭ\t12", "=== Лист: Моча ===", "Белок\tотр.",
+    ]
+
+
+def test_xlsx_rows_and_columns_are_capped(monkeypatch):
+    monkeypatch.setattr(bot, "SPREADSHEET_MAX_ROWS", 50)
+    monkeypatch.setattr(bot, "SPREADSHEET_MAX_COLS", 2)
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet("Экспорт")
+    for number in range(5000):
+        sheet.append([f"Показатель {number}", number, "ммоль/л", "3.3-5.5"])
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+
+    lines = bot.extract_text_from_document(buffer, "export.xlsx").split("\n")
+
+    assert len(lines) == 51
+    assert lines[1] == "Показатель 0\t0"
+    assert lines[-1] == "Показатель 49\t49"
+
+
+def test_extract_txt_from_memory():
+    buffer = io.BytesIO("Глюкоза: 6.5".encode("utf-8"))
+
+    assert bot.extract_text_from_document(buffer, "analysis.txt") == "Глюкоза: 6.5"
+
+
+def test_extraction_runs_in_worker_pool(monkeypatch):
+    monkeypatch.setattr(bot, "EXTRACT_WORKERS", 1)
+    medical_bot = bot.MedicalAnalysisBot()
+    buffer = io.BytesIO("Глюкоза: 6.5".encode("utf-8"))
+
+    try:
+        file_format, text = asyncio.run(medical_bot.extract_text_async(buffer, "analysis.txt"))
+    finally:
+        medical_bot.extract_pool.shutdown()
+
+    assert (file_format, text) == ("text", "Глюкоза: 6.5")
+
+
+def test_upload_format_is_sniffed_in_the_worker(monkeypatch):
+    monkeypatch.setattr(bot, "EXTRACT_WORKERS", 1)
+    medical_bot = bot.MedicalAnalysisBot()
+
+    def no_sniffing_on_the_event_loop(*args):
+        raise AssertionError("find_extractor called in the bot process")
+
+    # The spawned worker imports its own copy of the module
+    monkeypatch.setattr(bot, "find_extractor", no_sniffing_on_the_event_loop)
+    buffer = io.BytesIO("Глюкоза: 6.5".encode("utf-8"))
+
+    try:
+        text = asyncio.run(medical_bot.extract_upload("analysis.txt", buffer, False, "text/plain", "key"))
+    finally:
+        medical_bot.extract_pool.shutdown()
+
+    assert text == "Глюкоза: 6.5"
+    assert medical_bot.metrics.counters[("documents_total", (("format", "text"),))] == 1
+
+
+def test_stuck_job_is_stopped_by_restarting_the_pool(monkeypatch):
+    monkeypatch.setattr(bot, "EXTRACT_WORKERS", 1)
+    medical_bot = bot.MedicalAnalysisBot()
+
+    async def run():
+        try:
+            await medical_bot.run_extract_job(time.sleep, 60, timeout=0.5)
+        except asyncio.TimeoutError:
+            pass
+        else:
+            raise AssertionError("the job was not timed out")
+        # With one worker this would wait for the stuck job if it were still running
+        return await asyncio.wait_for(medical_bot.run_extract_job(len, "abc"), timeout=30)
+
+    try:
+        assert asyncio.run(run()) == 3
+    finally:
+        medical_bot.extract_pool.shutdown()
+
+    assert medical_bot.metrics.counters[("extract_pool_restarts_total", (("reason", "timeout"),))] == 1
+
+
+def test_crashed_worker_pool_is_replaced(monkeypatch):
+    monkeypatch.setattr(bot, "EXTRACT_WORKERS", 1)
+    medical_bot = bot.MedicalAnalysisBot()
+
+    async def run():
+        try:
+            await medical_bot.run_extract_job(os._exit, 1)
+        except BrokenProcessPool:
+            pass
+        else:
+            raise AssertionError("the crash was not reported")
+        return await medical_bot.run_extract_job(len, "abc")
+
+    try:
+        assert asyncio.run(run()) == 3
+    finally:
+        medical_bot.extract_pool.shutdown()
+
+    # The crashing job is tried once more in a new pool before giving up
+    assert medical_bot.metrics.counters[("extract_pool_restarts_total", (("reason", "broken"),))] == 2
+
+
+def make_text_pdf(page_texts):
+    """Build a minimal PDF with one line of Helvetica text per page."""
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for text in page_texts:
+        stream = f"BT /F1 12 Tf 50 700 Td ({text}) Tj ET".encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % len(objects)
+        )
+        kids.append(b"%d 0 R" % len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(kids), len(kids))
+
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(out.tell())
+        out.write(b"%d 0 obj\n%s\nendobj\n" % (number, body))
+    xref = out.tell()
+    out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    for offset in offsets:
+        out.write(b"%010d 00000 n \n" % offset)
+    out.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref))
+    return out.getvalue()
+
+
+def test_pdf_extraction_stops_at_char_budget(monkeypatch):
+    monkeypatch.setattr(bot, "EXTRACT_MAX_CHARS", 25)
+    pdf = make_text_pdf([f"Page {number} glucose 5.5" for number in range(20)])
+
+    text = bot.extract_text_from_document(io.BytesIO(pdf), "report.pdf")
+
+    assert text.startswith("Page 0 glucose 5.5")
+    assert len(text) == 25
+
+
+def test_pdf_pages_are_extracted_in_parallel_chunks(monkeypatch):
+    monkeypatch.setattr(bot, "EXTRACT_WORKERS", 2)
+    monkeypatch.setattr(bot, "PDF_PARALLEL_PAGES", 3)
+    pdf = make_text_pdf([f"Page {number}" for number in range(10)])
+    medical_bot = bot.MedicalAnalysisBot()
+
+    try:
+        _, text = asyncio.run(medical_bot.extract_text_async(io.BytesIO(pdf), "report.pdf"))
+    finally:
+        medical_bot.extract_pool.shutdown()
+
+    assert text.split("\n") == [f"Page {number}" for number in range(10)]
@@ -1,41 +1,35 @@
-#!/usr/bin/env python3
-# Test script to verify the formatting functionality
-
-import re
-
-def format_gigachat_response(text):
-    """Format the GigaChat response with emojis and proper formatting."""
-    
-    # Replace markdown headers with emojis
-    text = re.sub(r'^##\s+(.*)', r'🔬 **\1**', text, flags=re.MULTILINE)
-    text = re.sub(r'^###\s+(.*)', r'💊 \1', text, flags=re.MULTILINE)
-    text = re.sub(r'^####\s+(.*)', r'🧪 \1', text, flags=re.MULTILINE)
-    
-    # Find analysis names (typically followed by numbers/values) and underline them
-    # Use a more specific pattern to match medical test names followed by values
-    # This pattern targets uppercase words that likely represent test names
-    text = re.sub(r'([А-ЯA-Z][А-Яа-яA-Za-z\s\-\(\)]*?[А-ЯA-Zа-яa-z])\s*:(?=\s*[0-9.,\-\s\w\(\)<>≥≤\[\]])', r'___\1___:', text, flags=re.MULTILINE)
-    
-    # Find the disclaimer text about self-treatment and make it italic
-    text = re.sub(
-        r'(Самолечение недопустимо[^\n\r.]*[.\n\r]*)',
-        r'*\1*',
-        text,
-        flags=re.IGNORECASE | re.MULTILINE
-    )
-    
-    # Look for other variations of the disclaimer
-    text = re.sub(
-        r'((?:пользователь\s*не\s*должен|не\s*следует\s*заниматься)\s*(?:самолечением|лечением\s*без\s*врача)[^\n\r.]*[.\n\r]*)',
-        r'*\1*',
-        text,
-        flags=re.IGNORECASE | re.MULTILINE
-    )
-    
-    return text
-
-# Test example
-test_text = """## Анализ результатов лабораторных исследований
+"""
+Tests for the Telegram HTML formatting of GigaChat responses.
+"""
+
+import time
+from html.parser import HTMLParser
+
+import bot
+
+
+class TagChecker(HTMLParser):
+    """Fails on tags that are closed out of order or left open."""
+
+    def __init__(self):
+        super().__init__()
+        self.open_tags = []
+
+    def handle_starttag(self, tag, attrs):
+        self.open_tags.append(tag)
+
+    def handle_endtag(self, tag):
+        assert self.open_tags and self.open_tags.pop() == tag, f"</{tag}> closes another tag"
+
+
+def assert_well_formed(formatted):
+    checker = TagChecker()
+    checker.feed(formatted)
+    checker.close()
+    assert checker.open_tags == []
+
+
+SAMPLE_RESPONSE = """## Анализ результатов лабораторных исследований
 
 ### Общие комментарии
 
@@ -67,8 +61,65 @@ test_text = """## Анализ результатов лабораторных 
 
 Самолечение недопустимо, решение о лечении принимается исключительно врачом на основании полного обследования и клинических рекомендаций."""
 
-formatted_text = format_gigachat_response(test_text)
-print("Original text:")
-print(test_text)
-print("\nFormatted text:")
-print(formatted_text)
\ No newline at end of file
+
+def test_headings_get_icons():
+    formatted = bot.format_gigachat_response(SAMPLE_RESPONSE)
+
+    assert formatted.startswith("🔬 <b>Анализ результатов лабораторных исследований</b>")
+    assert "💊 Гормональный профиль" in formatted
+    assert "🧪 Эстрадиол (E2)" in formatted
+
+
+def test_bold_test_names_and_disclaimer():
+    formatted = bot.format_gigachat_response(SAMPLE_RESPONSE)
+
+    assert "- <b>Результат:</b> 68,7 пг/мл" in formatted
+    assert "<u>Фолликулиновая фаза</u>: 12,4–233 пг/мл" in formatted
+    assert "<i>Самолечение недопустимо, решение о лечении принимается исключительно врачом" in formatted
+    assert formatted.count("<i>") == formatted.count("</i>") == 1
+
+
+def test_html_is_escaped():
+    formatted = bot.format_gigachat_response("Постменопауза: <138 пг/мл & выше\n## <script>")
+
+    assert "<u>Постменопауза</u>: &lt;138 пг/мл &amp; выше" in formatted
+    assert "🔬 <b>&lt;script&gt;</b>" in formatted
+
+
+def test_user_not_self_treating_variant_is_italic():
+    formatted = bot.format_gigachat_response("Пользователь не должен заниматься самолечением. Спасибо.")
+
+    assert formatted == "<i>Пользователь не должен заниматься самолечением.</i> Спасибо."
+
+
+def test_disclaimer_never_crosses_other_tags():
+    lines = [
+        "Самолечение недопустимо: обратитесь к врачу.",
+        "**Самолечение недопустимо**. Обратитесь к врачу.",
+        "Важно: не следует заниматься самолечением, **обратитесь** к врачу.",
+        "- **Совет:** самолечение недопустимо, **решение за врачом**",
+    ]
+    formatted = [bot.format_response_line(line) for line in lines]
+
+    for line in formatted:
+        assert_well_formed(line)
+    assert formatted[0] == "<i>Самолечение недопустимо: обратитесь к врачу.</i>"
+    assert formatted[1] == "<i><b>Самолечение недопустимо</b>.</i> Обратитесь к врачу."
+    assert formatted[2].startswith("<u>Важно</u>: <i>не следует заниматься самолечением, <b>обратитесь</b>")
+    assert_well_formed(bot.format_gigachat_response(SAMPLE_RESPONSE))
+
+
+def test_no_catastrophic_backtracking():
+    # Long lines that almost match a test name or a disclaimer must stay linear
+    adversarial = "\n".join([
+        "Анализ" + " крови" * 20000,
+        "А" + "(" * 50000 + ":",
+        "**" + "*" * 50000,
+        "не следует" + " " * 50000 + "заниматься",
+        "Ab " * 20000,
+    ])
+
+    start = time.perf_counter()
+    bot.format_gigachat_response(adversarial)
+
+    assert time.perf_counter() - start < 1.0
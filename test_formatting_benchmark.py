@@ -0,0 +1,43 @@
+"""
+Benchmarks for the response formatter on large synthetic GigaChat answers.
+
+Run with: python -m pytest test_formatting_benchmark.py --benchmark-only
+"""
+
+import pytest
+
+import bot
+from test_formatting import SAMPLE_RESPONSE
+
+pytest.importorskip("pytest_benchmark")
+
+
+def synthetic_response(sections):
+    """A long answer built from many analysis sections."""
+    section = (
+        "### Анализ {n}\n"
+        "- **Результат:** {n},5 ммоль/л\n"
+        "- **Референсные значения:** 3,3–5,5 ммоль/л\n"
+        "Глюкоза натощак: {n},5 ммоль/л, выше нормы < 6,1\n"
+        "Комментарий: значение требует контроля и консультации эндокринолога.\n"
+    )
+    body = "\n".join(section.format(n=number) for number in range(sections))
+    return "## Анализ результатов\n\n" + body + "\nСамолечение недопустимо, обратитесь к врачу."
+
+
+@pytest.mark.parametrize("sections", [10, 100, 1000])
+def test_benchmark_synthetic_response(benchmark, sections):
+    text = synthetic_response(sections)
+
+    formatted = benchmark(bot.format_gigachat_response, text)
+
+    assert formatted.count("<i>") == 1
+
+
+def test_benchmark_sample_response(benchmark):
+    benchmark(bot.format_gigachat_response, SAMPLE_RESPONSE * 50)
+
+
+def test_benchmark_backtracking_input(benchmark):
+    # Quadratic for the previous lazy test-name pattern (~6 s for 8000 repeats)
+    benchmark(bot.format_gigachat_response, "Ab " * 8000)
@@ -0,0 +1,173 @@
+"""
+Tests for the durable job queue and resuming unfinished analyses after a restart.
+"""
+
+import asyncio
+from types import SimpleNamespace
+
+from telegram import Update
+
+import bot
+
+
+def make_update_data(update_id=10, chat_id=42, file_id="file-1"):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Иван"},
+            "document": {"file_id": file_id, "file_unique_id": file_id, "file_name": "analysis.pdf", "mime_type": "application/pdf"},
+        },
+    }
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+        self.deleted = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+
+    async def delete_message(self, chat_id, message_id, **kwargs):
+        self.deleted.append((chat_id, message_id))
+
+
+def store_job(stage=None, status_message_id=None, attempts=0):
+    async def run():
+        store = bot.JobStore()
+        job_id = await store.add([(Update.de_json(make_update_data(), None), None)])
+        if stage:
+            await store.set_stage(job_id, stage, status_message_id)
+        for _ in range(attempts):
+            await store.retry(job_id)
+        store.close()
+
+    asyncio.run(run())
+
+
+def test_jobs_survive_reopening_the_store():
+    store_job("extract", 77)
+
+    async def run():
+        store = bot.JobStore()
+        jobs = await store.pending()
+        await store.finish(jobs[0].id)
+        left = await store.pending()
+        store.close()
+        return jobs, left
+
+    jobs, left = asyncio.run(run())
+
+    assert len(jobs) == 1
+    job = jobs[0]
+    assert (job.user_id, job.chat_id, job.stage, job.status_message_id) == (42, 42, "extract", 77)
+    assert job.updates[0]["message"]["document"]["file_id"] == "file-1"
+    assert left == []
+
+
+def test_unfinished_job_is_resumed_at_startup():
+    store_job("analyze", 77)
+    medical_bot = bot.MedicalAnalysisBot()
+    processed = []
+
+    async def process_uploads(items, job_id=None):
+        processed.append((items[0][0].message.document.file_id, job_id))
+
+    medical_bot.process_uploads = process_uploads
+    fake_bot = FakeBot()
+
+    async def run():
+        await medical_bot.resume_jobs(SimpleNamespace(bot=fake_bot))
+        return await medical_bot.jobs.pending()
+
+    left = asyncio.run(run())
+
+    assert fake_bot.deleted == [(42, 77)]
+    assert [file_id for file_id, _ in processed] == ["file-1"]
+    assert processed[0][1] is not None
+    assert left == []
+    assert medical_bot.metrics.counters[("jobs_resumed_total", ())] == 1
+
+
+def test_job_is_given_up_after_max_attempts():
+    store_job(attempts=bot.JOB_MAX_ATTEMPTS - 1)
+    medical_bot = bot.MedicalAnalysisBot()
+    processed = []
+
+    async def process_uploads(items, job_id=None):
+        processed.append(items)
+
+    medical_bot.process_uploads = process_uploads
+    fake_bot = FakeBot()
+
+    async def run():
+        await medical_bot.resume_jobs(SimpleNamespace(bot=fake_bot))
+        return await medical_bot.jobs.pending()
+
+    left = asyncio.run(run())
+
+    assert processed == []
+    assert left == []
+    assert fake_bot.sent and "ещё раз" in fake_bot.sent[0][1]
+
+
+def test_interrupted_job_stays_queued_and_finished_job_is_dropped():
+    medical_bot = bot.MedicalAnalysisBot()
+    items = [(Update.de_json(make_update_data(), FakeBot()), None)]
+
+    async def run():
+        started = asyncio.Event()
+        finish = asyncio.Event()
+
+        async def process_uploads(items, job_id=None):
+            started.set()
+            await finish.wait()
+
+        medical_bot.process_uploads = process_uploads
+
+        # Cancelled mid-analysis, as on shutdown: the job is kept
+        task = asyncio.create_task(medical_bot.schedule_batch(items))
+        await started.wait()
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        interrupted = await medical_bot.jobs.pending()
+
+        # Completed normally: the job is removed
+        finish.set()
+        await medical_bot.schedule_batch(items)
+        finished = await medical_bot.jobs.pending()
+        return interrupted, finished
+
+    interrupted, finished = asyncio.run(run())
+
+    assert [job.stage for job in interrupted] == ["queued"]
+    assert len(finished) == 1 and finished[0].id == interrupted[0].id
+
+
+def test_only_jobs_with_an_expired_lease_are_claimed():
+    async def run():
+        live = bot.JobStore(lease=60)
+        stopped = bot.JobStore(lease=0)
+        other = bot.JobStore()
+        update = Update.de_json(make_update_data(), None)
+        running = await live.add([(update, None)])
+        left = await stopped.add([(update, None)])
+
+        # The job of the live process is not taken over, the one without a lease is
+        first = [job.id for job in await other.claim()]
+        again = await other.claim()
+        # A process shutting down releases its jobs
+        live.close()
+        released = [job.id for job in await other.claim()]
+        stopped.close()
+        other.close()
+        return running, left, first, again, released
+
+    running, left, first, again, released = asyncio.run(run())
+
+    assert first == [left]
+    assert again == []
+    assert released == [running]
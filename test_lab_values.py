@@ -0,0 +1,137 @@
+"""
+Tests for the local lab value parser and the compact prompt built from it.
+"""
+
+import asyncio
+
+import bot
+
+
+REPORT = """ООО «Лаборатория», г. Москва, ул. Ленина 5
+Дата: 21.01.2026
+Результаты анализа крови:
+Гемоглобин: 120 г/л (норма: 120-140)
+Глюкоза: 6.5 ммоль/л (норма: 3.3-5.5)
+Витамин B12 350 пг/мл 191-663
+Ферритин\t<5\tнг/мл\t10-120
+ВИЧ: отрицательный
+"""
+
+
+def test_parse_lab_values():
+    values = {value.name: value for value in bot.parse_lab_values(REPORT)}
+
+    assert set(values) == {"Гемоглобин", "Глюкоза", "Витамин B12", "Ферритин"}
+    assert values["Глюкоза"] == bot.LabValue("Глюкоза", 6.5, "ммоль/л", 3.3, 5.5, "high")
+    assert values["Гемоглобин"].status == "normal"
+    assert values["Ферритин"].status == "low"
+
+
+def test_ranges_with_comma_decimals_and_upper_bound():
+    assert bot.parse_lab_line("ТТГ: 2,1 мЕд/л (0,4–4,0)") == bot.LabValue("ТТГ", 2.1, "мЕд/л", 0.4, 4.0, "normal")
+    assert bot.parse_lab_line("Холестерин общий 6.1 ммоль/л < 5.2").status == "high"
+    assert bot.parse_lab_line("Глюкоза 3.3-5.5") is None
+
+
+def test_compact_prompt_drops_boilerplate():
+    values = bot.parse_lab_values(REPORT)
+    prompt = bot.build_analysis_prompt(REPORT, values)
+
+    assert "Глюкоза | 6,5 | ммоль/л | 3,3–5,5 | ↑ выше нормы" in prompt
+    assert "ВИЧ: отрицательный" in prompt
+    assert "Ленина" not in prompt
+    assert len(prompt) < len(bot.build_analysis_prompt(REPORT, []))
+
+
+def test_normal_report_can_skip_llm(monkeypatch):
+    monkeypatch.setattr(bot, "LAB_SKIP_LLM_WHEN_NORMAL", True)
+    monkeypatch.setattr(bot, "GIGACHAT_CREDENTIALS", None)
+    medical_bot = bot.MedicalAnalysisBot()
+
+    result, _ = asyncio.run(medical_bot.analyze_with_gigachat("Гемоглобин: 130 г/л (норма: 120-140)"))
+
+    assert "в пределах референсных значений" in result
+    assert "Гемоглобин: 130 г/л" in result
+
+
+def test_analyte_names_with_typos_and_lookalike_letters():
+    assert bot.find_analyte("Гемоглобин (HGB)").name == "Гемоглобин"
+    # "НGВ" with Cyrillic Н and В, as OCR often returns it
+    assert bot.find_analyte("НGВ").name == "Гемоглобин"
+    assert bot.find_analyte("Глюказа в сыворотке крови").name == "Глюкоза"
+    assert bot.find_analyte("Т3 свободныи").name == "Т3 свободный"
+    assert bot.find_analyte("Лютеинизирующий гормон (ЛГ)").name == "ЛГ"
+    assert bot.find_analyte("Билирубин прямой") is None
+    assert bot.find_analyte("Кальций ионизированный") is None
+
+
+def test_missing_ranges_come_from_reference_table_by_sex():
+    text = "Пол: Ж\nВозраст: 30\nГемоглобин 125 г/л\nЛГ 12 мМЕ/мл\nГлюкоза 5,0 мг/дл\nЛейкоциты 12 х10*9/л"
+    values = {value.name: value for value in bot.parse_lab_values(text)}
+
+    assert values["Гемоглобин"] == bot.LabValue("Гемоглобин", 125, "г/л", 120, 150, "normal", True)
+    assert values["Лейкоциты"].status == "high"
+    # Cycle-dependent hormone and a unit the table does not know stay without a range
+    assert values["ЛГ"].status is None
+    assert values["Глюкоза"].status is None
+    assert bot.parse_lab_values("Пол: М\nГемоглобин 125 г/л")[0].status == "low"
+    assert "справочно" in bot.format_lab_table(list(values.values()))
+
+
+def test_single_analyte_report_is_answered_locally(monkeypatch):
+    monkeypatch.setattr(bot, "GIGACHAT_CREDENTIALS", None)
+    medical_bot = bot.MedicalAnalysisBot()
+
+    result, _ = asyncio.run(medical_bot.analyze_with_gigachat("Пациент: Иванов И.И.\nГлюкоза: 7.2 ммоль/л"))
+    several, _ = asyncio.run(medical_bot.analyze_with_gigachat("Глюкоза: 7.2 ммоль/л\nВИЧ: отрицательный"))
+
+    assert "выше нормы" in result
+    assert "Повышение бывает при нарушении углеводного обмена" in result
+    assert "справочный" in result
+    assert "GIGACHAT_CREDENTIALS" in several
+
+
+BLOOD_COUNT = """ООО «Лаборатория», г. Москва, ул. Ленина 5
+Дата: 21.01.2026 10:30
+Пол: муж
+Гемоглобин 135 г/л 130 - 160
+Тромбоциты 180 10^9/л 150 - 400
+Лимфоциты, % 52 19 - 37
+Эозинофилы, % 12 1 - 5
+"""
+
+
+def test_name_comma_unit_layout_is_parsed():
+    values = {value.name: value for value in bot.parse_lab_values(BLOOD_COUNT)}
+
+    assert values["Лимфоциты"] == bot.LabValue("Лимфоциты", 52, "%", 19, 37, "high")
+    assert values["Эозинофилы"].status == "high"
+
+    prompt = bot.build_analysis_prompt(BLOOD_COUNT, list(values.values()))
+    assert "Все показатели" not in prompt
+    assert "Лимфоциты | 52 | % | 19–37 | ↑ выше нормы" in prompt
+
+
+def test_unparsed_numeric_lines_reach_the_prompt(monkeypatch):
+    monkeypatch.setattr(bot, "LAB_SKIP_LLM_WHEN_NORMAL", True)
+    monkeypatch.setattr(bot, "GIGACHAT_CREDENTIALS", None)
+    report = BLOOD_COUNT.replace("Лимфоциты, % 52 19 - 37", "Лимфоциты | 52 | % | 19-37").replace("Эозинофилы, % 12 1 - 5\n", "")
+    values = bot.parse_lab_values(report)
+
+    assert all(value.status == "normal" for value in values)
+    assert bot.unchecked_result_lines(report) == ["Лимфоциты | 52 | % | 19-37"]
+    prompt = bot.build_analysis_prompt(report, values)
+    assert "Все показатели" not in prompt
+    assert "Лимфоциты | 52 | % | 19-37" in prompt
+    assert "Ленина" not in prompt and "10:30" not in prompt
+
+    # The local "everything is normal" answer is not given either
+    result, succeeded = asyncio.run(bot.MedicalAnalysisBot().analyze_with_gigachat(report))
+    assert "GIGACHAT_CREDENTIALS" in result and not succeeded
+
+
+def test_report_with_another_analyte_is_not_answered_locally():
+    text = "Пол: муж\nГлюкоза: 6.5 ммоль/л\nГомоцистеин: 18 мкмоль/л"
+
+    assert bot.find_single_analyte(bot.parse_lab_values(text), text) is None
+    assert bot.find_single_analyte(bot.parse_lab_values("Пол: муж\nГлюкоза: 6.5 ммоль/л"), "Пол: муж\nГлюкоза: 6.5 ммоль/л")
@@ -0,0 +1,209 @@
+"""
+Tests for the managed GigaChat client against a local stub server.
+"""
+
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from gigachat.exceptions import ServerError
+from gigachat.models import Chat, Messages, MessagesRole
+
+import bot
+
+
+class StubGigaChat(BaseHTTPRequestHandler):
+    """Answers the OAuth and chat endpoints; the server holds the scripted failures."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        server = self.server
+        server.ports.add(self.client_address[1])
+        if self.path.endswith("/oauth"):
+            time.sleep(server.token_delay)
+            server.token_requests += 1
+            expires_at = int((time.time() + server.token_lifetime) * 1000)
+            self.send_json(200, {"access_token": f"token-{server.token_requests}", "expires_at": expires_at})
+            return
+        server.chat_requests += 1
+        if server.failures:
+            server.failures -= 1
+            self.send_json(503, {"message": "unavailable"})
+            return
+        self.send_json(200, {
+            "choices": [{"message": {"role": "assistant", "content": "ok"}, "index": 0, "finish_reason": "stop"}],
+            "created": 0,
+            "model": "GigaChat",
+            "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+            "object": "chat.completion",
+        })
+
+
+@pytest.fixture
+def stub_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubGigaChat)
+    server.daemon_threads = True
+    server.token_requests = 0
+    server.chat_requests = 0
+    server.failures = 0
+    server.token_lifetime = 1800
+    server.token_delay = 0
+    server.ports = set()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_client(monkeypatch, server, **options):
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    monkeypatch.setattr(bot, "GIGACHAT_CREDENTIALS", "dGVzdDp0ZXN0")
+    monkeypatch.setattr(bot, "GIGACHAT_SCOPE", "GIGACHAT_API_PERS")
+    monkeypatch.setattr(bot, "GIGACHAT_BASE_URL", url)
+    monkeypatch.setattr(bot, "GIGACHAT_AUTH_URL", f"{url}/oauth")
+    monkeypatch.setattr(bot, "GIGACHAT_BACKOFF_BASE", 0.01)
+    monkeypatch.setattr(bot, "GIGACHAT_BACKOFF_MAX", 0.05)
+    client = bot.GigaChatClient()
+    for name, value in options.items():
+        setattr(client, name, value)
+    return client
+
+
+def make_chat():
+    return Chat(messages=[Messages(role=MessagesRole.USER, content="hello")])
+
+
+def test_token_and_connection_are_reused(monkeypatch, stub_server):
+    client = make_client(monkeypatch, stub_server)
+
+    async def run():
+        results = [await client.achat(make_chat()) for _ in range(3)]
+        await client.aclose()
+        return results
+
+    results = asyncio.run(run())
+
+    assert [result.choices[0].message.content for result in results] == ["ok"] * 3
+    assert stub_server.token_requests == 1
+    # Chat requests go over a single keep-alive connection
+    assert stub_server.chat_requests == 3
+    assert len(stub_server.ports) == 2
+
+
+def test_token_is_refreshed_before_expiry(monkeypatch, stub_server):
+    client = make_client(monkeypatch, stub_server, refresh_margin=120)
+    real_time = time.time
+    offset = [0]
+    monkeypatch.setattr(time, "time", lambda: real_time() + offset[0])
+
+    async def run():
+        await client.achat(make_chat())
+        # 100 s before the 1800 s token expires, inside the refresh margin
+        offset[0] = 1700
+        await client.achat(make_chat())
+        await client.achat(make_chat())
+        await client.aclose()
+
+    asyncio.run(run())
+
+    assert stub_server.token_requests == 2
+    assert client.token_refreshes == 2
+
+
+def test_live_token_is_kept_while_it_is_refreshed(monkeypatch, stub_server):
+    stub_server.token_lifetime = 300
+    client = make_client(monkeypatch, stub_server, refresh_margin=600)
+
+    async def run():
+        await client.ensure_token()
+        stub_server.token_delay = 0.2
+        refresh = asyncio.create_task(client.ensure_token())
+        await asyncio.sleep(0.05)
+        # Requests started during the refresh still find the previous token
+        during = client.get_client().token
+        await refresh
+        after = client.get_client().token
+        await client.aclose()
+        return during, after
+
+    during, after = asyncio.run(run())
+
+    assert (during, after) == ("token-1", "token-2")
+    assert client.token_refreshes == 2
+
+
+def test_server_errors_are_retried(monkeypatch, stub_server):
+    stub_server.failures = 2
+    client = make_client(monkeypatch, stub_server, max_retries=3)
+
+    async def run():
+        response = await client.achat(make_chat())
+        await client.aclose()
+        return response
+
+    response = asyncio.run(run())
+
+    assert response.choices[0].message.content == "ok"
+    assert stub_server.chat_requests == 3
+    assert client.retries == 2
+    assert client.state == "closed"
+
+
+def test_circuit_breaker_fails_fast_and_recovers(monkeypatch, stub_server):
+    stub_server.failures = 100
+    client = make_client(monkeypatch, stub_server, max_retries=1, breaker_threshold=2, breaker_cooldown=0.2)
+
+    async def run():
+        for _ in range(2):
+            with pytest.raises(ServerError):
+                await client.achat(make_chat())
+        assert client.state == "open"
+        requests_before = stub_server.chat_requests
+        with pytest.raises(bot.CircuitOpenError):
+            await client.achat(make_chat())
+        assert stub_server.chat_requests == requests_before
+
+        # After the cooldown one probe call is let through and closes the breaker
+        stub_server.failures = 0
+        await asyncio.sleep(0.25)
+        response = await client.achat(make_chat())
+        await client.aclose()
+        return response
+
+    response = asyncio.run(run())
+
+    assert response.choices[0].message.content == "ok"
+    assert client.state == "closed"
+
+
+def test_open_breaker_gives_user_message(monkeypatch):
+    client = bot.GigaChatClient(client=None, breaker_threshold=1, breaker_cooldown=60)
+    client.opened_at = time.monotonic()
+    monkeypatch.setattr(bot, "giga", client, raising=False)
+    monkeypatch.setattr(bot, "GIGACHAT_CREDENTIALS", "credentials")
+    monkeypatch.setattr(bot, "GIGACHAT_SCOPE", "scope")
+    monkeypatch.setattr(bot, "LAB_SKIP_LLM_WHEN_NORMAL", False)
+    monkeypatch.setattr(bot, "LAB_LOCAL_SINGLE_ANALYTE", False)
+    medical_bot = bot.MedicalAnalysisBot()
+
+    result, succeeded = asyncio.run(medical_bot.analyze_with_gigachat("Глюкоза 5.0 ммоль/л"))
+
+    assert "временно недоступен" in result
+    assert not succeeded
@@ -0,0 +1,64 @@
+"""
+Tests for the bounded, non-blocking GigaChat request pool.
+"""
+
+import asyncio
+import time
+
+import bot
+
+
+class FakeGigaChat:
+    """Stand-in for the GigaChat client that answers after a fixed delay."""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.active = 0
+        self.max_active = 0
+
+    async def achat(self, chat):
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.active -= 1
+        return "ok"
+
+
+def make_bot(monkeypatch, fake, concurrency=2, timeout=5.0):
+    monkeypatch.setattr(bot, "giga", fake, raising=False)
+    monkeypatch.setattr(bot, "GIGACHAT_MAX_CONCURRENCY", concurrency)
+    monkeypatch.setattr(bot, "GIGACHAT_TIMEOUT", timeout)
+    return bot.MedicalAnalysisBot()
+
+
+def test_requests_run_in_parallel_up_to_limit(monkeypatch):
+    fake = FakeGigaChat(delay=0.1)
+    medical_bot = make_bot(monkeypatch, fake, concurrency=2)
+
+    async def run():
+        start = time.perf_counter()
+        await asyncio.gather(*(medical_bot.request_gigachat(None) for _ in range(4)))
+        return time.perf_counter() - start
+
+    elapsed = asyncio.run(run())
+
+    assert fake.max_active == 2
+    assert elapsed < 0.35
+    assert medical_bot.llm_queue_depth == 0
+
+
+def test_request_times_out(monkeypatch):
+    fake = FakeGigaChat(delay=1.0)
+    medical_bot = make_bot(monkeypatch, fake, timeout=0.05)
+
+    async def run():
+        try:
+            await medical_bot.request_gigachat(None)
+        except asyncio.TimeoutError:
+            return True
+        return False
+
+    assert asyncio.run(run())
+    assert medical_bot.llm_queue_depth == 0
@@ -0,0 +1,28 @@
+"""
+Smoke test for the offline end-to-end benchmark harness.
+"""
+
+import load_test
+
+
+def test_load_harness_reports_latency_throughput_and_rss():
+    corpus = load_test.build_corpus(["pdf", "docx", "xlsx"], ["small"])
+
+    report = load_test.run_load(corpus, users=3, uploads_per_user=2, llm_latency=0.01, workers=1)
+
+    assert report["uploads"] == report["llm_calls"] == 6
+    assert report["errors"] == []
+    assert set(report["latency_by_file"]) == {"pdf/small", "docx/small", "xlsx/small"}
+    assert 0 < report["latency"]["p50"] <= report["latency"]["p95"] <= report["latency"]["p99"]
+    assert report["throughput"] > 0
+    assert {"download", "extract/pdf", "llm", "format", "send"} <= set(report["stages"])
+    assert report["peak_rss_mb"] > 0
+    assert "Throughput" in load_test.format_report(report)
+
+
+def test_percentile_uses_nearest_rank():
+    samples = list(range(1, 101))
+
+    assert load_test.percentile(samples, 50) == 50
+    assert load_test.percentile(samples, 99) == 99
+    assert load_test.percentile([], 95) == 0.0
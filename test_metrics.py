@@ -0,0 +1,82 @@
+"""
+Tests for stage metrics, the /metrics endpoint and the queued error log.
+"""
+
+import asyncio
+from types import SimpleNamespace
+
+import bot
+
+
+class FakeGigaChat:
+    retries = 0
+    state = "closed"
+
+    async def achat(self, chat):
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="Глюкоза повышена."))])
+
+
+def test_histograms_and_counters_render_in_prometheus_format():
+    metrics = bot.Metrics(buckets=(0.1, 1))
+    metrics.observe("stage_seconds", 0.05, stage="extract", format="pdf")
+    metrics.observe("stage_seconds", 0.5, stage="extract", format="pdf")
+    metrics.observe("stage_seconds", 5, stage="extract", format="pdf")
+    metrics.inc("documents_total", format="pdf")
+    metrics.gauge("queue_depth", lambda: 3)
+    metrics.summary("ttft_seconds", [1.0, 2.0, 3.0, 4.0])
+
+    text = metrics.render()
+
+    assert '# TYPE stage_seconds histogram' in text
+    assert 'stage_seconds_bucket{format="pdf",stage="extract",le="0.1"} 1' in text
+    assert 'stage_seconds_bucket{format="pdf",stage="extract",le="1"} 2' in text
+    assert 'stage_seconds_bucket{format="pdf",stage="extract",le="+Inf"} 3' in text
+    assert 'stage_seconds_count{format="pdf",stage="extract"} 3' in text
+    assert 'documents_total{format="pdf"} 1' in text
+    assert 'queue_depth 3' in text
+    assert 'ttft_seconds{quantile="0.5"} 3.000000' in text
+    assert metrics.snapshot()["histograms"]["stage_seconds"][0]["count"] == 3
+
+
+def test_llm_and_format_stages_are_timed(monkeypatch):
+    monkeypatch.setattr(bot, "giga", FakeGigaChat(), raising=False)
+    monkeypatch.setattr(bot, "GIGACHAT_CREDENTIALS", "credentials")
+    monkeypatch.setattr(bot, "GIGACHAT_SCOPE", "scope")
+    medical_bot = bot.MedicalAnalysisBot()
+
+    asyncio.run(medical_bot.analyze_with_gigachat("Глюкоза: 6.5"))
+
+    stages = {dict(labels)["stage"] for _, labels in medical_bot.metrics.histograms}
+    assert stages == {"llm", "format"}
+    assert "llm_circuit_open 0" in medical_bot.metrics.render()
+
+
+def test_metrics_endpoint_serves_text():
+    metrics = bot.Metrics()
+    metrics.inc("errors_total", stage="llm")
+
+    async def fetch(path):
+        server = await metrics.start_server("127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+        response = await reader.read()
+        writer.close()
+        server.close()
+        await server.wait_closed()
+        return response.decode()
+
+    assert asyncio.run(fetch("/metrics")).endswith('errors_total{stage="llm"} 1\n')
+    assert asyncio.run(fetch("/")).startswith("HTTP/1.1 404")
+
+
+def test_errors_reach_log_file_through_queue(tmp_path, monkeypatch):
+    bot.stop_error_log()
+    monkeypatch.setattr(bot, "ERROR_LOG_PATH", str(tmp_path / "log.txt"))
+
+    bot.log_error("first failure")
+    bot.log_error("second failure")
+    bot.stop_error_log()
+
+    lines = (tmp_path / "log.txt").read_text(encoding="utf-8").splitlines()
+    assert [line.split(" - ", 1)[1] for line in lines] == ["first failure", "second failure"]
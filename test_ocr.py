@@ -0,0 +1,162 @@
+"""
+Tests for the OCR preprocessing and the Tesseract subprocess wrapper.
+"""
+
+import asyncio
+import io
+import os
+import stat
+import time
+from types import SimpleNamespace
+
+from PIL import Image, ImageDraw
+
+import bot
+
+
+def make_page(angle=0, size=(1200, 1600)):
+    """White page with dark horizontal text-like bars, rotated by angle degrees."""
+    image = Image.new("L", size, 255)
+    draw = ImageDraw.Draw(image)
+    for top in range(100, size[1] - 100, 60):
+        draw.rectangle([100, top, size[0] - 100, top + 12], fill=0)
+    return image.rotate(angle, resample=Image.BICUBIC, fillcolor=255)
+
+
+def test_skew_is_detected_and_corrected():
+    assert abs(bot.estimate_skew(make_page(angle=3)) + 3) <= 0.5
+    assert bot.estimate_skew(make_page(angle=0)) == 0
+
+
+def test_large_photos_are_downscaled_to_target_dpi(monkeypatch):
+    monkeypatch.setattr(bot, "OCR_TARGET_DPI", 150)
+    photo = make_page(size=(3000, 4000)).convert("RGB")
+
+    start = time.perf_counter()
+    image = bot.preprocess_for_ocr(photo)
+    elapsed = time.perf_counter() - start
+
+    assert image.mode == "1"
+    assert max(image.size) <= int(150 * bot.A4_LONG_SIDE_INCHES) + 2
+    assert elapsed < 5
+
+
+def test_ocr_runs_engine_and_reports_missing_binary(tmp_path, monkeypatch):
+    fake_engine = tmp_path / "tesseract"
+    fake_engine.write_text("#!/bin/sh\ncat > /dev/null\necho 'Глюкоза: 6.5'\n", encoding="utf-8")
+    fake_engine.chmod(fake_engine.stat().st_mode | stat.S_IEXEC)
+    png = io.BytesIO()
+    make_page().save(png, format="PNG")
+
+    monkeypatch.setattr(bot, "TESSERACT_CMD", str(fake_engine))
+    assert bot.ocr_image_job(png.getvalue()) == "Глюкоза: 6.5"
+
+    monkeypatch.setattr(bot, "TESSERACT_CMD", os.path.join(str(tmp_path), "missing"))
+    assert bot.ocr_image_job(png.getvalue()) is None
+
+
+def jpeg_bytes(image, quality=90):
+    data = io.BytesIO()
+    image.convert("RGB").save(data, format="JPEG", quality=quality)
+    return data.getvalue()
+
+
+def test_smallest_legible_photo_size_is_chosen():
+    sizes = [SimpleNamespace(width=side, height=side * 3 // 4, file_id=str(side)) for side in (90, 320, 800, 1280, 2560)]
+
+    assert bot.select_photo_size(sizes, min_side=1000).file_id == "1280"
+    assert bot.select_photo_size(sizes[:3], min_side=1000).file_id == "800"
+
+
+def test_jpeg_is_decoded_at_reduced_scale_in_grayscale():
+    image = bot.open_image(io.BytesIO(jpeg_bytes(make_page(size=(2400, 3200)))), 1000)
+    image.load()
+
+    assert image.mode == "L"
+    assert image.size == (1200, 1600)
+
+
+def test_page_is_cropped_and_thresholded():
+    page = make_page(size=(1200, 1600))
+    image = bot.binarize(bot.crop_to_content(page))
+
+    assert image.mode == "1"
+    assert image.size == (1041, 1433)
+    assert 60 <= bot.otsu_threshold(page.point(lambda value: 60 if value < 128 else 200)) < 200
+
+
+def test_resent_photo_is_recognised_once(monkeypatch):
+    medical_bot = bot.MedicalAnalysisBot()
+    calls = []
+
+    async def run_extract_job(job, *args, timeout=None):
+        calls.append(job)
+        await asyncio.sleep(0.01)
+        return "Глюкоза: 6.5"
+
+    medical_bot.run_extract_job = run_extract_job
+    first = jpeg_bytes(make_page(), quality=90)
+    # The same photo sent again, recompressed on the way
+    second = jpeg_bytes(Image.open(io.BytesIO(first)), quality=85)
+    other = jpeg_bytes(make_page().rotate(90, expand=True))
+    # Another shot of the same sheet may as well be another page of the form
+    reshot = jpeg_bytes(make_page().rotate(0.3, translate=(4, 3), fillcolor=255))
+
+    async def run():
+        return await asyncio.gather(
+            medical_bot.ocr_photo(io.BytesIO(first), "a", user_id=1),
+            medical_bot.ocr_photo(io.BytesIO(second), "b", user_id=1),
+            medical_bot.ocr_photo(io.BytesIO(second), "c", user_id=2),
+            medical_bot.ocr_photo(io.BytesIO(other), "d", user_id=1),
+            medical_bot.ocr_photo(io.BytesIO(reshot), "e", user_id=1),
+        )
+
+    texts = asyncio.run(run())
+
+    assert texts == ["Глюкоза: 6.5"] * 5
+    # The copy re-sent by user 1 is skipped; user 2, the other sheet and the new shot are recognised
+    assert len(calls) == 4
+    assert medical_bot.metrics.counters[("duplicate_photos_total", ())] == 1
+
+
+def make_form_page(values):
+    """Page of one lab form template filled in with the given result values."""
+    image = Image.new("L", (1240, 1754), 255)
+    draw = ImageDraw.Draw(image)
+    draw.rectangle([100, 80, 1140, 160], fill=0)
+    for row, value in enumerate(values):
+        top = 240 + row * 90
+        draw.text((120, top), f"Analyte {row}", fill=0)
+        draw.text((600, top), value, fill=0)
+        draw.text((900, top), "3.3 - 5.5", fill=0)
+        draw.line([100, top + 40, 1140, top + 40], fill=0, width=2)
+    return image
+
+
+def test_different_pages_of_one_form_are_both_recognised():
+    medical_bot = bot.MedicalAnalysisBot()
+    calls = []
+
+    async def run_extract_job(job, *args, timeout=None):
+        calls.append(job)
+        return f"Страница {len(calls)}"
+
+    medical_bot.run_extract_job = run_extract_job
+    first = jpeg_bytes(make_form_page([f"{4 + row * 0.1:.1f}" for row in range(15)]))
+    second = jpeg_bytes(make_form_page([f"{4 + row * 0.2:.1f}" for row in range(15)]))
+    first_hash, _ = bot.photo_fingerprint(io.BytesIO(first))
+    second_hash, _ = bot.photo_fingerprint(io.BytesIO(second))
+    # The pages are hash candidates of each other, yet not the same photo
+    assert (first_hash ^ second_hash).bit_count() <= bot.PHOTO_DEDUP_DISTANCE
+
+    async def run():
+        return await asyncio.gather(
+            medical_bot.ocr_photo(io.BytesIO(first), "a", user_id=1),
+            medical_bot.ocr_photo(io.BytesIO(second), "b", user_id=1),
+        )
+
+    texts = asyncio.run(run())
+
+    assert len(calls) == 2
+    assert sorted(texts) == ["Страница 1", "Страница 2"]
+    assert ("duplicate_photos_total", ()) not in medical_bot.metrics.counters
@@ -0,0 +1,46 @@
+"""
+Tests for the two-tier analysis result cache.
+"""
+
+import asyncio
+
+import bot
+
+
+def test_text_key_ignores_case_and_whitespace():
+    assert bot.text_cache_key("Глюкоза:  6.5\nммоль/л") == bot.text_cache_key("глюкоза: 6.5 ммоль/л")
+    assert bot.file_cache_key(b"a") != bot.file_cache_key(b"b")
+
+
+def test_hit_miss_and_lru_eviction(tmp_path):
+    cache = bot.ResultCache(db_path=str(tmp_path / "cache.db"), max_entries=2)
+
+    async def run():
+        assert await cache.get("file:1") is None
+        await cache.put(["file:1", "text:1"], "ответ 1")
+        await cache.put(["file:2"], "ответ 2")
+        assert await cache.get("file:1") == "ответ 1"
+        return list(cache.memory)
+
+    in_memory = asyncio.run(run())
+
+    # Only the two most recently used keys stay in memory
+    assert in_memory == ["file:2", "file:1"]
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+    cache.close()
+
+
+def test_disk_tier_survives_restart_and_expires(tmp_path):
+    db_path = str(tmp_path / "cache.db")
+    cache = bot.ResultCache(db_path=db_path)
+    asyncio.run(cache.put(["text:abc"], "ответ"))
+    cache.close()
+
+    cache = bot.ResultCache(db_path=db_path)
+    assert asyncio.run(cache.get("text:abc")) == "ответ"
+    cache.close()
+
+    cache = bot.ResultCache(db_path=db_path, ttl=0)
+    assert asyncio.run(cache.get("text:abc")) is None
+    cache.close()
@@ -0,0 +1,89 @@
+"""
+Tests for the fair per-user job scheduler.
+"""
+
+import asyncio
+
+import bot
+
+
+def test_round_robin_between_users():
+    scheduler = bot.FairScheduler(max_active=1, rate_per_minute=60, burst=10)
+    order = []
+
+    def job(name):
+        async def run():
+            order.append(name)
+            await asyncio.sleep(0)
+        return run
+
+    async def run():
+        futures = [scheduler.submit("a", job(f"a{number}"))[0] for number in range(4)]
+        futures.append(scheduler.submit("b", job("b0"))[0])
+        futures.append(scheduler.submit("c", job("c0"))[0])
+        await asyncio.gather(*futures)
+
+    asyncio.run(run())
+
+    # a0 starts at once; afterwards users take turns
+    assert order == ["a0", "a1", "b0", "c0", "a2", "a3"]
+    assert len(scheduler.wait_times) == len(scheduler.run_times) == 6
+
+
+def test_queue_position_is_reported():
+    scheduler = bot.FairScheduler(max_active=1, rate_per_minute=60, burst=10)
+
+    async def run():
+        gate = asyncio.Event()
+
+        async def blocker():
+            await gate.wait()
+
+        async def quick():
+            return "done"
+
+        first = scheduler.submit("a", blocker)
+        second = scheduler.submit("a", quick)
+        third = scheduler.submit("b", quick)
+        gate.set()
+        await asyncio.gather(first[0], second[0], third[0])
+        return first[1], second[1], third[1], third[0].result()
+
+    assert asyncio.run(run()) == (0, 1, 2, "done")
+
+
+def test_token_bucket_limits_bursts(monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(bot.time, "monotonic", lambda: clock[0])
+    scheduler = bot.FairScheduler(rate_per_minute=6, burst=2)
+
+    assert scheduler.take_token(1) == (True, 0.0)
+    assert scheduler.take_token(1) == (True, 0.0)
+    allowed, retry_after = scheduler.take_token(1)
+    assert not allowed and retry_after == 10
+    # Another user is not affected
+    assert scheduler.take_token(2)[0]
+
+    clock[0] += 10
+    assert scheduler.take_token(1)[0]
+
+
+def test_running_jobs_are_referenced_until_done():
+    scheduler = bot.FairScheduler(max_active=2, rate_per_minute=60, burst=10)
+
+    async def run():
+        gate = asyncio.Event()
+
+        async def blocker():
+            await gate.wait()
+
+        future, _ = scheduler.submit("a", blocker)
+        await asyncio.sleep(0)
+        running = len(scheduler.tasks)
+        gate.set()
+        await future
+        await asyncio.sleep(0)
+        return running
+
+    assert asyncio.run(run()) == 1
+    assert scheduler.tasks == set()
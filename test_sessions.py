@@ -0,0 +1,191 @@
+"""
+Tests for follow-up questions answered from the stored report context.
+"""
+
+import asyncio
+import io
+from types import SimpleNamespace
+
+import bot
+
+
+class FakeMessage:
+    """Records Telegram calls made on a message."""
+
+    message_id = 1
+
+    def __init__(self, log, text=""):
+        self.log = log
+        self.text = text
+
+    async def reply_text(self, text, **kwargs):
+        self.log.append(("reply", text))
+        return FakeMessage(self.log)
+
+    async def edit_text(self, text, **kwargs):
+        self.log.append(("edit", text))
+
+    async def delete(self):
+        self.log.append(("delete", None))
+
+
+class RecordingGigaChat:
+    retries = 0
+    state = "closed"
+
+    def __init__(self):
+        self.prompts = []
+
+    async def achat(self, chat):
+        self.prompts.append(chat.messages[0].content)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="Ферритин не измерялся."))])
+
+
+REPORT = "Гемоглобин 110 г/л 120-140\nГлюкоза 5.0 ммоль/л 3.3-5.5\n" + "Подпись врача\n" * 500
+
+
+def test_sessions_expire_and_evict_least_recently_used(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(bot.time, "monotonic", lambda: clock[0])
+    store = bot.SessionStore(ttl=60, max_users=2)
+
+    store.start(1, REPORT, "<b>Разбор</b>")
+    store.start(2, REPORT, "Разбор")
+    assert store.get(1) is not None
+    store.start(3, REPORT, "Разбор")
+
+    # User 2 was used least recently
+    assert set(store.sessions) == {1, 3}
+    clock[0] += 61
+    assert store.get(1) is None
+    assert store.get(3) is None
+
+
+def test_session_keeps_only_compact_context():
+    store = bot.SessionStore()
+
+    store.start(1, REPORT, "<b>Гемоглобин</b> снижен &amp; требует внимания")
+    session = store.get(1)
+
+    assert "Гемоглобин" in session["summary"] and "Подпись врача" not in session["summary"]
+    assert session["answer"] == "Гемоглобин снижен & требует внимания"
+
+
+def test_follow_up_sends_summary_instead_of_document(monkeypatch):
+    fake = RecordingGigaChat()
+    monkeypatch.setattr(bot, "giga", fake, raising=False)
+    monkeypatch.setattr(bot, "GIGACHAT_CREDENTIALS", "credentials")
+    monkeypatch.setattr(bot, "GIGACHAT_SCOPE", "scope")
+    monkeypatch.setattr(bot, "GIGACHAT_STREAMING", False)
+    medical_bot = bot.MedicalAnalysisBot()
+    medical_bot.sessions.start(7, REPORT, "Гемоглобин снижен.")
+    log = []
+    update = SimpleNamespace(
+        message=FakeMessage(log, "А что с ферритином?"),
+        effective_user=SimpleNamespace(id=7, first_name="Анна", last_name=None, username="anna"),
+    )
+
+    async def run():
+        await medical_bot.handle_text(update, None)
+        await medical_bot.handle_text(update, None)
+
+    asyncio.run(run())
+
+    assert len(fake.prompts) == 2
+    assert "А что с ферритином?" in fake.prompts[0]
+    assert "Подпись врача" not in fake.prompts[0]
+    assert len(fake.prompts[0]) < 2000
+    # The second question sees the first one in its history
+    assert "Ферритин не измерялся." in fake.prompts[1]
+    assert ("edit", "Ферритин не измерялся.") in log
+
+
+def test_text_without_report_asks_for_upload():
+    medical_bot = bot.MedicalAnalysisBot()
+    log = []
+    update = SimpleNamespace(
+        message=FakeMessage(log, "Привет"),
+        effective_user=SimpleNamespace(id=8, first_name="Иван", last_name=None, username=None),
+    )
+
+    asyncio.run(medical_bot.handle_text(update, None))
+
+    assert log == [("reply", "Чтобы задать вопрос, сначала отправьте документ или фото с результатами анализов.")]
+
+
+def make_uploading_bot(monkeypatch):
+    """Bot whose uploads are text messages taken as the extracted report; returns (bot, upload)."""
+    monkeypatch.setattr(bot, "LAB_LOCAL_SINGLE_ANALYTE", False)
+    monkeypatch.setattr(bot, "GIGACHAT_STREAMING", False)
+    medical_bot = bot.MedicalAnalysisBot()
+
+    async def download_upload(update, context):
+        return "analysis.txt", io.BytesIO(update.message.text.encode("utf-8")), False, "text/plain"
+
+    async def extract_upload(name, buffer, is_photo, mime_type, file_key, user_id=None):
+        return buffer.getvalue().decode("utf-8")
+
+    medical_bot.download_upload = download_upload
+    medical_bot.extract_upload = extract_upload
+
+    def upload(user_id, report):
+        log = []
+        message = FakeMessage(log, report)
+        message.photo = None
+        message.document = SimpleNamespace(file_name="analysis.txt")
+        update = SimpleNamespace(message=message, effective_user=SimpleNamespace(id=user_id))
+        asyncio.run(medical_bot.process_uploads([(update, None)]))
+        return log
+
+    return medical_bot, upload
+
+
+def use_recording_gigachat(monkeypatch):
+    fake = RecordingGigaChat()
+    monkeypatch.setattr(bot, "giga", fake, raising=False)
+    monkeypatch.setattr(bot, "GIGACHAT_CREDENTIALS", "credentials")
+    monkeypatch.setattr(bot, "GIGACHAT_SCOPE", "scope")
+    return fake
+
+
+def test_session_is_started_only_after_a_successful_analysis(monkeypatch):
+    medical_bot, upload = make_uploading_bot(monkeypatch)
+
+    # No GigaChat credentials: the user gets an error text, not an analysis
+    monkeypatch.setattr(bot, "GIGACHAT_CREDENTIALS", None)
+    log = upload(1, REPORT)
+    assert "GIGACHAT_CREDENTIALS" in log[-1][1]
+    assert medical_bot.sessions.get(1) is None
+
+    use_recording_gigachat(monkeypatch)
+    upload(2, REPORT + "Ферритин 30 нг/мл 15-150\n")
+    assert medical_bot.sessions.get(2)["answer"] == "Ферритин не измерялся."
+
+
+def test_resent_cached_report_reopens_the_session(monkeypatch):
+    medical_bot, upload = make_uploading_bot(monkeypatch)
+    fake = use_recording_gigachat(monkeypatch)
+    upload(1, REPORT)
+    medical_bot.sessions.sessions.clear()
+
+    # The answer comes from the file cache, the context for questions too
+    log = upload(1, REPORT)
+    assert log[-1] == ("edit", "Ферритин не измерялся.")
+    question_log = []
+    update = SimpleNamespace(
+        message=FakeMessage(question_log, "А что с ферритином?"),
+        effective_user=SimpleNamespace(id=1, first_name="Анна", last_name=None, username="anna"),
+    )
+    asyncio.run(medical_bot.handle_text(update, None))
+
+    assert len(fake.prompts) == 2
+    assert "Гемоглобин" in fake.prompts[1] and "А что с ферритином?" in fake.prompts[1]
+
+    # An answer cached without the context: the file is read again, not analysed again
+    other_report = REPORT + "Ферритин 30 нг/мл 15-150\n"
+    file_key = bot.file_cache_key(io.BytesIO(other_report.encode("utf-8")))
+    asyncio.run(medical_bot.result_cache.put([file_key], "Ферритин в норме."))
+    upload(2, other_report)
+
+    assert len(fake.prompts) == 2
+    assert medical_bot.sessions.get(2)["answer"] == "Ферритин в норме."
@@ -0,0 +1,88 @@
+"""
+Tests for streamed GigaChat answers and long message splitting.
+"""
+
+import asyncio
+from types import SimpleNamespace
+
+from telegram.error import BadRequest
+
+import bot
+
+
+class FakeMessage:
+    """Records Telegram calls made on a message."""
+
+    def __init__(self, log, reject_html=False):
+        self.log = log
+        self.reject_html = reject_html
+
+    async def reply_text(self, text, **kwargs):
+        self.log.append(("reply", text))
+        return FakeMessage(self.log)
+
+    async def edit_text(self, text, parse_mode=None, **kwargs):
+        if parse_mode and self.reject_html:
+            raise BadRequest("Can't parse entities: can't find end tag corresponding to start tag \"i\"")
+        self.log.append(("edit", text))
+
+
+class FakeStreamingGigaChat:
+    def __init__(self, pieces):
+        self.pieces = pieces
+
+    async def astream(self, chat):
+        for piece in self.pieces:
+            await asyncio.sleep(0)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=piece))])
+
+
+def test_split_message_prefers_section_boundaries():
+    sections = ["🔬 Раздел %d\n" % number + "строка анализа\n" * 150 for number in range(3)]
+    text = "\n".join(sections)
+
+    parts = bot.split_message(text)
+
+    assert len(parts) > 1
+    assert all(len(part) <= bot.TELEGRAM_MESSAGE_LIMIT for part in parts)
+    assert parts[1].startswith("🔬 Раздел") or parts[1].startswith("строка")
+    assert "".join(parts).replace("\n", "") == text.replace("\n", "")
+
+
+def test_stream_edits_placeholder_and_records_ttft(monkeypatch):
+    monkeypatch.setattr(bot, "giga", FakeStreamingGigaChat(["Глюкоза ", "повышена. ", "Обратитесь к врачу."]), raising=False)
+    monkeypatch.setattr(bot, "GIGACHAT_CREDENTIALS", "credentials")
+    monkeypatch.setattr(bot, "GIGACHAT_SCOPE", "scope")
+    monkeypatch.setattr(bot, "STREAM_EDIT_INTERVAL", 0)
+    medical_bot = bot.MedicalAnalysisBot()
+    log = []
+    reply = bot.ProgressiveReply(FakeMessage(log), FakeMessage(log))
+
+    async def run():
+        result, _ = await medical_bot.analyze_with_gigachat("Глюкоза: 6.5", on_progress=reply.update)
+        await reply.finish(result)
+        return result
+
+    result = asyncio.run(run())
+
+    assert result == "Глюкоза повышена. Обратитесь к врачу."
+    assert [kind for kind, _ in log] == ["edit", "edit", "edit", "edit"]
+    assert log[-1] == ("edit", result)
+    assert reply.finished
+    assert len(medical_bot.llm_ttft) == 1
+
+
+def test_rejected_markup_replaces_the_preview_with_plain_text(monkeypatch):
+    monkeypatch.setattr(bot, "STREAM_EDIT_INTERVAL", 0)
+    log = []
+    reply = bot.ProgressiveReply(FakeMessage(log), FakeMessage(log, reject_html=True))
+
+    async def run():
+        await reply.update("Глюкоза повышена")
+        await reply.finish("<u>Глюкоза</u>: 6.5 &lt; 7")
+
+    asyncio.run(run())
+
+    # The placeholder is edited once more instead of a second message being sent
+    assert log == [("edit", "Глюкоза повышена ▌"), ("edit", "Глюкоза: 6.5 < 7")]
+    assert reply.finished
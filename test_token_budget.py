@@ -0,0 +1,120 @@
+"""
+Tests for the token estimator and the map-reduce analysis of oversized reports.
+"""
+
+import asyncio
+from types import SimpleNamespace
+
+import bot
+
+
+class FakeGigaChat:
+    """Records prompts and how many calls ran at the same time."""
+
+    retries = 0
+    state = "closed"
+
+    def __init__(self):
+        self.prompts = []
+        self.active = 0
+        self.peak = 0
+
+    async def achat(self, chat):
+        prompt = chat.messages[0].content
+        self.prompts.append(prompt)
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        await asyncio.sleep(0.01)
+        self.active -= 1
+        answer = f"Итог.\n\n{bot.DISCLAIMER}" if prompt.startswith("Ты врач. Результаты") else f"Разбор {len(self.prompts)}."
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=answer))])
+
+
+def make_bot(monkeypatch):
+    giga = FakeGigaChat()
+    monkeypatch.setattr(bot, "giga", giga, raising=False)
+    monkeypatch.setattr(bot, "GIGACHAT_CREDENTIALS", "credentials")
+    monkeypatch.setattr(bot, "GIGACHAT_SCOPE", "scope")
+    monkeypatch.setattr(bot, "LAB_SKIP_LLM_WHEN_NORMAL", False)
+    monkeypatch.setattr(bot, "LAB_LOCAL_SINGLE_ANALYTE", False)
+    return bot.MedicalAnalysisBot(), giga
+
+
+def test_estimate_tokens_weights_cyrillic_and_digits():
+    assert bot.estimate_tokens("") == 0
+    assert bot.estimate_tokens("abcd") == 1
+    assert bot.estimate_tokens("абв") == 1
+    assert bot.estimate_tokens("1234") == 2
+    assert bot.estimate_tokens("Гемоглобин " * 10) > bot.estimate_tokens("Hemoglobin " * 10)
+
+
+def test_split_for_budget_keeps_lines_and_cuts_long_ones():
+    text = "\n".join(f"Показатель {number}: 5.5 ммоль/л" for number in range(200))
+    chunks = bot.split_for_budget(text, 100)
+
+    assert len(chunks) > 1
+    assert all(bot.estimate_tokens(chunk) <= 100 for chunk in chunks)
+    assert "\n".join(chunks) == text
+
+    long_line = "а" * 1000
+    pieces = bot.split_for_budget(long_line, 50)
+    assert "".join(pieces) == long_line
+    assert all(bot.estimate_tokens(piece) <= 50 for piece in pieces)
+
+
+def test_map_prompts_repeat_table_header(monkeypatch):
+    monkeypatch.setattr(bot, "MAP_CHUNK_TOKENS", 200)
+    text = "\n".join(f"Показатель{number} {number}.5 ммоль/л (1.0 - 3.0)" for number in range(60))
+    values = bot.parse_lab_values(text)
+
+    prompts, total = bot.build_map_prompts(text, values)
+
+    assert total == len(prompts) > 1
+    header = bot.format_lab_table(values).split("\n")[0]
+    assert all(header in prompt for prompt in prompts)
+    assert f"часть 1 из {len(prompts)}" in prompts[0]
+
+
+def test_small_report_uses_single_call(monkeypatch):
+    medical_bot, giga = make_bot(monkeypatch)
+
+    asyncio.run(medical_bot.analyze_with_gigachat("Глюкоза 6.5 ммоль/л (3.9 - 5.5)"))
+
+    assert len(giga.prompts) == 1
+    assert medical_bot.metrics.counters[("analyses_total", (("mode", "single"),))] == 1
+
+
+def test_large_report_is_mapped_concurrently_and_reduced(monkeypatch):
+    monkeypatch.setattr(bot, "PROMPT_TOKEN_BUDGET", 300)
+    monkeypatch.setattr(bot, "MAP_CHUNK_TOKENS", 150)
+    medical_bot, giga = make_bot(monkeypatch)
+    text = "\n".join(f"Показатель{number} {number}.5 ммоль/л (1.0 - 3.0)" for number in range(40))
+
+    result, succeeded = asyncio.run(medical_bot.analyze_with_gigachat(text))
+
+    parts = len(giga.prompts) - 1
+    assert parts > 1
+    assert giga.peak > 1
+    reduce_prompt = giga.prompts[-1]
+    assert all("Разбор" in reduce_prompt and f"Часть {number}:" in reduce_prompt for number in range(1, parts + 1))
+    assert bot.ANSWER_RULES in reduce_prompt
+    assert "Итог." in result and succeeded
+    stages = {dict(labels)["stage"] for _, labels in medical_bot.metrics.histograms}
+    assert stages == {"llm_map", "llm", "format"}
+
+
+def test_truncated_report_says_which_parts_were_analysed(monkeypatch):
+    monkeypatch.setattr(bot, "PROMPT_TOKEN_BUDGET", 300)
+    monkeypatch.setattr(bot, "MAP_CHUNK_TOKENS", 150)
+    monkeypatch.setattr(bot, "MAP_MAX_CHUNKS", 2)
+    medical_bot, giga = make_bot(monkeypatch)
+    text = "\n".join(f"Показатель{number} {number}.5 ммоль/л (1.0 - 3.0)" for number in range(40))
+    _, total = bot.build_map_prompts(text, bot.parse_lab_values(text))
+
+    result, succeeded = asyncio.run(medical_bot.analyze_with_gigachat(text))
+
+    assert succeeded and total > 2
+    assert len(giga.prompts) == 3
+    note = f"Разобраны только первые 2 из {total} частей отчёта"
+    assert note in result
+    assert result.index(note) < result.index("Самолечение недопустимо")
@@ -0,0 +1,45 @@
+"""
+Tests for the SQLite-backed user interaction store.
+"""
+
+import asyncio
+import sqlite3
+
+import bot
+
+
+def test_request_count_keeps_increasing(tmp_path):
+    store = bot.UserStore(db_path=str(tmp_path / "users.db"), legacy_path=str(tmp_path / "missing.txt"))
+
+    counts = [store.log_interaction(1, "Иван Иванов", "ivan", ".pdf") for _ in range(3)]
+    store.log_interaction(2, "Мария Смирнова", None, ".docx")
+    asyncio.run(store.close())
+
+    assert counts == [1, 2, 3]
+    conn = sqlite3.connect(str(tmp_path / "users.db"))
+    assert conn.execute("SELECT request_count FROM users WHERE user_id = 1").fetchone() == (3,)
+    assert conn.execute("SELECT COUNT(*) FROM interactions").fetchone() == (4,)
+    assert conn.execute(
+        "SELECT request_type FROM interactions WHERE user_id = 1 ORDER BY id"
+    ).fetchall() == [("first",), ("repeat",), ("repeat",)]
+
+
+def test_legacy_users_txt_is_imported_once(tmp_path):
+    legacy = tmp_path / "users.txt"
+    legacy.write_text(
+        "123|Иван Иванов|ivan|2026-01-21 05:33:48|.pdf|first|1\n"
+        "987|Мария Смирнова|maria_s|2026-01-21 05:33:48|.docx|first|1\n"
+        "123|Иван Иванов|ivan|2026-01-21 05:33:48|.jpg|repeat|2\n"
+        "123|Иван Иванов|ivan|2026-01-21 05:34:10|.pdf|repeat|2\n",
+        encoding="utf-8",
+    )
+    db_path = str(tmp_path / "users.db")
+
+    store = bot.UserStore(db_path=db_path, legacy_path=str(legacy))
+    assert store.counts == {123: 3, 987: 1}
+    asyncio.run(store.close())
+
+    # Reopening must not import the file a second time
+    store = bot.UserStore(db_path=db_path, legacy_path=str(legacy))
+    assert store.log_interaction(123, "Иван Иванов", "ivan", ".pdf") == 4
+    asyncio.run(store.close())
@@ -0,0 +1,29 @@
+"""
+Tests for webhook update deduplication.
+"""
+
+import asyncio
+
+import bot
+
+
+def test_duplicates_are_detected_in_memory():
+    deduplicator = bot.UpdateDeduplicator(size=2)
+
+    async def run():
+        return [await deduplicator.is_duplicate(update_id) for update_id in (1, 2, 1, 3, 1)]
+
+    # Update 1 falls out of the bounded window once 2 and 3 arrive
+    assert asyncio.run(run()) == [False, False, True, False, False]
+
+
+def test_duplicates_are_shared_between_processes(tmp_path):
+    db_path = str(tmp_path / "updates.db")
+    first = bot.UpdateDeduplicator(db_path=db_path)
+    second = bot.UpdateDeduplicator(db_path=db_path)
+
+    assert asyncio.run(first.is_duplicate(42)) is False
+    assert asyncio.run(second.is_duplicate(42)) is True
+    assert second.duplicates == 1
+    first.close()
+    second.close()